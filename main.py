@@ -11,7 +11,7 @@ from selfweed.utils.grid import make_grid
 from selfweed.utils.utils import load_yaml
 
 from selfweed.data.spring_wheat import SpringWheatDataset, SpringWheatMaskedDataset
-from selfweed.labeling import label as label_fn, load_and_label
+from selfweed.labeling import label as label_fn, load_and_label, load_and_merge
 from selfweed.detector import ModifiedHoughCropRowDetector
 from selfweed.utils.utils import get_square_from_lines
 from selfweed.preprocess import divide_ortho_into_patches, rotate_ortho
@@ -141,12 +141,112 @@ def rotate(root, outdir, patch_size):
 @main.command("label")
 @click.option("--outdir", default=OUTDIR, type=click.STRING)
 @click.option("--parameters", default=PARAMETERS, type=click.STRING)
-def label(outdir, parameters):
+@click.option("--workers", default=1, type=click.INT)
+@click.option("--profile", default=False, is_flag=True)
+@click.option("--trace", default=False, is_flag=True)
+@click.option("--shard-index", default=0, type=click.INT)
+@click.option("--num-shards", default=1, type=click.INT)
+def label(outdir, parameters, workers, profile, trace, shard_index, num_shards):
     """
     :param outdir: Output directory
     :param parameters: Parameters file
+    :param workers: Number of CPU labelling processes, 1 labels in the main process
+    :param profile: Write the per stage timings and counters in outdir/{parameters}_profile.txt
+    :param trace: Write the per image timings and counters in outdir/{parameters}_trace.jsonl
+    :param shard_index: Index of the shard of the dataset labelled by this process
+    :param num_shards: Number of shards, combine them with merge-label-shards when all are done
     """
-    load_and_label(outdir, param_file=parameters)
+    load_and_label(
+        outdir,
+        param_file=parameters,
+        workers=workers,
+        profile=profile,
+        trace=trace,
+        shard_index=shard_index,
+        num_shards=num_shards,
+    )
+
+
+@main.command("merge-label-shards")
+@click.option("--outdir", default=OUTDIR, type=click.STRING)
+@click.option("--parameters", default=PARAMETERS, type=click.STRING)
+def merge_label_shards(outdir, parameters):
+    """
+    :param outdir: Output directory of the sharded label runs
+    :param parameters: Parameters file of the sharded label runs
+    """
+    load_and_merge(outdir, param_file=parameters)
+
+
+@main.command("export-patches")
+@click.option("--root", type=click.STRING)
+@click.option("--outdir", type=click.STRING)
+def export_patches(root, outdir):
+    """
+    :param root: Packed patch store written by label (outdir/patches)
+    :param outdir: Output directory of the PNG patches (field/channel/name.png layout)
+    """
+    from selfweed.data.patch_store import export_patches as export_patches_fn
+    export_patches_fn(root, outdir)
+
+
+@main.command("compact-patches")
+@click.option("--root", type=click.STRING)
+@click.option("--min-dead-share", default=0.0, type=click.FLOAT)
+def compact_patches(root, min_dead_share):
+    """
+    :param root: Packed patch store written by label (outdir/patches)
+    :param min_dead_share: Compact only if the removed patches take more than this share of the shard bytes
+    """
+    from selfweed.data.patch_store import compact_patch_store
+    compact_patch_store(root, min_dead_share)
+
+
+@main.command("pack")
+@click.option("--root", default=DATA_ROOT, type=click.STRING)
+@click.option("--outdir", type=click.STRING)
+@click.option("--fields", multiple=True, type=click.STRING)
+@click.option("--channels", multiple=True, default=["R", "G", "B", "NIR", "RE"], type=click.STRING)
+@click.option("--gt-folder", default=None, type=click.STRING)
+def pack(root, outdir, fields, channels, gt_folder):
+    """
+    :param root: Base folder of the dataset
+    :param outdir: Output sample store, given as store (or test_store) in the dataset parameters
+    :param fields: Fields to pack, repeat the option for each field
+    :param channels: Channels to pack, repeat the option for each channel
+    :param gt_folder: Folder of the pseudo GTs to pack, the groundtruth of each field by default
+    """
+    from selfweed.data.sample_store import pack_samples
+    pack_samples(root, outdir, list(fields), list(channels), gt_folder=gt_folder)
+
+
+@main.command("index-plants")
+@click.option("--root", default=DATA_ROOT, type=click.STRING)
+@click.option("--fields", multiple=True, type=click.STRING)
+@click.option("--gt-folder", default=None, type=click.STRING)
+def index_plants(root, fields, gt_folder):
+    """
+    :param root: Base folder of the dataset
+    :param fields: Fields to index, repeat the option for each field
+    :param gt_folder: Folder of the pseudo GTs to index, the groundtruth of each field by default
+    """
+    from selfweed.data.plant_index import build_plant_index
+    from selfweed.data.weedmap import WeedMapDataset
+    dataset = WeedMapDataset(root, [], list(fields), gt_folder=gt_folder)
+    for folder in dataset.gt_folders.values():
+        build_plant_index(folder)
+
+
+@main.command("benchmark")
+@click.option("--name", default="connectivity", type=click.STRING)
+@click.option("--device", default="cpu", type=click.STRING)
+def benchmark(name, device):
+    """
+    :param name: Name of the benchmark (see selfweed.benchmark.BENCHMARKS)
+    :param device: Device where tensors are placed
+    """
+    from selfweed.benchmark import run_benchmark
+    run_benchmark(name, device=device)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,897 @@
+import itertools
+import os
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import pandas as pd
+import torch
+
+from selfweed.cache import StageCache
+from selfweed.detector import (
+    AbstractHoughCropRowDetector,
+    HoughCropRowDetector,
+    HoughDetectorDict,
+    ModifiedHoughCropRowDetector,
+)
+from selfweed.data import build_dataset, get_loader_kwargs, get_preprocessing
+from selfweed.data.utils import bucket_patches, crop_to_nonzero, pad_patches
+from selfweed.data.weedmap import WeedMapDataset
+from selfweed.histogramdd import histogramdd
+from selfweed.labeling import get_patches
+from selfweed.models.rowweeder import RowWeeder
+from selfweed.superpixels import SuperpixelService, get_slic
+from selfweed.utils.utils import (
+    get_cluster_index,
+    get_medians,
+    merge_bboxes,
+    previous_iterator,
+)
+
+
+def synthetic_mask(n_components, plant_size=3, min_size=512):
+    """
+    Build a binary mask with n_components square plants laid out on a grid.
+
+    Args:
+        n_components (int): Number of connected components.
+        plant_size (int): Side of each plant in pixels.
+        min_size (int): Minimum side of the mask.
+
+    Returns:
+        torch.Tensor: (H, W) uint8 mask with values in {0, 255}.
+    """
+    side = int(np.ceil(np.sqrt(n_components)))
+    pitch = plant_size + 2  # Leave a gap so that plants are not 8-connected
+    size = max(min_size, side * pitch)
+    mask = torch.zeros(size, size, dtype=torch.uint8)
+    idx = torch.arange(n_components)
+    rows = (idx // side) * pitch
+    cols = (idx % side) * pitch
+    for dy in range(plant_size):
+        for dx in range(plant_size):
+            mask[rows + dy, cols + dx] = 255
+    return mask
+
+
+def synthetic_rows_mask(theta, size=512, n_rows=5, pitch=9, plant_size=3, seed=0):
+    """
+    Build a binary mask with n_rows crop rows orthogonal to the hough angle theta.
+
+    Args:
+        theta (float): Hough angle of the rows in radians.
+        size (int): Side of the mask.
+        n_rows (int): Number of rows.
+        pitch (int): Distance between two plants of a row.
+        plant_size (int): Side of each plant in pixels.
+        seed (int): Seed of the jitter of the plant positions.
+
+    Returns:
+        torch.Tensor: (H, W) uint8 mask with values in {0, 255}.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    normal = torch.tensor([np.cos(theta), np.sin(theta)])
+    direction = torch.tensor([-np.sin(theta), np.cos(theta)])
+    offsets = (torch.arange(n_rows) - (n_rows - 1) / 2) * size / n_rows
+    steps = torch.arange(-size, size, pitch)
+    centers = (
+        size / 2
+        + offsets[:, None, None] * normal
+        + steps[None, :, None] * direction
+    ).reshape(-1, 2)
+    centers = (centers + torch.randn(centers.shape, generator=generator)).round().long()
+    mask = torch.zeros(size, size, dtype=torch.uint8)
+    for dy in range(plant_size):
+        for dx in range(plant_size):
+            xy = centers + torch.tensor([dx, dy])
+            inside = ((xy >= 0) & (xy < size)).all(dim=1)
+            mask[xy[inside, 1], xy[inside, 0]] = 255
+    return mask
+
+
+def timeit(fn, *args, repeat=3, **kwargs):
+    """
+    Time a function taking the best of `repeat` runs after one warmup run.
+
+    Returns:
+        tuple: (best time in seconds, output of the last run)
+    """
+    out = fn(*args, **kwargs)
+    times = []
+    for _ in range(repeat):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        out = fn(*args, **kwargs)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return min(times), out
+
+
+def connectivity_loop(input_img):
+    """
+    Reference per-label region extraction, O(components x pixels).
+    """
+    components = cv2.connectedComponents(input_img.cpu().numpy())[1]
+    components = torch.tensor(components, device=input_img.device)
+
+    def get_region(label):
+        where_t = torch.where(label == components)
+        y0 = where_t[0][0]  # First dimension is sorted
+        y1 = where_t[0][-1]
+        x0 = where_t[-1].min()
+        x1 = where_t[-1].max()
+        cx = (torch.round((x1 + x0) / 2)).int()
+        cy = (torch.round((y1 + y0) / 2)).int()
+        return torch.tensor([cx, cy, x0, y0, x1, y1, x1 - x0 + 1, y1 - y0 + 1])
+
+    labels = components.unique()[1:]  # First one is background
+    return torch.stack(tuple(map(get_region, labels)))
+
+
+def benchmark_connectivity(sizes=(10, 1000, 10000), device="cpu", repeat=3):
+    """
+    Compare the single pass region extraction with the per-label loop.
+    """
+    detector = AbstractHoughCropRowDetector()
+    rows = []
+    for n_components in sizes:
+        mask = synthetic_mask(n_components).to(device)
+        fast_time, (_, regions) = timeit(
+            detector.calculate_connectivity, mask, repeat=repeat
+        )
+        loop_time, loop_regions = timeit(connectivity_loop, mask, repeat=1)
+        rows.append(
+            {
+                "components": n_components,
+                "single_pass_s": fast_time,
+                "loop_s": loop_time,
+                "speedup": loop_time / fast_time,
+                "equal": torch.equal(regions.cpu(), loop_regions.cpu().long()),
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+def histogramdd_loop(thetas, rhos, rho_values, displacements):
+    """
+    Reference band voting, one arange per (component, theta) pair.
+    """
+    device = thetas.device
+    bins = [thetas.float(), rhos.float()]
+    sample = torch.stack(
+        [torch.tile(thetas, (rho_values.shape[0], 1)).ravel(), rho_values.ravel()]
+    ).T
+    nbin = torch.tensor([len(bins[0]), len(bins[1])])
+    ncount = torch.stack(
+        [
+            torch.searchsorted(bins[i], sample[:, i].contiguous(), side="left")
+            for i in range(2)
+        ],
+        dim=1,
+    )
+    xy = ncount @ torch.tensor([nbin[1], 1], device=device)
+    displacements_adapted = (
+        displacements.repeat(len(thetas))
+        .reshape(len(thetas), len(displacements))
+        .T.flatten()
+    )
+    xy_enlarged = torch.concat(
+        [
+            torch.arange(-dis, dis + 1, device=device) + xyindex
+            for dis, xyindex in zip(displacements_adapted, xy)
+        ]
+    )
+    return torch.bincount(xy_enlarged, minlength=nbin.prod()).reshape(*nbin)
+
+
+def hough_inputs(detector, shape, regions):
+    """
+    Inputs of histogramdd as computed by ModifiedHoughCropRowDetector.hough, on the
+    device of the regions
+    """
+    width, height = shape
+    d = np.sqrt(np.square(height) + np.square(width))
+    thetas = torch.arange(0, 180, step=detector.step_theta, device=regions.device)
+    rhos = torch.arange(-d, d + 1, step=detector.step_rho, device=regions.device)
+    points = torch.stack(
+        [
+            regions[:, detector.IDX_CY] - height / 2,
+            regions[:, detector.IDX_CX] - width / 2,
+        ],
+        dim=1,
+    )
+    trig = torch.stack(
+        [torch.sin(torch.deg2rad(thetas)), torch.cos(torch.deg2rad(thetas))]
+    )
+    rho_values = torch.matmul(points.float(), trig)
+    shapes = regions[:, [detector.IDX_WIDTH, detector.IDX_HEIGHT]]
+    displacements = torch.div(shapes.max(dim=1).values, 2).round().int()
+    return thetas, rhos, rho_values, displacements
+
+
+def benchmark_histogramdd(sizes=(10, 1000, 3000), device="cpu", repeat=3):
+    """
+    Compare difference-array band voting with the per-sample concatenation and
+    check that both produce the same accumulator.
+    """
+    detector = ModifiedHoughCropRowDetector(device=device)
+    rows = []
+    for n_components in sizes:
+        mask = synthetic_mask(n_components).to(device)
+        _, regions = detector.calculate_connectivity(mask)
+        inputs = hough_inputs(detector, mask.shape, regions)
+        fast_time, (accumulator, _) = timeit(
+            histogramdd, *inputs[:3], displacements=inputs[3], repeat=repeat
+        )
+        loop_time, loop_accumulator = timeit(histogramdd_loop, *inputs, repeat=1)
+        rows.append(
+            {
+                "components": n_components,
+                "votes": int(accumulator.sum()),
+                "band_voting_s": fast_time,
+                "loop_s": loop_time,
+                "speedup": loop_time / fast_time,
+                "equal": torch.equal(accumulator, loop_accumulator),
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+def calculate_mask_loop(detector, shape, regions):
+    """
+    Reference mask painting, one slice assignment per region.
+    """
+    displ_mask = torch.zeros(shape, dtype=torch.uint8)
+    for cx, cy, x0, y0, x1, y1, width, height in regions:
+        displacement = detector.displacement(width, height)
+        displ_mask[
+            max(int(cy - displacement), 0) : min(int(cy + displacement), shape[0]),
+            max(int(cx - displacement), 0) : min(int(cx + displacement), shape[1]),
+        ] = 255
+    return displ_mask
+
+
+def increase_recall_loop(detector, regions):
+    """
+    Reference neighbour merging, each region is compared with all the others.
+    """
+    regions = regions.clone()
+
+    def get_neighbours(cx, cy, regions, threshold):
+        return ((regions[:, detector.IDX_CX] - cx).abs() < threshold) & (
+            (regions[:, detector.IDX_CY] - cy).abs() < threshold
+        )
+
+    presence = torch.ones(regions.shape[0], dtype=torch.bool)
+    for i in range(regions.shape[0]):
+        cx, cy, x0, y0, x1, y1, width, height = regions[i]
+        neighbours = get_neighbours(
+            cx,
+            cy,
+            regions[presence],
+            detector.displacement(width, height) * detector.crop_merge_multiplier,
+        )
+        if neighbours.sum() > 1:
+            neighbours = presence.argwhere().squeeze(1)[neighbours]
+            regions[neighbours[-1]] = merge_bboxes(regions[neighbours])
+            presence[neighbours[:-1]] = False
+    return regions[presence].contiguous()
+
+
+def benchmark_mask(
+    sizes=(1000, 10000, 50000), device="cpu", repeat=3, crop_merge_multiplier=1
+):
+    """
+    Compare the difference-array mask painter and the grid-bucketed neighbour
+    merging with their per-region loops on synthetic masks. The plants of
+    synthetic_mask are farther apart than their merge threshold, so the recall
+    timings measure the neighbour queries.
+    """
+    detector = ModifiedHoughCropRowDetector(
+        crop_merge_multiplier=crop_merge_multiplier, device=device
+    )
+    rows = []
+    for n_components in sizes:
+        mask = synthetic_mask(n_components).to(device)
+        _, regions = detector.calculate_connectivity(mask)
+        mask_time, displ_mask = timeit(
+            detector.calculate_mask, mask.shape, regions, repeat=repeat
+        )
+        mask_loop_time, loop_mask = timeit(
+            calculate_mask_loop, detector, mask.shape, regions.cpu(), repeat=1
+        )
+        recall_time, merged = timeit(
+            detector.increase_recall, regions, repeat=repeat
+        )
+        recall_loop_time, loop_merged = timeit(
+            increase_recall_loop, detector, regions.cpu(), repeat=1
+        )
+        rows.append(
+            {
+                "components": n_components,
+                "mask_s": mask_time,
+                "mask_loop_s": mask_loop_time,
+                "mask_equal": torch.equal(displ_mask.cpu(), loop_mask),
+                "merged_regions": len(merged),
+                "recall_s": recall_time,
+                "recall_loop_s": recall_loop_time,
+                "recall_equal": torch.equal(merged.cpu(), loop_merged),
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+def benchmark_theta_search(n_masks=20, device="cpu", threshold=60, prior_patches=3):
+    """
+    Compare the full theta sweep of HoughCropRowDetector with the coarse-to-fine search,
+    without and with a learned angle prior, on synthetic row masks of a single field.
+    The warmup run of timeit learns the prior, the timed one reuses it.
+    """
+    generator = torch.Generator().manual_seed(0)
+    theta = torch.rand(1, generator=generator).item() * np.pi
+    masks = [synthetic_rows_mask(theta, seed=seed) for seed in range(n_masks)]
+    searches = {
+        "full": HoughCropRowDetector(threshold=threshold, device=device),
+        "coarse_to_fine": HoughCropRowDetector(
+            threshold=threshold, coarse_to_fine=True, device=device
+        ),
+        "prior": HoughCropRowDetector(
+            threshold=threshold,
+            coarse_to_fine=True,
+            theta_prior_patches=prior_patches,
+            device=device,
+        ),
+    }
+
+    def detect(detector):
+        return [
+            detector.predict_from_mask(mask.unsqueeze(0), field="synthetic")[
+                HoughDetectorDict.LINES
+            ]
+            for mask in masks
+        ]
+
+    rows = []
+    for name, detector in searches.items():
+        elapsed, lines = timeit(detect, detector, repeat=1)
+        thetas = torch.cat([line[:, 1] for line in lines if len(line) > 0])
+        rows.append(
+            {
+                "search": name,
+                "seconds": elapsed,
+                "lines": len(thetas),
+                "theta_error": (thetas - theta).abs().mean().item(),
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+def benchmark_sweep(
+    n_masks=8,
+    thresholds=tuple(range(40, 140, 10)),
+    clustering_tols=(1, 2, 4, 8, "crop_as_tol"),
+    device="cpu",
+):
+    """
+    Compare a (threshold, clustering_tol) sweep of each detector with a detection
+    per combination on synthetic row masks, and check that both find the same lines.
+    """
+    masks = torch.stack(
+        [
+            synthetic_rows_mask(theta, seed=seed)
+            for seed, theta in enumerate(np.linspace(0, np.pi, n_masks, endpoint=False))
+        ]
+    )
+    detectors = {
+        "modified": (ModifiedHoughCropRowDetector, [t // 10 for t in thresholds]),
+        "hough": (HoughCropRowDetector, list(thresholds)),
+    }
+
+    def detect_each(cls, thresholds):
+        return [
+            cls(
+                threshold=threshold, clustering_tol=clustering_tol, device=device
+            ).predict_batch(masks)
+            for threshold in thresholds
+            for clustering_tol in clustering_tols
+        ]
+
+    rows = []
+    for name, (cls, detector_thresholds) in detectors.items():
+        single_time, _ = timeit(
+            cls(device=device).predict_batch, masks, repeat=1
+        )
+        sweep_time, sweep = timeit(
+            cls(device=device).sweep,
+            masks,
+            detector_thresholds,
+            None,
+            list(clustering_tols),
+            repeat=1,
+        )
+        loop_time, results = timeit(
+            detect_each, cls, detector_thresholds, repeat=1
+        )
+        loop_lines = [
+            result[HoughDetectorDict.LINES] for batch in results for result in batch
+        ]
+        rows.append(
+            {
+                "detector": name,
+                "combinations": len(detector_thresholds) * len(clustering_tols),
+                "detection_s": single_time,
+                "sweep_s": sweep_time,
+                "loop_s": loop_time,
+                "speedup": loop_time / sweep_time,
+                "equal": all(
+                    len(a) == len(b) == 0 or torch.equal(a, b)
+                    for a, b in zip(loop_lines, sweep["lines"])
+                ),
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+def same_lines(a, b):
+    return len(a) == len(b) == 0 or (
+        a.shape == b.shape and torch.equal(a.float().cpu(), b.float().cpu())
+    )
+
+
+def benchmark_hough_lines(n_masks=12, thresholds=(40, 60, 100), device="cpu"):
+    """
+    Check HoughCropRowDetector.predict_batch against predict_from_mask (cv2.HoughLines
+    per mask) on synthetic row masks, with the cv2 lines and with the torch accumulator
+    (torch_hough): share of the masks with the same lines, original lines and zero
+    reason, and time of the batch and of the loop.
+    """
+    masks = torch.stack(
+        [
+            synthetic_rows_mask(theta, seed=seed)
+            for seed, theta in enumerate(np.linspace(0, np.pi, n_masks, endpoint=False))
+        ]
+    ).to(device)
+    rows = []
+    for threshold in thresholds:
+        for torch_hough in (False, True):
+            detector = HoughCropRowDetector(
+                threshold=threshold, torch_hough=torch_hough, device=device
+            )
+            batch_time, batch = timeit(detector.predict_batch, masks, repeat=1)
+            loop_time, single = timeit(
+                lambda: [detector.predict_from_mask(mask.unsqueeze(0)) for mask in masks],
+                repeat=1,
+            )
+            equal = [
+                same_lines(b[HoughDetectorDict.LINES], s[HoughDetectorDict.LINES])
+                and same_lines(
+                    b[HoughDetectorDict.ORIGINAL_LINES],
+                    s[HoughDetectorDict.ORIGINAL_LINES],
+                )
+                and b[HoughDetectorDict.ZERO_REASON] == s[HoughDetectorDict.ZERO_REASON]
+                for b, s in zip(batch, single)
+            ]
+            rows.append(
+                {
+                    "threshold": threshold,
+                    "hough": "torch" if torch_hough else "cv2",
+                    "equal_share": np.mean(equal),
+                    "batch_s": batch_time,
+                    "loop_s": loop_time,
+                }
+            )
+    return pd.DataFrame(rows)
+
+
+def get_patches_loop(img, weedmap, slic_map):
+    """
+    Reference get_patches, full image masks for each SLIC segment.
+    """
+    MIN_HEIGHT = 10
+    MIN_WIDTH = 10
+    MIN_PLANT_PERCENT = 0.1
+    patches = []
+    slic_map = torch.tensor(slic_map)
+    weedmap = weedmap.argmax(dim=0).cpu()
+    weedmap_slic = torch.zeros_like(slic_map)
+    for i in np.unique(slic_map):
+        mask = slic_map == i
+        plant_mask = mask * weedmap
+        if plant_mask.sum() == 0:
+            continue
+        patch_mask = crop_to_nonzero(plant_mask)
+        min_size = (
+            patch_mask.shape[0] >= MIN_HEIGHT and patch_mask.shape[1] >= MIN_WIDTH
+        )
+        values, counts = torch.unique(patch_mask, return_counts=True)
+        complete_counts = torch.zeros(3, dtype=int)
+        complete_counts[values] = counts
+        if values.sum() == 0:
+            continue
+        label = complete_counts[1:].argmax() + 1
+        min_percent = complete_counts[label] >= (
+            MIN_PLANT_PERCENT * complete_counts.sum()
+        )
+        patch = crop_to_nonzero(mask * img)
+        weedmap_slic[plant_mask.bool()] = label
+        if min_size and min_percent:
+            patches.append((patch, label - 1))
+    return weedmap_slic, patches
+
+
+def benchmark_patches(sizes=(256, 512), percent=0.005, device="cpu", repeat=3):
+    """
+    Compare the single pass get_patches with the per-segment loop on synthetic
+    row images (weeds are the plants off the rows) and check that both return
+    the same SLIC weed map and patches. Both run on CPU, device is ignored.
+    """
+    rows = []
+    for size in sizes:
+        crops = synthetic_rows_mask(0.3, size=size, plant_size=7, pitch=15)
+        weeds = synthetic_rows_mask(1.4, size=size, n_rows=3, plant_size=5, seed=1)
+        weeds = weeds * (1 - crops)
+        mask = crops | weeds
+        generator = torch.Generator().manual_seed(0)
+        img = torch.rand(5, size, size, generator=generator) * 0.2
+        img[1] += mask * 0.6
+        weedmap = torch.stack([mask == 0, crops.bool(), weeds.bool()]).long()
+        slic = get_slic(img, {"percent": percent, "compactness": 20, "sigma": 1})
+        fast_time, (weedmap_slic, patches) = timeit(
+            get_patches, img, weedmap, slic, repeat=repeat
+        )
+        loop_time, (loop_weedmap_slic, loop_patches) = timeit(
+            get_patches_loop, img, weedmap, slic, repeat=1
+        )
+        rows.append(
+            {
+                "size": size,
+                "segments": len(np.unique(slic)),
+                "patches": len(patches),
+                "vectorized_s": fast_time,
+                "loop_s": loop_time,
+                "speedup": loop_time / fast_time,
+                "equal": torch.equal(weedmap_slic, loop_weedmap_slic)
+                and len(patches) == len(loop_patches)
+                and all(
+                    torch.equal(patch, loop_patch) and label == loop_label
+                    for (patch, label), (loop_patch, loop_label) in zip(
+                        patches, loop_patches
+                    )
+                ),
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+def achievable_segmentation_accuracy(segments, reference):
+    """
+    Fraction of pixels of each segment in its most overlapping reference segment.
+    """
+    segments = torch.unique(torch.as_tensor(segments), return_inverse=True)[1].flatten()
+    reference = torch.unique(torch.as_tensor(reference), return_inverse=True)[1].flatten()
+    n_reference = int(reference.max()) + 1
+    overlaps = torch.bincount(
+        segments * n_reference + reference,
+        minlength=(int(segments.max()) + 1) * n_reference,
+    ).reshape(-1, n_reference)
+    return (overlaps.max(dim=1).values.sum() / len(segments)).item()
+
+
+def benchmark_slic(
+    size=512, percent=0.005, downscales=(1, 2), device="cpu", cache_root=None
+):
+    """
+    Time SLIC at full resolution and in downscale mode on a synthetic row image.
+    Quality is measured as the achievable segmentation accuracy of the superpixels
+    w.r.t. the weed map (how well they follow the plant boundaries) and as the agreement
+    of the SLIC weed maps of get_patches with the full resolution one on the plant pixels.
+    With cache_root, the cached lookup is timed too.
+    Everything runs on CPU, device is ignored.
+    """
+    crops = synthetic_rows_mask(0.3, size=size, plant_size=7, pitch=15)
+    weeds = synthetic_rows_mask(1.4, size=size, n_rows=3, plant_size=5, seed=1)
+    weeds = weeds * (1 - crops)
+    mask = crops | weeds
+    generator = torch.Generator().manual_seed(0)
+    img = torch.rand(5, size, size, generator=generator) * 0.2
+    img[1] += mask * 0.6
+    weedmap = torch.stack([mask == 0, crops.bool(), weeds.bool()]).long()
+    slic_params = {"percent": percent, "compactness": 20, "sigma": 1}
+
+    reference = get_slic(img, slic_params)
+    reference_weedmap = get_patches(img, weedmap, reference)[0]
+    rows = []
+    for downscale in downscales:
+        params = {**slic_params, "downscale": downscale}
+        elapsed, slic = timeit(get_slic, img, params, repeat=1)
+        weedmap_slic = get_patches(img, weedmap, slic)[0]
+        row = {
+            "downscale": downscale,
+            "segments": len(np.unique(slic)),
+            "seconds": elapsed,
+            "asa": achievable_segmentation_accuracy(slic, weedmap.argmax(dim=0)),
+            "weedmap_agreement": (
+                (weedmap_slic == reference_weedmap)[mask.bool()].float().mean().item()
+            ),
+        }
+        if cache_root is not None:
+            service = SuperpixelService(params, cache=StageCache(cache_root))
+            row["cached_seconds"], cached = timeit(service, img, repeat=3)
+            row["cached_equal"] = np.array_equal(cached, slic)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def cluster_loop(sorted_lines, clustering_tol):
+    """
+    Reference rho clustering and median selection, one python step per line.
+    """
+    cluster_indices = [0]
+    if sorted_lines.shape[0] > 1:
+        for i in range(1, sorted_lines.shape[0]):
+            if abs(sorted_lines[i][0] - sorted_lines[i - 1][0]) > clustering_tol:
+                cluster_indices.append(i)
+    else:
+        i = 0
+    cluster_indices.append(i + 1)
+    return torch.stack(
+        [
+            sorted_lines[(i + j) // 2]
+            for i, j in previous_iterator(cluster_indices, return_first=False)
+        ]
+    )
+
+
+def cluster_vectorized(sorted_lines, clustering_tol):
+    cluster_index = get_cluster_index(sorted_lines[:, 0], clustering_tol)
+    return get_medians(sorted_lines, cluster_index)
+
+
+def benchmark_clustering(
+    sizes=(100, 1000, 10000), device="cpu", repeat=3, clustering_tol=2
+):
+    """
+    Compare the vectorized rho clustering with the per-line loop on random
+    (rho, theta) lines and check that both select the same medians.
+    """
+    generator = torch.Generator().manual_seed(0)
+    rows = []
+    for n_lines in sizes:
+        rhos = torch.rand(n_lines, generator=generator) * n_lines * clustering_tol
+        thetas = torch.rand(n_lines, generator=generator) * np.pi
+        lines = torch.stack([rhos, thetas], dim=1).to(device)
+        sorted_lines = lines[torch.argsort(lines[:, 0])]
+        fast_time, medians = timeit(
+            cluster_vectorized, sorted_lines, clustering_tol, repeat=repeat
+        )
+        loop_time, loop_medians = timeit(
+            cluster_loop, sorted_lines, clustering_tol, repeat=1
+        )
+        rows.append(
+            {
+                "lines": n_lines,
+                "clusters": len(medians),
+                "vectorized_s": fast_time,
+                "loop_s": loop_time,
+                "speedup": loop_time / fast_time,
+                "equal": torch.equal(medians, loop_medians),
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+def synthetic_plants(batch_size=8, max_plants=10, large_share=0.05, seed=0):
+    """
+    Random plant crops of a batch: mostly small plants with a few large ones,
+    as the crops and weeds of SelfSupervisedWeedMapDataset.
+
+    Returns:
+        list: The list of (3, h, w) plants of each sample.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    samples = []
+    for _ in range(batch_size):
+        plants = []
+        for _ in range(int(torch.randint(1, max_plants + 1, (1,), generator=generator))):
+            large = torch.rand(1, generator=generator).item() < large_share
+            low, high = (48, 128) if large else (3, 24)
+            h, w = torch.randint(low, high, (2,), generator=generator).tolist()
+            plants.append(torch.rand(3, h, w, generator=generator))
+        samples.append(plants)
+    return samples
+
+
+def count_conv_flops(module, fn, *args):
+    """
+    Run fn counting the multiply-adds of the Conv2d layers of module (x2 for FLOPs).
+    """
+    flops = [0]
+
+    def hook(conv, inputs, output):
+        kernel = conv.in_channels // conv.groups * np.prod(conv.kernel_size)
+        flops[0] += 2 * output.numel() * kernel
+
+    handles = [
+        layer.register_forward_hook(hook)
+        for layer in module.modules()
+        if isinstance(layer, torch.nn.Conv2d)
+    ]
+    try:
+        fn(*args)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return flops[0]
+
+
+def benchmark_plant_batches(
+    batch_size=8,
+    max_plants=10,
+    large_shares=(0.0, 0.05, 0.2),
+    buckets=(16, 32, 64),
+    device="cpu",
+    repeat=3,
+):
+    """
+    Compare the plant batches padded to the largest plant (pad_patches) with the size
+    bucketed ones (bucket_patches): share of padding pixels in the batch, size of the
+    batch, FLOPs and time of the RowWeeder plant encoder, and peak memory on CUDA.
+    """
+    model = RowWeeder(None, ["R", "G", "B"], [16, 32, 64, 128]).to(device).eval()
+    rows = []
+    for large_share in large_shares:
+        samples = synthetic_plants(batch_size, max_plants, large_share)
+        plant_pixels = sum(p.shape[-2] * p.shape[-1] for s in samples for p in s)
+        batches = {
+            "padded": [
+                x.to(device)
+                for x in pad_patches([pad_patches(plants)[0] for plants in samples])
+            ],
+            "bucketed": [
+                [plants.to(device), positions.to(device)]
+                for plants, positions in bucket_patches(samples, list(buckets))
+            ],
+        }
+        for mode, batch in batches.items():
+            tensors = [batch[0]] if mode == "padded" else [plants for plants, _ in batch]
+            batch_pixels = sum(t.numel() // t.shape[-3] for t in tensors)
+            if torch.cuda.is_available():
+                torch.cuda.reset_peak_memory_stats()
+            with torch.no_grad():
+                elapsed, _ = timeit(model._encode_plants, batch, repeat=repeat)
+                flops = count_conv_flops(model.plant_encoder, model._encode_plants, batch)
+            rows.append(
+                {
+                    "large_share": large_share,
+                    "mode": mode,
+                    "plants": sum(len(s) for s in samples),
+                    "padding": 1 - plant_pixels / batch_pixels,
+                    "batch_mb": sum(t.numel() * t.element_size() for t in tensors) / 2**20,
+                    "encoder_gflops": flops / 1e9,
+                    "encode_s": elapsed,
+                    "peak_mb": torch.cuda.max_memory_allocated() / 2**20
+                    if torch.cuda.is_available()
+                    else float("nan"),
+                }
+            )
+    return pd.DataFrame(rows)
+
+
+def synthetic_weedmap(root, n_images=64, size=512, field="000", seed=0):
+    """
+    Write a WeedMap field tree of random images: a PNG for each of the R, G, B, NIR
+    and RE channels and an index label map in groundtruth.
+    """
+    rng = np.random.default_rng(seed)
+    for folder in ["R", "G", "B", "NIR", "RE", "groundtruth"]:
+        os.makedirs(os.path.join(root, field, folder), exist_ok=True)
+    for i in range(n_images):
+        filename = f"frame{i:04d}.png"
+        for channel in ["R", "G", "B", "NIR", "RE"]:
+            cv2.imwrite(
+                os.path.join(root, field, channel, filename),
+                rng.integers(0, 256, (size, size), dtype=np.uint8),
+            )
+        cv2.imwrite(
+            os.path.join(root, field, "groundtruth", filename),
+            rng.integers(0, 3, (size, size), dtype=np.uint8),
+        )
+
+
+def benchmark_loader(
+    n_images=64,
+    size=512,
+    batch_size=8,
+    num_workers=(0, 2),
+    resize=None,
+    device="cpu",
+    repeat=2,
+):
+    """
+    Compare the throughput of WeedMapDataset loaders whose transforms run in the
+    workers (float batches) with the ones preprocessed on the device (uint8 batches,
+    device_preprocessing), for each number of workers and, on CUDA, with and without
+    pinned memory: samples/s of an epoch moved to the device and preprocessed, and
+    size of the collated batch of images.
+    """
+    preprocess = {"mean": [0.5, 0.5, 0.5], "std": [0.25, 0.25, 0.25]}
+    if resize is not None:
+        preprocess["resize"] = resize
+    transforms, target_transforms, _ = get_preprocessing({"preprocess": preprocess})
+    pin_memory = (False, True) if torch.cuda.is_available() else (False,)
+    rows = []
+    with tempfile.TemporaryDirectory() as root:
+        synthetic_weedmap(root, n_images, size)
+        for workers, pin, device_preprocessing in itertools.product(
+            num_workers, pin_memory, (False, True)
+        ):
+            dataloader_params = {
+                "batch_size": batch_size,
+                "num_workers": workers,
+                "pin_memory": pin,
+                "persistent_workers": True,
+                "prefetch_factor": 2,
+                "device_preprocessing": device_preprocessing,
+            }
+            dataset = build_dataset(
+                WeedMapDataset,
+                transforms,
+                dataloader_params,
+                root=root,
+                channels=["R", "G", "B"],
+                fields=["000"],
+                target_transform=target_transforms,
+            )
+            loader = torch.utils.data.DataLoader(
+                dataset,
+                batch_size=batch_size,
+                shuffle=False,
+                **get_loader_kwargs(dataloader_params),
+            )
+            device_transform = getattr(dataset, "device_transform", None)
+
+            def epoch():
+                batch_mb = 0
+                for batch in loader:
+                    batch_mb = batch.image.numel() * batch.image.element_size() / 2**20
+                    image = batch.image.to(device, non_blocking=pin)
+                    if device_transform is not None:
+                        image = device_transform(image)
+                return batch_mb
+
+            elapsed, batch_mb = timeit(epoch, repeat=repeat)
+            rows.append(
+                {
+                    "num_workers": workers,
+                    "pin_memory": pin,
+                    "preprocessing": "device" if device_preprocessing else "workers",
+                    "batch_mb": batch_mb,
+                    "epoch_s": elapsed,
+                    "samples_per_s": len(dataset) / elapsed,
+                }
+            )
+    return pd.DataFrame(rows)
+
+
+BENCHMARKS = {
+    "connectivity": benchmark_connectivity,
+    "histogramdd": benchmark_histogramdd,
+    "clustering": benchmark_clustering,
+    "mask": benchmark_mask,
+    "theta_search": benchmark_theta_search,
+    "sweep": benchmark_sweep,
+    "hough_lines": benchmark_hough_lines,
+    "patches": benchmark_patches,
+    "slic": benchmark_slic,
+    "plant_batches": benchmark_plant_batches,
+    "loader": benchmark_loader,
+}
+
+
+def run_benchmark(name, **kwargs):
+    results = BENCHMARKS[name](**kwargs)
+    print(results.to_string(index=False))
+    return results
@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+import uuid
+
+import numpy as np
+import torch
+
+
+def hash_array(x):
+    """
+    Content hash of an array or tensor, including its shape and dtype.
+    """
+    if torch.is_tensor(x):
+        x = x.detach().cpu().numpy()
+    x = np.ascontiguousarray(x)
+    digest = hashlib.sha1(x.tobytes())
+    digest.update(f"{x.shape}{x.dtype}".encode())
+    return digest.hexdigest()
+
+
+def hash_files(paths):
+    """
+    Content hash of the bytes of some files.
+    """
+    digest = hashlib.sha1()
+    for path in paths:
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def hash_params(*parts):
+    """
+    Stable hash of JSON serializable parts (e.g. a stage name, upstream keys and parameters).
+    """
+    encoded = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha1(encoded.encode()).hexdigest()
+
+
+class StageCache:
+    """
+    Persistent content-addressed cache of stage outputs.
+
+    Each entry is a dictionary of outputs: tensors and arrays are written as .npy files
+    in a directory per entry (sharded by the first two characters of the key) and
+    read through a memory map, other values must be JSON serializable and are kept in a
+    SQLite index together with the size and the last access time of the entry.
+    When max_bytes is set, the least recently used entries are evicted to keep the
+    cache within the budget. The index makes the cache safe to share across processes.
+    """
+
+    INDEX_FILE = "index.sqlite"
+
+    def __init__(self, root, max_bytes=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+        self.index = sqlite3.connect(os.path.join(root, self.INDEX_FILE), timeout=60)
+        with self.index:
+            self.index.execute(
+                "CREATE TABLE IF NOT EXISTS entries "
+                "(key TEXT PRIMARY KEY, nbytes INTEGER, last_access REAL, meta TEXT)"
+            )
+
+    def entry_dir(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key):
+        """
+        Outputs stored under key, None if missing. Arrays are returned as CPU tensors
+        backed by copy-on-write memory maps of the entry files.
+        """
+        row = self.index.execute(
+            "SELECT meta FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        meta = json.loads(row[0])
+        try:
+            # Copy-on-write maps: writable tensors without reading the files up front,
+            # which stay readable if another process evicts the entry afterwards
+            arrays = {
+                name: torch.from_numpy(
+                    np.load(
+                        os.path.join(self.entry_dir(key), f"{name}.npy"), mmap_mode="c"
+                    )
+                )
+                for name in meta["arrays"]
+            }
+        except FileNotFoundError:  # Evicted by another process
+            return None
+        with self.index:
+            self.index.execute(
+                "UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key)
+            )
+        return {**meta["values"], **arrays}
+
+    def put(self, key, outputs):
+        """
+        Store the outputs dictionary under key, then evict the least recently used
+        entries if the cache exceeds max_bytes.
+        """
+        arrays, values = {}, {}
+        for name, value in outputs.items():
+            if torch.is_tensor(value):
+                arrays[name] = value.detach().cpu().numpy()
+            elif isinstance(value, np.ndarray):
+                arrays[name] = value
+            elif isinstance(value, np.generic):
+                values[name] = value.item()
+            else:
+                values[name] = value
+        # Write in a temporary directory, then move it so that readers never see partial entries
+        tmp_dir = os.path.join(self.root, f"tmp-{uuid.uuid4().hex}")
+        os.makedirs(tmp_dir)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), array)
+        entry_dir = self.entry_dir(key)
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(tmp_dir, entry_dir)
+        nbytes = sum(
+            os.path.getsize(os.path.join(entry_dir, f"{name}.npy")) for name in arrays
+        )
+        meta = json.dumps({"arrays": list(arrays), "values": values})
+        with self.index:
+            self.index.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                (key, nbytes, time.time(), meta),
+            )
+        if self.max_bytes is not None:
+            self.evict(self.max_bytes)
+
+    def evict(self, max_bytes):
+        """
+        Remove the least recently used entries until the cache is within max_bytes.
+        """
+        total = self.index.execute(
+            "SELECT COALESCE(SUM(nbytes), 0) FROM entries"
+        ).fetchone()[0]
+        if total <= max_bytes:
+            return
+        for key, nbytes in self.index.execute(
+            "SELECT key, nbytes FROM entries ORDER BY last_access"
+        ).fetchall():
+            if total <= max_bytes:
+                break
+            with self.index:
+                self.index.execute("DELETE FROM entries WHERE key = ?", (key,))
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            total -= nbytes
+
+    def cached_batch(self, keys, compute):
+        """
+        Outputs of each key, computing only the missing ones.
+        :param keys: list of keys
+        :param compute: function taking the indices of the missing keys and
+            returning the list of their outputs
+        :return: list of outputs dictionaries
+        """
+        outputs = [self.get(key) for key in keys]
+        missing = [i for i, output in enumerate(outputs) if output is None]
+        if missing:
+            for i, output in zip(missing, compute(missing)):
+                self.put(keys[i], output)
+                outputs[i] = output
+        return outputs
+
+    def cached(self, key, compute):
+        """
+        Outputs of key, computed with compute() and stored if missing.
+        """
+        return self.cached_batch([key], lambda missing: [compute()])[0]
+
+    def __getstate__(self):
+        return {"root": self.root, "max_bytes": self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+class Manifest:
+    """
+    Record of the inputs processed by a run: the hash of the run parameters and the
+    content hash of each processed input. A manifest written with other parameters
+    is discarded (reset is True), so that only unchanged inputs of the same run are
+    skipped. Entries are written atomically on flush.
+    """
+
+    def __init__(self, path, params_hash):
+        self.path = path
+        self.params_hash = params_hash
+        self.entries = {}
+        self.reset = True
+        if os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            if manifest["params"] == params_hash:
+                self.entries = manifest["entries"]
+                self.reset = False
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def add(self, key, content_hash):
+        self.entries[key] = content_hash
+
+    def flush(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"params": self.params_hash, "entries": self.entries}, f)
+        os.replace(tmp_path, self.path)
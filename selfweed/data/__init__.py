@@ -43,6 +43,37 @@ def get_preprocessing(dataset_params):
     return transforms, target_transforms, deprocess
 
 
+def get_loader_kwargs(dataloader_params):
+    """
+    DataLoader arguments of dataloader_params: num_workers and the optional pin_memory,
+    persistent_workers and prefetch_factor, the last two only with worker processes.
+    """
+    kwargs = {
+        "num_workers": dataloader_params["num_workers"],
+        "pin_memory": dataloader_params.get("pin_memory", False),
+    }
+    if kwargs["num_workers"] > 0:
+        for key in ("persistent_workers", "prefetch_factor"):
+            if key in dataloader_params:
+                kwargs[key] = dataloader_params[key]
+    return kwargs
+
+
+def build_dataset(dataset_class, transforms, dataloader_params, **params):
+    """
+    Build a dataset whose transforms run in the loader workers or, with
+    device_preprocessing in dataloader_params, on the device: samples are then loaded
+    and collated as uint8, and Run applies the device_transform of the dataset to
+    the images of each batch.
+    """
+    if not dataloader_params.get("device_preprocessing", False):
+        return dataset_class(transform=transforms, **params)
+    dataset = dataset_class(transform=None, **params)
+    # The datasets convert the images to float before their transforms
+    dataset.device_transform = T.Compose([lambda x: x.float(), transforms])
+    return dataset
+
+
 def get_classification_dataloaders(dataset_params, dataloader_params, seed=42):
     dataset_params = deepcopy(dataset_params)
     transforms, target_transforms, deprocess = get_preprocessing(dataset_params)
@@ -63,14 +94,22 @@ def get_classification_dataloaders(dataset_params, dataloader_params, seed=42):
         train_params.pop("train_fields")
         train_params.pop("test_fields")
         train_params.pop("test_root", None)
-        train_set = ClassificationWeedMapDataset(
+        # Sample stores are for the segmentation datasets, the test set here
+        train_params.pop("store", None)
+        train_params.pop("test_store", None)
+        train_params.pop("plant_buckets", None)
+        train_set = build_dataset(
+            ClassificationWeedMapDataset,
+            transforms,
+            dataloader_params,
             **train_params,
-            transform=transforms,
             target_transform=target_transforms,
         )
-        val_set = ClassificationWeedMapDataset(
+        val_set = build_dataset(
+            ClassificationWeedMapDataset,
+            transforms,
+            dataloader_params,
             **train_params,
-            transform=transforms,
             target_transform=target_transforms,
         )
         index = train_set.index
@@ -85,13 +124,13 @@ def get_classification_dataloaders(dataset_params, dataloader_params, seed=42):
             train_set,
             batch_size=dataloader_params["batch_size"],
             shuffle=True,
-            num_workers=dataloader_params["num_workers"],
+            **get_loader_kwargs(dataloader_params),
         )
         val_loader = torch.utils.data.DataLoader(
             val_set,
             batch_size=dataloader_params["batch_size"],
             shuffle=False,
-            num_workers=dataloader_params["num_workers"],
+            **get_loader_kwargs(dataloader_params),
         )
     else:
         train_loader = None
@@ -118,14 +157,21 @@ def get_dataloaders(dataset_params, dataloader_params, seed=42):
         train_params["fields"] = dataset_params["train_fields"]
         train_params.pop("train_fields")
         train_params.pop("test_fields")
+        train_params.pop("test_store", None)
+        # Plant buckets are only for the plants of the training set
+        plant_buckets = train_params.pop("plant_buckets", None)
+        # The plants are cut from the preprocessed images, so the transforms stay in the workers
         train_set = SelfSupervisedWeedMapDataset(
             **train_params,
+            plant_buckets=plant_buckets,
             transform=transforms,
             target_transform=target_transforms,
         )
-        val_set = WeedMapDataset(
+        val_set = build_dataset(
+            WeedMapDataset,
+            transforms,
+            dataloader_params,
             **train_params,
-            transform=transforms,
             target_transform=target_transforms,
         )
         index = train_set.index
@@ -140,14 +186,14 @@ def get_dataloaders(dataset_params, dataloader_params, seed=42):
             train_set,
             batch_size=dataloader_params["batch_size"],
             shuffle=True,
-            num_workers=dataloader_params["num_workers"],
+            **get_loader_kwargs(dataloader_params),
             collate_fn=train_set.collate_fn,
         )
         val_loader = torch.utils.data.DataLoader(
             val_set,
             batch_size=dataloader_params["batch_size"],
             shuffle=False,
-            num_workers=dataloader_params["num_workers"],
+            **get_loader_kwargs(dataloader_params),
         )
     else:
         train_loader = None
@@ -169,9 +215,16 @@ def get_testloader(dataset_params, dataloader_params, transforms, target_transfo
         test_params.pop("test_root")
     if "train_fields" in dataset_params:
         test_params.pop("train_fields")
-
-    test_set = WeedMapDataset(
-        transform=transforms,
+    # The test set has its own sample store, as it has other fields and labels
+    test_params.pop("store", None)
+    test_params.pop("plant_buckets", None)
+    if "test_store" in dataset_params:
+        test_params["store"] = test_params.pop("test_store")
+
+    test_set = build_dataset(
+        WeedMapDataset,
+        transforms,
+        dataloader_params,
         target_transform=target_transforms,
         **test_params,
     )
@@ -180,7 +233,7 @@ def get_testloader(dataset_params, dataloader_params, transforms, target_transfo
         test_set,
         batch_size=dataloader_params["batch_size"],
         shuffle=False,
-        num_workers=dataloader_params["num_workers"],
+        **get_loader_kwargs(dataloader_params),
     )
 
 
@@ -0,0 +1,342 @@
+import json
+import os
+import re
+import shutil
+import threading
+
+import cv2
+import numpy as np
+from tqdm import tqdm
+
+from selfweed.data.utils import to_records
+
+INDEX_FILE = "index.npy"
+META_FILE = "meta.json"
+SHARD_BYTES = 2**30
+# Share of the shard bytes taken by removed patches above which a store is compacted
+COMPACT_DEAD_SHARE = 0.5
+# Store written inside a store by compact_patch_store before it replaces the shards
+COMPACTED_DIR = "compacted"
+SHARD_PATTERN = re.compile(r"shard-(\d+)\.bin")
+INDEX_DTYPE = np.dtype(
+    [
+        ("field", "U16"),
+        ("source", "U64"),
+        ("patch", "i4"),
+        ("label", "i1"),
+        ("shard", "i4"),
+        ("offset", "i8"),
+        ("channels", "i2"),
+        ("height", "i4"),
+        ("width", "i4"),
+    ]
+)
+
+
+def shard_path(root, shard):
+    return os.path.join(root, f"shard-{shard:05d}.bin")
+
+
+def get_shards(root):
+    """
+    Sorted numbers of the shard files of a store.
+    """
+    matches = (SHARD_PATTERN.fullmatch(name) for name in os.listdir(root))
+    return sorted(int(match.group(1)) for match in matches if match)
+
+
+def write_patch_pngs(outdir, field, source, patch_index, label, patch, channels):
+    """
+    Write a patch in the directory layout: a PNG for each channel in outdir/field/channel
+    and an RGB composite of the first three channels in outdir/field/RGB.
+
+    Args:
+        outdir (str): The patches directory.
+        field (str): The field of the source image.
+        source (str): The file name of the source image.
+        patch_index (int): The index of the patch in the source image.
+        label (int): The class of the patch, 0 for crop, 1 for weed.
+        patch (numpy.ndarray): The (C, H, W) uint8 patch.
+        channels (list): Names of the channels of the patch.
+
+    Returns:
+        list: The paths of the written files.
+    """
+    filename = f"{os.path.splitext(source)[0]}_{patch_index}_{label}.png"
+    paths = [os.path.join(outdir, field, ch, filename) for ch in channels + ["RGB"]]
+    for ch in channels + ["RGB"]:
+        os.makedirs(os.path.join(outdir, field, ch), exist_ok=True)
+    for j, path in enumerate(paths[:-1]):
+        cv2.imwrite(path, patch[j])
+    cv2.imwrite(paths[-1], np.moveaxis(patch[:3], 0, 2))
+    return paths
+
+
+class PatchStoreWriter:
+    """
+    Append-only packed patch store. Patches are appended as raw uint8 (C, H, W) bytes
+    to shard files of at most shard_bytes, the index records field, source image,
+    patch index, label, shard, offset and shape of each patch.
+    Opening an existing store appends to it in new shards (mode "a") or replaces it
+    (mode "w"). Adding patches is thread safe, the index is written on flush and close.
+    """
+
+    def __init__(self, root, channels, shard_bytes=SHARD_BYTES, mode="a"):
+        self.root = root
+        self.channels = list(channels)
+        self.shard_bytes = shard_bytes
+        os.makedirs(root, exist_ok=True)
+        if mode == "w":
+            for name in os.listdir(root):
+                if name in (INDEX_FILE, META_FILE) or name.startswith("shard-"):
+                    os.remove(os.path.join(root, name))
+        elif mode != "a":
+            raise ValueError(f"Unknown mode {mode}")
+        meta_path = os.path.join(root, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                stored_channels = json.load(f)["channels"]
+            if stored_channels != self.channels:
+                raise ValueError(
+                    f"Store {root} has channels {stored_channels}, not {self.channels}"
+                )
+        else:
+            with open(meta_path, "w") as f:
+                json.dump({"channels": self.channels}, f)
+        index_path = os.path.join(root, INDEX_FILE)
+        self.records = (
+            np.load(index_path).tolist() if os.path.exists(index_path) else []
+        )
+        # After the last shard, compacted stores do not number their shards from 0
+        self.shard = max(get_shards(root), default=-1) + 1
+        self.file = None
+        self.offset = 0
+        self.lock = threading.Lock()
+
+    def add(self, field, source, patch_index, label, patch):
+        """
+        Append a (C, H, W) uint8 patch.
+        """
+        data = np.ascontiguousarray(patch, dtype=np.uint8)
+        with self.lock:
+            if self.file is not None and self.offset + data.nbytes > self.shard_bytes:
+                self.file.close()
+                self.file = None
+                self.shard += 1
+            if self.file is None:
+                self.file = open(shard_path(self.root, self.shard), "ab")
+                self.offset = 0
+            self.file.write(data.tobytes())
+            self.records.append(
+                (field, source, patch_index, label, self.shard, self.offset, *data.shape)
+            )
+            self.offset += data.nbytes
+
+    def remove(self, sources):
+        """
+        Drop the patches of some source images from the index, their bytes stay in the shards.
+
+        Args:
+            sources (set): (field, source) pairs.
+        """
+        with self.lock:
+            self.records = [
+                record for record in self.records if tuple(record[:2]) not in sources
+            ]
+
+    def add_store(self, root):
+        """
+        Move the shards of another store written with the same channels into this one
+        and append its records, then remove the other store.
+
+        Args:
+            root (str): The other store.
+        """
+        with open(os.path.join(root, META_FILE)) as f:
+            channels = json.load(f)["channels"]
+        if channels != self.channels:
+            raise ValueError(
+                f"Store {root} has channels {channels}, not {self.channels}"
+            )
+        index = np.load(os.path.join(root, INDEX_FILE))
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+                self.shard += 1
+            # Shards of compacted stores are not numbered from 0
+            shards = {}
+            for shard in get_shards(root):
+                os.replace(shard_path(root, shard), shard_path(self.root, self.shard))
+                shards[shard] = self.shard
+                self.shard += 1
+            for record in index.tolist():
+                self.records.append((*record[:4], shards[record[4]], *record[5:]))
+        os.remove(os.path.join(root, INDEX_FILE))
+        os.remove(os.path.join(root, META_FILE))
+        # Left by an interrupted compaction, its patches are still in the moved shards
+        shutil.rmtree(os.path.join(root, COMPACTED_DIR), ignore_errors=True)
+        os.rmdir(root)
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+            index_path = os.path.join(self.root, INDEX_FILE)
+            tmp_path = os.path.join(self.root, f"tmp-{INDEX_FILE}")
+            np.save(tmp_path, to_records(self.records, INDEX_DTYPE))
+            os.replace(tmp_path, index_path)
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PatchStore:
+    """
+    Reader of a packed patch store. Shards are memory mapped, each patch is a view
+    on its shard without copies nor decoding.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.index = np.load(os.path.join(root, INDEX_FILE))
+        with open(os.path.join(root, META_FILE)) as f:
+            self.channels = json.load(f)["channels"]
+        self.shards = {}
+
+    @staticmethod
+    def exists(root):
+        return os.path.exists(os.path.join(root, INDEX_FILE))
+
+    def get_shard(self, shard):
+        if shard not in self.shards:
+            # Copy on write, so that tensors can be built on the views without copies
+            self.shards[shard] = np.memmap(
+                shard_path(self.root, shard), dtype=np.uint8, mode="c"
+            )
+        return self.shards[shard]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        record = self.index[i]
+        shape = (record["channels"], record["height"], record["width"])
+        start = record["offset"]
+        return (
+            self.get_shard(int(record["shard"]))[start : start + np.prod(shape)]
+            .reshape(shape)
+        )
+
+    def __getstate__(self):
+        # Memory maps are opened again by each process
+        return {**self.__dict__, "shards": {}}
+
+
+def merge_patch_stores(root, parts, channels, sources=None, mode="a"):
+    """
+    Merge the stores written by the shards of a labelling run into the store at root.
+
+    Args:
+        root (str): The merged store.
+        parts (list): The stores of the shards, removed after the merge.
+        channels (list): Names of the channels of the patches.
+        sources (set): (field, source) pairs of the images labelled by the shards,
+            whose records in the store are replaced by the ones of the parts.
+            The sources of the records of the parts by default.
+        mode (str): "a" to add the parts to the store, "w" to replace it.
+    """
+    parts = [part for part in parts if PatchStore.exists(part)]
+    if sources is None:
+        sources = {
+            (str(record["field"]), str(record["source"]))
+            for part in parts
+            for record in np.load(os.path.join(part, INDEX_FILE))
+        }
+    with PatchStoreWriter(root, channels, mode=mode) as writer:
+        writer.remove(sources)
+        for part in parts:
+            writer.add_store(part)
+    compact_patch_store(root, COMPACT_DEAD_SHARE)
+
+
+def get_dead_share(root):
+    """
+    Share of the shard bytes of a store taken by patches removed from its index.
+    """
+    total = sum(os.path.getsize(shard_path(root, shard)) for shard in get_shards(root))
+    if total == 0:
+        return 0.0
+    index = np.load(os.path.join(root, INDEX_FILE))
+    live = (index["channels"].astype(np.int64) * index["height"] * index["width"]).sum()
+    return 1 - live / total
+
+
+def compact_patch_store(root, min_dead_share=0.0):
+    """
+    Rewrite the patches in the index of a store into new shards and remove the old
+    ones, reclaiming the bytes of the patches removed by PatchStoreWriter.remove.
+    The new index replaces the old one before the old shards are removed, so an
+    interrupted compaction leaves a valid store.
+
+    Args:
+        root (str): The packed patch store.
+        min_dead_share (float): Compact only if the removed patches take more than
+            this share of the shard bytes.
+
+    Returns:
+        bool: Whether the store was compacted.
+    """
+    if not PatchStore.exists(root) or get_dead_share(root) <= min_dead_share:
+        return False
+    store = PatchStore(root)
+    shards = get_shards(root)
+    compacted = os.path.join(root, COMPACTED_DIR)
+    with PatchStoreWriter(compacted, store.channels, mode="w") as writer:
+        for i, record in enumerate(store.index):
+            writer.add(
+                str(record["field"]),
+                str(record["source"]),
+                int(record["patch"]),
+                int(record["label"]),
+                store[i],
+            )
+    with PatchStoreWriter(root, store.channels) as writer:
+        # Every record is replaced by its compacted copy
+        writer.remove({tuple(record[:2]) for record in writer.records})
+        writer.add_store(compacted)
+    del store
+    for shard in shards:
+        os.remove(shard_path(root, shard))
+    return True
+
+
+def export_patches(root, outdir):
+    """
+    Export a packed patch store to the directory layout written by the PNG labeler.
+
+    Args:
+        root (str): The packed patch store.
+        outdir (str): The output patches directory.
+    """
+    store = PatchStore(root)
+    for i in tqdm(range(len(store))):
+        record = store.index[i]
+        write_patch_pngs(
+            outdir,
+            str(record["field"]),
+            str(record["source"]),
+            int(record["patch"]),
+            int(record["label"]),
+            store[i],
+            store.channels,
+        )
@@ -0,0 +1,175 @@
+import json
+import os
+
+import cv2
+import numpy as np
+import torch
+from scipy import ndimage
+from tqdm import tqdm
+
+from selfweed.data.utils import pad_patches, read_label_map, to_records
+
+INDEX_FILE = "index.npy"
+META_FILE = "meta.json"
+PLANT_DTYPE = np.dtype(
+    [
+        ("filename", "U64"),
+        ("plant", "i4"),
+        ("label", "i1"),
+        ("y0", "i4"),
+        ("x0", "i4"),
+        ("y1", "i4"),
+        ("x1", "i4"),
+        ("area", "i4"),
+    ]
+)
+
+
+def get_plant_index_dir(gt_folder):
+    """
+    The plant index of the label maps of a field, next to their folder.
+    """
+    return f"{os.path.normpath(gt_folder)}_plants"
+
+
+def get_plants(label_map):
+    """
+    Plants of a label map: the pixels of each class in each connected component of the
+    vegetation, as SelfSupervisedWeedMapDataset extracts them.
+
+    Args:
+        label_map (numpy.ndarray): The (H, W) class indices.
+
+    Returns:
+        tuple: (H, W) int32 plant map (0 for background, i for the i-th plant) and the
+            list of (plant, label, y0, x0, y1, x1, area) of each plant, sorted by label
+            and component, with exclusive bbox ends.
+    """
+    label_map = np.asarray(label_map, dtype=np.uint8)
+    components = cv2.connectedComponents(label_map)[1]
+    plant_map = np.zeros(label_map.shape, dtype=np.int32)
+    vegetation = components > 0
+    n_components = components.max() + 1
+    keys, inverse = np.unique(
+        label_map[vegetation].astype(np.int64) * n_components + components[vegetation],
+        return_inverse=True,
+    )
+    plant_map[vegetation] = inverse + 1
+    areas = np.bincount(inverse, minlength=len(keys))
+    plants = [
+        (
+            i + 1,
+            int(key // n_components),
+            box[0].start,
+            box[1].start,
+            box[0].stop,
+            box[1].stop,
+            int(area),
+        )
+        for i, (key, box, area) in enumerate(
+            zip(keys, ndimage.find_objects(plant_map), areas)
+        )
+    ]
+    return plant_map, plants
+
+
+def build_plant_index(gt_folder):
+    """
+    Write the plant index of the label maps of a field: the plants of every label map
+    and a plant map for each of them, as .npy files read through a memory map.
+    The modification time of each label map is recorded, a label map written again
+    must be indexed again.
+
+    Args:
+        gt_folder (str): The folder of the label maps.
+    """
+    outdir = get_plant_index_dir(gt_folder)
+    os.makedirs(outdir, exist_ok=True)
+    records, mtimes = [], {}
+    for filename in tqdm(sorted(os.listdir(gt_folder))):
+        path = os.path.join(gt_folder, filename)
+        mtimes[filename] = os.stat(path).st_mtime_ns
+        plant_map, plants = get_plants(read_label_map(path).numpy())
+        np.save(
+            os.path.join(outdir, f"{os.path.splitext(filename)[0]}.npy"), plant_map
+        )
+        records += [(filename, *plant) for plant in plants]
+    np.save(os.path.join(outdir, INDEX_FILE), to_records(records, PLANT_DTYPE))
+    # The meta file is written last, an index without it is incomplete
+    with open(os.path.join(outdir, META_FILE), "w") as f:
+        json.dump({"mtimes": mtimes}, f)
+
+
+class PlantIndex:
+    """
+    Reader of the plant index of a field written by build_plant_index.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, META_FILE)) as f:
+            self.mtimes = json.load(f)["mtimes"]
+        index = np.load(os.path.join(root, INDEX_FILE))
+        filenames, starts, counts = np.unique(
+            index["filename"], return_index=True, return_counts=True
+        )
+        self.plants = {
+            str(filename): index[start : start + count]
+            for filename, start, count in zip(filenames, starts, counts)
+        }
+        self.empty = index[:0]
+
+    @staticmethod
+    def load(gt_folder):
+        """
+        Plant index of the label maps in gt_folder, None if it was not built.
+        """
+        root = get_plant_index_dir(gt_folder)
+        if not os.path.exists(os.path.join(root, META_FILE)):
+            return None
+        return PlantIndex(root)
+
+    def is_current(self, filename, gt_path):
+        """
+        Whether the label map at gt_path was indexed after it was last written.
+        """
+        try:
+            return self.mtimes.get(filename) == os.stat(gt_path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+
+    def get_plants(self, filename, label=None):
+        """
+        Plant records of a label map, only the ones of class label if given.
+        """
+        plants = self.plants.get(filename, self.empty)
+        if label is not None:
+            plants = plants[plants["label"] == label]
+        return plants
+
+    def extract(self, image, filename, plants, pad=True):
+        """
+        Crops of some plants of a label map from its image, each one masked to the
+        pixels of the plant and padded to the largest one.
+
+        Args:
+            image (torch.Tensor): The (C, H, W) image.
+            filename (str): The file name of the label map.
+            plants (numpy.ndarray): Plant records of the label map.
+            pad (bool): Pad the crops to the largest one, else return the list of crops.
+
+        Returns:
+            torch.Tensor: The (P, C, h, w) plant crops, or the list of (C, h, w) crops.
+        """
+        if len(plants) == 0:
+            return torch.empty(0, 3, 0, 0) if pad else []
+        plant_map = np.load(
+            os.path.join(self.root, f"{os.path.splitext(filename)[0]}.npy"),
+            mmap_mode="r",
+        )
+        crops = []
+        for plant in plants:
+            y0, x0, y1, x1 = plant["y0"], plant["x0"], plant["y1"], plant["x1"]
+            mask = torch.from_numpy(plant_map[y0:y1, x0:x1] == plant["plant"])
+            crops.append(image[:, y0:y1, x0:x1] * mask)
+        return pad_patches(crops)[0] if pad else crops
@@ -0,0 +1,142 @@
+import json
+import os
+
+import numpy as np
+import torch
+import torchvision
+from tqdm import tqdm
+
+from selfweed.data.utils import read_label_map, to_records
+
+IMAGES_FILE = "images.npy"
+LABELS_FILE = "labels.npy"
+INDEX_FILE = "index.npy"
+META_FILE = "meta.json"
+INDEX_DTYPE = np.dtype([("field", "U16"), ("filename", "U64")])
+
+
+class SampleStore:
+    """
+    Reader of a packed sample store: the images of a WeedMap field tree as a single
+    uint8 (N, C, H, W) array and their label maps as a uint8 (N, H, W) array, both
+    memory mapped, so that each sample is a view without copies nor decoding.
+    The index records field and file name of each sample, the meta file the channels
+    and the ground truth folder of each field.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.index = np.load(os.path.join(root, INDEX_FILE))
+        with open(os.path.join(root, META_FILE)) as f:
+            meta = json.load(f)
+        self.channels = meta["channels"]
+        self.gt_folder = meta["gt_folder"]
+        self.gt_folders = meta["gt_folders"]
+        self.positions = {
+            (str(field), str(filename)): i
+            for i, (field, filename) in enumerate(self.index.tolist())
+        }
+        self.images = None
+        self.labels = None
+
+    @staticmethod
+    def exists(root):
+        return os.path.exists(os.path.join(root, META_FILE))
+
+    def open(self):
+        if self.images is None:
+            # Copy on write, so that tensors can be built on the views without copies
+            self.images = np.load(os.path.join(self.root, IMAGES_FILE), mmap_mode="c")
+            self.labels = np.load(os.path.join(self.root, LABELS_FILE), mmap_mode="c")
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_image(self, i):
+        """
+        (C, H, W) uint8 view of the image of sample i.
+        """
+        self.open()
+        return self.images[i]
+
+    def get_label(self, i):
+        """
+        (H, W) uint8 view of the label map of sample i.
+        """
+        self.open()
+        return self.labels[i]
+
+    def __getstate__(self):
+        # Memory maps are opened again by each process
+        return {**self.__dict__, "images": None, "labels": None}
+
+
+def pack_samples(root, outdir, fields, channels, gt_folder=None):
+    """
+    Pack the images and label maps of a WeedMap field tree into a sample store.
+    Samples are read one at a time and written in place in the memory mapped arrays,
+    all the images must have the same size.
+
+    Args:
+        root (str): The root of the dataset.
+        outdir (str): The sample store, replaced if it exists.
+        fields (list): The fields to pack.
+        channels (list): The channels to pack, in order.
+        gt_folder (str): The folder of the label maps (e.g. the pseudo GTs of a
+            labelling run), the groundtruth folder of each field if None.
+    """
+    # Imported here, the dataset module reads the stores
+    from selfweed.data.weedmap import WeedMapDataset
+
+    dataset = WeedMapDataset(root, channels, fields, gt_folder=gt_folder)
+    if len(dataset) == 0:
+        raise ValueError(f"No samples in {root} for fields {fields}")
+    os.makedirs(outdir, exist_ok=True)
+    meta_path = os.path.join(outdir, META_FILE)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    images, labels = None, None
+    for i, (field, filename) in enumerate(tqdm(dataset.index)):
+        image = torch.cat(
+            [
+                torchvision.io.read_image(path)
+                for path in dataset.get_image_paths(field, filename)
+            ]
+        )
+        label = read_label_map(os.path.join(dataset.gt_folders[field], filename))
+        if images is None:
+            images = np.lib.format.open_memmap(
+                os.path.join(outdir, IMAGES_FILE),
+                mode="w+",
+                dtype=np.uint8,
+                shape=(len(dataset), *image.shape),
+            )
+            labels = np.lib.format.open_memmap(
+                os.path.join(outdir, LABELS_FILE),
+                mode="w+",
+                dtype=np.uint8,
+                shape=(len(dataset), *label.shape),
+            )
+        if image.shape != images.shape[1:] or label.shape != labels.shape[1:]:
+            raise ValueError(
+                f"Sample {field}/{filename} has shape {tuple(image.shape)}, "
+                f"not {images.shape[1:]}"
+            )
+        images[i] = image.numpy()
+        labels[i] = label.numpy()
+    images.flush()
+    labels.flush()
+    del images, labels
+    np.save(
+        os.path.join(outdir, INDEX_FILE), to_records(dataset.index, INDEX_DTYPE)
+    )
+    # The meta file is written last, a store without it is incomplete
+    with open(meta_path, "w") as f:
+        json.dump(
+            {
+                "channels": list(channels),
+                "gt_folder": gt_folder,
+                "gt_folders": dataset.gt_folders,
+            },
+            f,
+        )
@@ -1,7 +1,10 @@
 from selfweed.utils.utils import EasyDict
 from enum import Enum, StrEnum
 
+import cv2
+import numpy as np
 import torch
+import torchvision
 
 
 class DataDict(EasyDict):
@@ -17,8 +20,92 @@ class LABELS(Enum):
     BACKGROUND: int = 0
     WEED: int = 1
     CROP: int = 2
+
+
+GT_FORMATS = ("index", "rgb")
+# BGR colors of the classes in RGB label maps: crop is green and weed is red
+GT_COLORS = {1: (0, 255, 0), 2: (0, 0, 255)}
+
+
+def write_label_map(path, label_map, gt_format="index"):
+    """
+    Write a (H, W) map of class indices as a PNG.
+
+    Args:
+        path (str): The output path.
+        label_map (torch.Tensor or numpy.ndarray): The (H, W) class indices.
+        gt_format (str): "index" writes the indices in a single uint8 channel,
+            "rgb" writes the colors of GT_COLORS (the WeedMap ground truth format).
+    """
+    if torch.is_tensor(label_map):
+        label_map = label_map.cpu().numpy()
+    label_map = label_map.astype(np.uint8)
+    if gt_format == "rgb":
+        lut = np.zeros((256, 3), dtype=np.uint8)
+        for value, color in GT_COLORS.items():
+            lut[value] = color
+        label_map = lut[label_map]
+    elif gt_format != "index":
+        raise ValueError(f"Unknown gt format {gt_format}")
+    cv2.imwrite(path, label_map)
+
+
+def to_records(records, dtype):
+    """
+    Structured array of records, with the string fields of dtype widened to their
+    longest value so that no field or file name is truncated.
+
+    Args:
+        records (list): Tuples with a value for each field of dtype.
+        dtype (numpy.dtype): The structured dtype, its string widths are minimums.
+
+    Returns:
+        numpy.ndarray: The (N,) structured array.
+    """
+    fields = []
+    for i, name in enumerate(dtype.names):
+        field = dtype.fields[name][0]
+        if field.kind == "U":
+            width = max([field.itemsize // 4] + [len(str(r[i])) for r in records])
+            field = np.dtype(f"U{width}")
+        fields.append((name, field))
+    return np.array(records, dtype=fields)
+
+
+def read_label_map(path):
+    """
+    Read a label map in any of GT_FORMATS, detected by its number of channels.
+
+    Args:
+        path (str): The path of the PNG.
+
+    Returns:
+        torch.Tensor: The (H, W) class indices.
+    """
+    gt = torchvision.io.read_image(path)
+    if gt.shape[0] == 1:
+        return gt[0].long()
+    # RGB: background, crop (green) and weed (red) in class order
+    return gt[[2, 1, 0]].argmax(dim=0)
     
     
+def get_ndvi(nir, red):
+    """
+    NDVI of the raw NIR and red channels, 0 where both are 0.
+
+    Args:
+        nir (torch.Tensor): The NIR channel.
+        red (torch.Tensor): The red channel.
+
+    Returns:
+        torch.Tensor: The float NDVI, with the shape of the channels.
+    """
+    nir, red = nir.float(), red.float()
+    total = nir + red
+    # Where the sum is 0 the difference is 0 too, so dividing by 1 gives 0 instead of NaN
+    return (nir - red) / torch.where(total == 0, torch.ones_like(total), total)
+
+
 def pad_patches(patches: list):
     """
     Pad a list of patches to the same size.
@@ -78,20 +165,63 @@ def crop_to_nonzero(tensor: torch.Tensor):
     raise ValueError("Only 2D or 3D tensors are supported.")
     
     
-def extract_plants(image: torch.Tensor, plant_mask: torch.Tensor):
+def extract_plants(image: torch.Tensor, plant_mask: torch.Tensor, pad=True):
     """
     Extract the individual plants from a patch.
 
     Args:
         patch (torch.Tensor): The patch to extract the plants from.
+        pad (bool): Pad the plants to the largest one, else return the list of plants.
     """
     plant_ids = torch.unique(plant_mask)
     plant_ids = plant_ids[plant_ids != 0]
     if plant_ids.numel() == 0:
-        return torch.empty(0, 3, 0, 0)
+        return torch.empty(0, 3, 0, 0) if pad else []
     plants = []
 
     for plant_id in plant_ids:
         plant = image * (plant_mask == plant_id)
         plants.append(crop_to_nonzero(plant))
-    return pad_patches(plants)[0]
\ No newline at end of file
+    return pad_patches(plants)[0] if pad else plants
+
+
+def bucket_patches(patches: list, bucket_sizes: list):
+    """
+    Group the plants of a batch in size buckets, padding each plant only to its bucket.
+    A plant goes to the smallest square bucket containing it, the plants larger than
+    the last bucket are padded to the largest of them.
+
+    Args:
+        patches (list): The list of (C, h, w) plants of each sample.
+        bucket_sizes (list): The increasing sides of the buckets.
+
+    Returns:
+        list: [plants, positions] for each non empty bucket, from the smallest, where
+            plants is the (N, C, H, W) tensor of the plants of the bucket and positions
+            the (N,) indices of its plants in the batch, counted sample by sample.
+    """
+    plants = [plant for sample in patches for plant in sample]
+    buckets = {}
+    for position, plant in enumerate(plants):
+        side = max(plant.shape[-2:])
+        size = next((size for size in bucket_sizes if side <= size), None)
+        buckets.setdefault(size, []).append(position)
+    sizes = sorted(buckets, key=lambda size: float("inf") if size is None else size)
+    result = []
+    for size in sizes:
+        positions = buckets[size]
+        height = size or max(plants[i].shape[-2] for i in positions)
+        width = size or max(plants[i].shape[-1] for i in positions)
+        padded = []
+        for i in positions:
+            pad_height = height - plants[i].shape[-2]
+            pad_width = width - plants[i].shape[-1]
+            top = pad_height // 2
+            left = pad_width // 2
+            padded.append(
+                torch.nn.functional.pad(
+                    plants[i], (left, pad_width - left, top, pad_height - top)
+                )
+            )
+        result.append([torch.stack(padded), torch.tensor(positions)])
+    return result
\ No newline at end of file
@@ -1,12 +1,16 @@
 import itertools
 import os
+import numpy as np
 import torch
 import torchvision
 import cv2
 
 from torch.utils.data import Dataset
 
-from selfweed.data.utils import DataDict, extract_plants, LABELS, pad_patches
+from selfweed.data.patch_store import PatchStore
+from selfweed.data.plant_index import PlantIndex
+from selfweed.data.sample_store import SampleStore
+from selfweed.data.utils import DataDict, bucket_patches, extract_plants, get_ndvi, LABELS, pad_patches, read_label_map
 
 
 class WeedMapDataset(Dataset):
@@ -25,6 +29,7 @@ class WeedMapDataset(Dataset):
         target_transform=None,
         return_path=False,
         return_ndvi=False, # Return NDVI as extra channel
+        store=None, # Packed sample store (see sample_store.pack_samples) read instead of the PNGs
     ):
         super().__init__()
         self.root = root
@@ -36,6 +41,10 @@ class WeedMapDataset(Dataset):
         self.return_ndvi = return_ndvi
 
         self.channels = channels
+        if store is not None:
+            self._init_store(store, gt_folder)
+            return
+        self.store = None
         if gt_folder is None:
             self.gt_folders = {
                 field: os.path.join(self.root, field, "groundtruth")
@@ -53,49 +62,97 @@ class WeedMapDataset(Dataset):
             (field, filename) for field in self.fields for filename in os.listdir(self.gt_folders[field])
         ]
 
+    def _init_store(self, store, gt_folder):
+        self.store = SampleStore(store)
+        if gt_folder != self.store.gt_folder:
+            raise ValueError(
+                f"Store {store} has the labels of {self.store.gt_folder}, not {gt_folder}"
+            )
+        missing = set(self.channels + ["NIR", "R"] * self.return_ndvi) - set(self.store.channels)
+        if missing:
+            raise ValueError(f"Store {store} has no channels {sorted(missing)}")
+        self.channel_index = torch.tensor(
+            [self.store.channels.index(ch) for ch in self.channels]
+        )
+        missing = set(self.fields) - set(self.store.gt_folders)
+        if missing:
+            raise ValueError(f"Store {store} has no fields {sorted(missing)}")
+        self.gt_folders = {field: self.store.gt_folders[field] for field in self.fields}
+        samples = self.store.index.tolist()
+        self.index = [
+            (field, filename)
+            for field in self.fields
+            for store_field, filename in samples
+            if store_field == field
+        ]
+
     def __len__(self):
         return len(self.index)
     
     def _get_gt(self, gt_path):
-        gt = torchvision.io.read_image(gt_path)
-        gt = gt[[2, 1, 0], ::]
-        gt = gt.argmax(dim=0)
+        gt = read_label_map(gt_path)
         gt = self.target_transform(gt)
         return gt
+
+    def _get_stored_item(self, field, filename):
+        """
+        Raw (C, H, W) uint8 image with all the channels of the store and target of a sample.
+        """
+        i = self.store.positions[(field, filename)]
+        image = torch.from_numpy(self.store.get_image(i))
+        gt = torch.from_numpy(self.store.get_label(i)).long()
+        return image, self.target_transform(gt)
     
-    def _get_image(self, field, filename):
+    def get_image_paths(self, field, filename):
+        return [
+            os.path.join(self.root, field, channel_folder, filename)
+            for channel_folder in self.channels
+        ]
+
+    def _read_image(self, field, filename):
         channels = []
-        for channel_folder in self.channels:
-            channel_path = os.path.join(
-                self.root,
-                field,
-                channel_folder,
-                filename
-            )
+        for channel_path in self.get_image_paths(field, filename):
             channel = torchvision.io.read_image(channel_path)
             channels.append(channel)
-        channels = torch.cat(channels).float()
-        return self.transform(channels)
+        return torch.cat(channels)
 
-    def _get_ndvi(self, field, filename):
-        nir_red_path = [
-            os.path.join(
-                self.root,
-                field,
-                ch,
-                filename
-            ) for ch in ["NIR", "R"]
+    def _transform(self, image):
+        # Without transform the uint8 image is returned, to be preprocessed on the device
+        if self.transform is None:
+            return image
+        return self.transform(image.float())
+
+    def _get_image(self, field, filename):
+        return self._transform(self._read_image(field, filename))
+
+    def _get_ndvi(self, field, filename, image=None, image_channels=None):
+        """
+        NDVI of a sample, from the NIR and R channels of its raw image when given
+        and it has them, decoding the missing ones.
+        """
+        image_channels = image_channels or []
+        nir_red = [
+            image[image_channels.index(ch)].unsqueeze(0)
+            if image is not None and ch in image_channels
+            else torchvision.io.read_image(os.path.join(self.root, field, ch, filename))
+            for ch in ["NIR", "R"]
         ]
-        nir_red = [torchvision.io.read_image(channel_path).float() for channel_path in nir_red_path]
-        return (nir_red[0] - nir_red[1]) / (nir_red[0] + nir_red[1])        
+        return get_ndvi(*nir_red)
 
     def __getitem__(self, i):
         field, filename = self.index[i]
         gt_path = os.path.join(
             self.gt_folders[field], filename
         )
-        gt = self._get_gt(gt_path)
-        channels = self._get_image(field, filename)
+        if self.store is not None:
+            image, gt = self._get_stored_item(field, filename)
+            image_channels = self.store.channels
+            channels = self._transform(image.index_select(0, self.channel_index))
+        else:
+            gt = self._get_gt(gt_path)
+            image = self._read_image(field, filename)
+            image_channels = self.channels
+            channels = self._transform(image)
 
         data_dict = DataDict(
             image = channels,
@@ -105,8 +162,7 @@ class WeedMapDataset(Dataset):
             data_dict.name = gt_path
         
         if self.return_ndvi:
-            ndvi = self._get_ndvi(field, filename)
-            data_dict.ndvi = ndvi
+            data_dict.ndvi = self._get_ndvi(field, filename, image, image_channels)
         return data_dict
     
     
@@ -133,10 +189,35 @@ class ClassificationWeedMapDataset(Dataset):
         self.fields = fields
 
         self.channels = channels
-            
-        self.index = [
-            (field, filename) for field in self.fields for filename in os.listdir(os.path.join(self.root, field, channels[0]))
-        ]
+
+        if PatchStore.exists(self.root):
+            # Packed patches, the index holds the records of the selected fields
+            self.store = PatchStore(self.root)
+            self.channel_index = torch.tensor(
+                [self.store.channels.index(ch) for ch in self.channels]
+            )
+            self.index = np.flatnonzero(
+                np.isin(self.store.index["field"], self.fields)
+            ).tolist()
+        else:
+            self.store = None
+            self.index = [
+                (field, filename) for field in self.fields for filename in os.listdir(os.path.join(self.root, field, channels[0]))
+            ]
+
+    def _get_stored_item(self, i):
+        record = self.store.index[i]
+        patch = torch.from_numpy(self.store[i])
+        channels = patch.index_select(0, self.channel_index)
+        field, source = str(record["field"]), str(record["source"])
+        filename = f"{os.path.splitext(source)[0]}_{record['patch']}_{record['label']}.png"
+        return self._transform(channels), int(record["label"]), os.path.join(self.root, field, filename)
+
+    def _transform(self, image):
+        # Without transform the uint8 image is returned, to be preprocessed on the device
+        if self.transform is None:
+            return image
+        return self.transform(image.float())
         
     def _get_image(self, field, filename):
         channels = []
@@ -149,49 +230,76 @@ class ClassificationWeedMapDataset(Dataset):
             )
             channel = torchvision.io.read_image(channel_path)
             channels.append(channel)
-        channels = torch.cat(channels).float()
-        return self.transform(channels)
+        return self._transform(torch.cat(channels))
     
     def __len__(self):
         return len(self.index)
     
     def __getitem__(self, i):
-        field, filename = self.index[i]
-        channels = self._get_image(field, filename)
-        fname = os.path.splitext(filename)[0]
-        label = int(fname.split("_")[-1])
+        if self.store is not None:
+            channels, label, name = self._get_stored_item(self.index[i])
+        else:
+            field, filename = self.index[i]
+            channels = self._get_image(field, filename)
+            fname = os.path.splitext(filename)[0]
+            label = int(fname.split("_")[-1])
+            name = os.path.join(self.root, field, filename)
         data_dict = DataDict(
             image = channels,
             target = self.target_transform(torch.tensor(label))
         )
         if self.return_path:
-            data_dict.name = os.path.join(self.root, field, filename)
+            data_dict.name = name
         return data_dict
 
 
 class SelfSupervisedWeedMapDataset(WeedMapDataset):
-    def __init__(self, root, channels, fields, gt_folder=None, transform=None, target_transform=None, return_path=False, max_plants=10):
-        super().__init__(root, channels, fields, gt_folder, transform, target_transform, return_path)
+    def __init__(self, root, channels, fields, gt_folder=None, transform=None, target_transform=None, return_path=False, max_plants=10, store=None, plant_buckets=None):
+        super().__init__(root, channels, fields, gt_folder, transform, target_transform, return_path, store=store)
         self.max_plants = max_plants
+        # Sides of the size buckets of the plants in collate_fn (see bucket_patches), None pads all the plants of a batch together
+        self.plant_buckets = plant_buckets
+        # Plants of the label maps indexed with build_plant_index, None for the fields without index
+        self.plant_indices = {
+            field: PlantIndex.load(folder) for field, folder in self.gt_folders.items()
+        }
+
+    def _sample_plants(self, image, plant_index, filename, label):
+        # Only the sampled plants are cropped, so the cost does not grow with the plants of the image
+        plants = plant_index.get_plants(filename, label)
+        if len(plants) > self.max_plants:
+            indices = torch.randperm(len(plants))[:self.max_plants]
+            plants = plants[indices.numpy()]
+        return plant_index.extract(image, filename, plants, pad=self.plant_buckets is None)
+
     def __getitem__(self, i):
         data_dict = super().__getitem__(i)
-        
+        field, filename = self.index[i]
+        plant_index = self.plant_indices[field]
+        if plant_index is not None and plant_index.is_current(
+            filename, os.path.join(self.gt_folders[field], filename)
+        ):
+            data_dict.crops = self._sample_plants(data_dict.image, plant_index, filename, LABELS.CROP.value)
+            data_dict.weeds = self._sample_plants(data_dict.image, plant_index, filename, LABELS.WEED.value)
+            return data_dict
+
         connected_components = torch.tensor(cv2.connectedComponents(data_dict.target.numpy().astype('uint8'))[1])
         crops_mask = data_dict.target == LABELS.CROP.value
         crops_mask = connected_components * crops_mask
-        crops_mask = extract_plants(data_dict.image, crops_mask)
-        if crops_mask.shape[0] > self.max_plants:
+        pad = self.plant_buckets is None
+        crops_mask = extract_plants(data_dict.image, crops_mask, pad=pad)
+        if len(crops_mask) > self.max_plants:
             # Get self.max_plants random crops
-            indices = torch.randperm(crops_mask.shape[0])[:self.max_plants]
-            crops_mask = crops_mask[indices]
+            indices = torch.randperm(len(crops_mask))[:self.max_plants]
+            crops_mask = crops_mask[indices] if pad else [crops_mask[j] for j in indices]
         
         weeds_mask = data_dict.target == LABELS.WEED.value
         weeds_mask = connected_components * weeds_mask
-        weeds_mask = extract_plants(data_dict.image, weeds_mask)
-        if weeds_mask.shape[0] > self.max_plants:
+        weeds_mask = extract_plants(data_dict.image, weeds_mask, pad=pad)
+        if len(weeds_mask) > self.max_plants:
             # Get self.max_plants random weeds
-            indices = torch.randperm(weeds_mask.shape[0])[:self.max_plants]
-            weeds_mask = weeds_mask[indices]
+            indices = torch.randperm(len(weeds_mask))[:self.max_plants]
+            weeds_mask = weeds_mask[indices] if pad else [weeds_mask[j] for j in indices]
         data_dict.crops = crops_mask
         data_dict.weeds = weeds_mask
         return data_dict
@@ -199,8 +307,12 @@ class SelfSupervisedWeedMapDataset(WeedMapDataset):
     def collate_fn(self, batch):
         crops = [item.crops for item in batch]
         weeds = [item.weeds for item in batch]
-        crops = pad_patches(crops)
-        weeds = pad_patches(weeds)
+        if self.plant_buckets is not None:
+            crops = bucket_patches(crops, self.plant_buckets)
+            weeds = bucket_patches(weeds, self.plant_buckets)
+        else:
+            crops = pad_patches(crops)
+            weeds = pad_patches(weeds)
         return DataDict(
             image=torch.stack([item.image for item in batch]),
             target=torch.stack([item.target for item in batch]),
@@ -1,4 +1,8 @@
+import os
+from collections import defaultdict
 from enum import Enum
+from functools import lru_cache
+from itertools import product
 from typing import Any
 import cv2
 import numpy as np
@@ -9,11 +13,18 @@ import torch
 from torchvision.transforms import Normalize, ToTensor, Compose
 from torch.nn import functional as F
 from selfweed.histogramdd import histogramdd
+from selfweed.preprocess import get_patch_origin
+from selfweed.profiling import PROFILER
 from selfweed.utils.utils import (
+    EasyDict,
     get_circular_interval,
+    get_cluster_index,
+    get_device,
     get_medians,
+    get_regions_from_stats,
     max_displacement,
     merge_bboxes,
+    paint_boxes,
 )
 from scipy.stats import kstest
 
@@ -25,7 +36,9 @@ LAWIN_CHANNELS = ["R", "G", "B", "NIR", "RE"]
 SUBSET = "rededge"
 
 
-def get_vegetation_detector(detector_name, detector_params):
+def get_vegetation_detector(detector_name, detector_params, device=None):
+    if device is not None:
+        detector_params = {**detector_params, "device": device}
     if detector_name == "NDVIDetector":
         return NDVIVegetationDetector(**detector_params)
 
@@ -39,6 +52,7 @@ class HoughDetectorDict(Enum):
     REDUCED_THRESHOLD = "reduced_threshold"
     ZERO_REASON = "zero_reason"
     UNIFORM_SIGNIFICANCE = "uniform_significance"
+    COARSE_THETA = "coarse_theta"
 
 
 # class LaweedVegetationDetector:
@@ -72,20 +86,65 @@ class HoughDetectorDict(Enum):
         return seg_class
 
 
+class VegetationSegmentation(EasyDict):
+    mask: torch.Tensor
+    components: torch.Tensor
+    stats: torch.Tensor
+
+
+def segment_vegetation(mask):
+    """
+    Connected components of a vegetation mask and their stats, in a single
+    cv2.connectedComponentsWithStats pass, to be reused by the consumers of the mask
+    :param mask: (1, H, W) vegetation mask, nonzero for vegetation
+    :return: VegetationSegmentation with the mask, the (H, W) int32 component labels
+        (0 for background) on the device of the mask and the (N, 5) cv2 stats of the
+        N components, background excluded
+    """
+    num_labels, components, stats, _ = cv2.connectedComponentsWithStats(
+        mask.reshape(mask.shape[-2:]).type(torch.uint8).cpu().numpy(),
+        connectivity=8,
+        ltype=cv2.CV_32S,
+    )
+    return VegetationSegmentation(
+        mask=mask,
+        components=torch.from_numpy(components).to(mask.device),
+        stats=torch.from_numpy(stats[1:]),
+    )
+
+
 class NDVIVegetationDetector:
-    def __init__(self, threshold=0.6, red_idx=0, nir_idx=3) -> None:
+    def __init__(self, threshold=0.6, red_idx=0, nir_idx=3, device=None) -> None:
         self.threshold = threshold
         self.nir_idx = nir_idx
         self.red_idx = red_idx
+        self.device = get_device(device)
+
+    def get_ndvi(self, image):
+        """
+        NDVI of an image, only the NIR and red channels are read and moved to the device
+        :param image: (C, H, W) tensor, uint8 channels are converted to float on the device
+        """
+        nir = image[self.nir_idx].to(self.device)
+        red = image[self.red_idx].to(self.device)
+        if not nir.is_floating_point():
+            nir, red = nir.float(), red.float()
+        return (nir - red) / (nir + red)
 
     def __call__(self, image=None, ndvi=None) -> Any:
         if ndvi is not None:
-            ndvi = ndvi.cuda()
+            ndvi = ndvi.to(self.device)
         else:
-            image = image.cuda()
-            ndvi = (image[self.nir_idx] - image[self.red_idx]) / (image[self.nir_idx] + image[self.red_idx])
+            ndvi = self.get_ndvi(image)
         return ((ndvi > self.threshold).type(torch.uint8) * 255).unsqueeze(0)
 
+    def segment(self, image=None, ndvi=None):
+        """
+        Vegetation mask of an image and its connected components, computed together
+        :return: VegetationSegmentation, see segment_vegetation
+        """
+        return segment_vegetation(self(image=image, ndvi=ndvi))
+
     def __repr__(self) -> str:
         return f"NDVI Vegetation Detector with threshold {self.threshold}"
 
@@ -142,9 +201,53 @@ class CropRowDetector:
     def predict_from_mask(self, mask):
         raise NotImplementedError
 
+    def predict_batch(self, masks):
+        raise NotImplementedError
+
+
+@lru_cache(maxsize=32)
+def get_hough_tables(width, height, step_theta, step_rho):
+    """
+    Theta, rho and trigonometric tables of the modified hough, cached per (shape, step).
+    The returned tensors are shared and must not be modified in place.
+    :return: diagonal length, thetas, rhos, cos_thetas, sin_thetas
+    """
+    d = np.sqrt(np.square(height) + np.square(width))
+    thetas = torch.arange(0, 180, step=step_theta)
+    rhos = torch.arange(-d, d + 1, step=step_rho)
+    cos_thetas = torch.cos(torch.deg2rad(thetas))
+    sin_thetas = torch.sin(torch.deg2rad(thetas))
+    return d, thetas, rhos, cos_thetas, sin_thetas
+
+
+@lru_cache(maxsize=32)
+def get_hough_lines_tables(height, width, step_theta, step_rho):
+    """
+    Accumulator size and trigonometric tables of cv2.HoughLines, cached per (shape, step).
+    The returned tensors are shared and must not be modified in place.
+    :return: n_thetas, n_rhos, cos_thetas / step_rho, sin_thetas / step_rho (float32)
+    """
+    step_theta = step_theta * np.pi / 180
+    n_thetas = int(np.floor(np.pi / step_theta)) + 1
+    if n_thetas > 1 and abs(np.pi - (n_thetas - 1) * step_theta) < step_theta / 2:
+        n_thetas -= 1
+    n_rhos = int(round(((width + height) * 2 + 1) / step_rho))
+    angles = torch.arange(n_thetas, dtype=torch.float64) * step_theta
+    cos_thetas = (torch.cos(angles) / step_rho).float()
+    sin_thetas = (torch.sin(angles) / step_rho).float()
+    return n_thetas, n_rhos, cos_thetas, sin_thetas
+
 
 class AbstractHoughCropRowDetector(CropRowDetector):
     CROP_AS_TOL = "crop_as_tol"
+    IDX_CX = 0
+    IDX_CY = 1
+    IDX_X0 = 2
+    IDX_Y0 = 3
+    IDX_X1 = 4
+    IDX_Y1 = 5
+    IDX_WIDTH = 6
+    IDX_HEIGHT = 7
 
     def __init__(
         self,
@@ -157,6 +260,7 @@ class AbstractHoughCropRowDetector(CropRowDetector):
         crop_detector=None,
         theta_reduction_threshold=1.0,
         theta_value=None,
+        device=None,
     ):
         super().__init__(crop_detector)
         self.step_theta = step_theta
@@ -169,42 +273,80 @@ class AbstractHoughCropRowDetector(CropRowDetector):
         self.uniform_significance = uniform_significance
         self.theta_reduction_threshold = theta_reduction_threshold
         self.theta_value = theta_value
+        self.device = get_device(device)
 
-    def calculate_connectivity(self, input_img):
+    def calculate_connectivity(self, input_img, segmentation=None):
         """
-        Regions extracted with PyTorch with GPU
-        :param input_img: Binary Tensor located on GPU
-        :return: connectivity tensor (N, 6) where each row is (centroid x, centroid y, x0, y0, x1, y1)
+        Regions extracted in a single pass with cv2.connectedComponentsWithStats
+        :param input_img: Binary Tensor (CPU or GPU)
+        :param segmentation: VegetationSegmentation of input_img, its components are
+            reused instead of being computed again
+        :return: components tensor (1, H, W) and connectivity tensor (N, 8) where each row is
+            (centroid x, centroid y, x0, y0, x1, y1, width, height), both on the device of input_img
         """
-        input_img = input_img.type(torch.uint8)
-        if len(input_img.shape) == 3:
-            if input_img.shape[0] == 1:
-                input_img = input_img.squeeze(0)
-            else:
-                raise ValueError("Must be 2D tensor")
-        components = cv2.connectedComponents(input_img.cpu().numpy())[1:]
-        components = torch.tensor(np.array(components)).cuda()
-
-        def get_region(label):
-            where_t = torch.where(label == components)
-            y0 = where_t[0][0]  # First dimension is sorted
-            y1 = where_t[0][-1]
-            x0 = where_t[-1].min()
-            x1 = where_t[-1].max()
-            cx = (torch.round((x1 + x0) / 2)).int()
-            cy = (torch.round((y1 + y0) / 2)).int()
-            return torch.tensor([cx, cy, x0, y0, x1, y1, x1 - x0 + 1, y1 - y0 + 1])
-
-        labels = components.unique()[1:]  # First one is background
-        if len(labels) == 0:
+        if len(input_img.shape) == 3 and input_img.shape[0] != 1:
+            raise ValueError("Must be 2D tensor")
+        if segmentation is None:
+            segmentation = segment_vegetation(input_img)
+        if len(segmentation.stats) == 0:  # Only background
             return torch.tensor([]), torch.tensor([])
-        regions = torch.stack(tuple(map(get_region, labels)))
+        components = segmentation.components.unsqueeze(0).to(input_img.device)
+        regions = get_regions_from_stats(segmentation.stats).to(input_img.device)
         self.mean_crop_size = (
             (regions[:, 4] - regions[:, 2]).float().mean()
             + (regions[:, 5] - regions[:, 3]).float().mean()
         ) / 2
         return components, regions
 
+    def calculate_connectivity_batch(self, masks):
+        """
+        Regions of a batch of masks extracted with a single connected components pass
+        over the masks tiled side by side
+        :param masks: (B, H, W) binary tensor
+        :return: components (B, H, W) labelled image by image,
+            regions (N, 8) sorted by image,
+            region image index (N,),
+            mean crop size of each image (B,)
+        """
+        masks = masks.type(torch.uint8)
+        B, H, W = masks.shape
+        device = masks.device
+        # A zero column after each mask keeps components of different images apart
+        tiled = F.pad(masks, (0, 1)).permute(1, 0, 2).reshape(H, B * (W + 1))
+        num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(
+            tiled.cpu().numpy(), connectivity=8, ltype=cv2.CV_32S
+        )
+        stats = torch.from_numpy(stats[1:]).long()  # First one is background
+        region_index = stats[:, cv2.CC_STAT_LEFT] // (W + 1)
+        stats[:, cv2.CC_STAT_LEFT] -= region_index * (W + 1)
+
+        # Relabel each image from 1 keeping the scan order of the labels
+        order = torch.sort(region_index, stable=True).indices
+        region_index = region_index[order]
+        counts = torch.bincount(region_index, minlength=B)
+        first = counts.cumsum(0) - counts
+        lookup = torch.zeros(num_labels, dtype=torch.int32)
+        lookup[order + 1] = (
+            torch.arange(len(order)) - first[region_index] + 1
+        ).int()
+        components = lookup[torch.from_numpy(labels).long()]
+        components = components.reshape(H, B, W + 1).permute(1, 0, 2)[:, :, :W]
+
+        regions = get_regions_from_stats(stats[order])
+        crop_sizes = (
+            (regions[:, self.IDX_X1] - regions[:, self.IDX_X0]).float()
+            + (regions[:, self.IDX_Y1] - regions[:, self.IDX_Y0]).float()
+        ) / 2
+        mean_crop_sizes = torch.zeros(B).index_add_(
+            0, region_index, crop_sizes
+        ) / counts
+        return (
+            components.contiguous().to(device),
+            regions.to(device),
+            region_index.to(device),
+            mean_crop_sizes.to(device),
+        )
+
     def revive_border_lines(
         self, mask, lines, filtered_lines, return_reduced_threshold=False
     ):
@@ -275,15 +417,6 @@ class AbstractHoughCropRowDetector(CropRowDetector):
 
 
 class ModifiedHoughCropRowDetector(AbstractHoughCropRowDetector):
-    IDX_CX = 0
-    IDX_CY = 1
-    IDX_X0 = 2
-    IDX_Y0 = 3
-    IDX_X1 = 4
-    IDX_Y1 = 5
-    IDX_WIDTH = 6
-    IDX_HEIGHT = 7
-
     def __init__(
         self,
         step_theta=1,
@@ -295,6 +428,7 @@ class ModifiedHoughCropRowDetector(AbstractHoughCropRowDetector):
         crop_detector=None,
         crop_merge_multiplier=1,
         uniform_significance=0.1,
+        device=None,
     ):
         """
 
@@ -315,6 +449,7 @@ class ModifiedHoughCropRowDetector(AbstractHoughCropRowDetector):
             angle_error=angle_error,
             clustering_tol=clustering_tol,
             uniform_significance=uniform_significance,
+            device=device,
         )
         self.displacement = displacement_function
         self.angle_error = angle_error
@@ -372,14 +507,12 @@ class ModifiedHoughCropRowDetector(AbstractHoughCropRowDetector):
 
         width, height = shape
 
-        d = np.sqrt(np.square(height) + np.square(width))
+        d, thetas, rhos, cos_thetas, sin_thetas = (
+            table.to(connectivity_tensor.device) if torch.is_tensor(table) else table
+            for table in get_hough_tables(width, height, self.step_theta, self.step_rho)
+        )
         self.diag_len = d + 1
 
-        thetas = torch.arange(0, 180, step=self.step_theta)
-        rhos = torch.arange(-d, d + 1, step=self.step_rho)
-        cos_thetas = torch.cos(torch.deg2rad(thetas))
-        sin_thetas = torch.sin(torch.deg2rad(thetas))
-
         # Retrieve all the points from dataframe
         points = torch.stack(
             [
@@ -445,42 +578,84 @@ class ModifiedHoughCropRowDetector(AbstractHoughCropRowDetector):
         :param regions: region tensor (N, 8)
         :return: Drew mask
         """
-        displ_mask = torch.zeros(shape, dtype=torch.uint8)
-        for cx, cy, x0, y0, x1, y1, width, height in regions:
-            displacement = self.displacement(width, height)
-            displ_mask[
-                max(int(cy - displacement), 0) : min(int(cy + displacement), shape[0]),
-                max(int(cx - displacement), 0) : min(int(cx + displacement), shape[1]),
-            ] = 255
-        return displ_mask
+        if len(regions) == 0:
+            return torch.zeros(shape, dtype=torch.uint8)
+        displacement = self.displacement(
+            regions[:, self.IDX_WIDTH], regions[:, self.IDX_HEIGHT]
+        )
+        cx, cy = regions[:, self.IDX_CX], regions[:, self.IDX_CY]
+        painted = paint_boxes(
+            shape,
+            (cy - displacement).clamp(0, shape[0]),
+            (cy + displacement).clamp(0, shape[0]),
+            (cx - displacement).clamp(0, shape[1]),
+            (cx + displacement).clamp(0, shape[1]),
+        )
+        return painted.type(torch.uint8) * 255
 
     def increase_recall(self, regions):
         """
-        Temporary Failed
+        Merge each region with the ones whose centroid is closer than its
+        displacement times crop_merge_multiplier, in region order.
+        Centroids are bucketed in a uniform grid, so each region is only
+        compared with the ones in the neighbouring cells.
         """
+        if len(regions) == 0:
+            return regions
+        rows = regions.tolist()
+        cell = max(
+            int(
+                self.displacement(
+                    regions[:, self.IDX_WIDTH], regions[:, self.IDX_HEIGHT]
+                ).max()
+                * self.crop_merge_multiplier
+            ),
+            1,
+        )
 
-        def get_neighbours(cx, cy, regions, threshold):
-            return ((regions[:, self.IDX_CX] - cx).abs() < threshold) & (
-                (regions[:, self.IDX_CY] - cy).abs() < threshold
+        def get_cell(row):
+            return row[self.IDX_CX] // cell, row[self.IDX_CY] // cell
+
+        grid = defaultdict(set)
+        for i, row in enumerate(rows):
+            grid[get_cell(row)].add(i)
+
+        def get_neighbours(cx, cy, threshold):
+            reach = int(threshold // cell) + 1
+            gx, gy = cx // cell, cy // cell
+            if (2 * reach + 1) ** 2 < len(grid):
+                candidates = (
+                    grid.get((gx + dx, gy + dy), ())
+                    for dx in range(-reach, reach + 1)
+                    for dy in range(-reach, reach + 1)
+                )
+            else:
+                candidates = grid.values()
+            return sorted(
+                j
+                for bucket in candidates
+                for j in bucket
+                if abs(rows[j][self.IDX_CX] - cx) < threshold
+                and abs(rows[j][self.IDX_CY] - cy) < threshold
             )
 
-        presence = torch.ones(regions.shape[0], dtype=torch.bool)
-        for i in range(regions.shape[0]):
-            cx, cy, x0, y0, x1, y1, width, height = regions[i]
+        presence = torch.ones(len(rows), dtype=torch.bool)
+        for i in range(len(rows)):
+            cx, cy, x0, y0, x1, y1, width, height = rows[i]
             neighbours = get_neighbours(
-                cx,
-                cy,
-                regions[presence],
-                self.displacement(width, height) * self.crop_merge_multiplier,
+                cx, cy, self.displacement(width, height) * self.crop_merge_multiplier
             )
-            if neighbours.sum() > 1:  # Itself
-                neighbours = presence.argwhere().squeeze(1)[
-                    neighbours
-                ]  # Get back indices to original tensor
-                new_bbox = merge_bboxes(regions[neighbours])
-                regions[neighbours[-1]] = new_bbox
+            if len(neighbours) > 1:  # Itself
+                for j in neighbours:
+                    grid[get_cell(rows[j])].discard(j)
+                rows[neighbours[-1]] = (
+                    merge_bboxes(regions.new_tensor([rows[j] for j in neighbours]))
+                    .type(regions.dtype)
+                    .tolist()
+                )
+                grid[get_cell(rows[neighbours[-1]])].add(neighbours[-1])
                 presence[neighbours[:-1]] = False
-        return regions[presence].contiguous()
+        return regions.new_tensor(rows)[presence.to(regions.device)].contiguous()
 
     def filter_lines(self, accumulator):
         """
@@ -517,7 +692,7 @@ class ModifiedHoughCropRowDetector(AbstractHoughCropRowDetector):
         Cluster lines basing on rhos
         :param acc: frequency accumulator
         :param thetas_idcs: parallel theta tensor
-        :return: cluster list indices: index where each cluster starts
+        :return: sorted lines, cluster indices: index where each cluster starts and the end index
         """
         clustering_tol = (
             self.mean_crop_size
@@ -528,14 +703,7 @@ class ModifiedHoughCropRowDetector(AbstractHoughCropRowDetector):
         rhos_thetas = torch.stack(torch.where(acc.T > 0), dim=1)
         thetas_rhos = torch.index_select(rhos_thetas, 1, torch.LongTensor([1, 0]))
         thetas_rhos[:, 0] = thetas_idcs[thetas_rhos[:, 0]]
-        cluster_indices = [0]
-        if thetas_rhos.shape[0] > 1:
-            for i in range(1, thetas_rhos.shape[0]):
-                if abs(thetas_rhos[i][1] - thetas_rhos[i - 1][1]) > clustering_tol:
-                    cluster_indices.append(i)
-        else:
-            i = 0
-        cluster_indices.append(i + 1)
+        cluster_indices = get_cluster_index(thetas_rhos[:, 1], clustering_tol)
         return thetas_rhos, cluster_indices
 
     def predict_from_mask(
@@ -560,7 +728,7 @@ class ModifiedHoughCropRowDetector(AbstractHoughCropRowDetector):
             else:
                 raise ValueError("Must be 2D tensor")
         width, height = mask.shape
-        crop_mask = mask.cuda()
+        crop_mask = mask.to(self.device)
         components, connectivity_df = self.calculate_connectivity(crop_mask)
         enhanced_mask = self.calculate_mask((width, height), connectivity_df)
         accumulator = self.hough(enhanced_mask.shape, connectivity_df)
@@ -577,19 +745,663 @@ class ModifiedHoughCropRowDetector(AbstractHoughCropRowDetector):
             res += (components,)
         return res[0] if len(res) == 1 else res
 
+    def hough_batch(self, shape, regions, region_index, batch_size):
+        """
+        Modified hough implementation based on the regions of a batch of images
+        :param shape: image shape
+        :param regions: (N, 8) region tensor of the whole batch
+        :param region_index: (N,) image index of each region
+        :param batch_size: number of images
+        :return: (B, n_thetas, n_rhos) frequency accumulator
+        """
+        width, height = shape
+
+        d, thetas, rhos, cos_thetas, sin_thetas = get_hough_tables(
+            width, height, self.step_theta, self.step_rho
+        )
+        self.diag_len = d + 1
+
+        regions = regions.cpu()
+        points = torch.stack(
+            [
+                regions[:, self.IDX_CY] - height / 2,
+                regions[:, self.IDX_CX] - width / 2,
+            ],
+            dim=1,
+        )
+        rho_values = torch.matmul(points.float(), torch.stack([sin_thetas, cos_thetas]))
+        shapes = torch.stack(
+            [regions[:, self.IDX_WIDTH], regions[:, self.IDX_HEIGHT]], dim=1
+        )
+        displacements = torch.div(shapes.max(dim=1).values, 2).round().int()
+
+        accumulator, edges = histogramdd(
+            thetas,
+            rhos,
+            rho_values,
+            displacements=displacements,
+            batch_index=region_index.cpu(),
+            batch_size=batch_size,
+        )
+        return accumulator
+
+    def filter_lines_batch(self, accumulator, threshold=None, angle_error=None):
+        """
+        Batched filter_lines: threshold, then keep for each image the thetas
+        around its own mode
+        :param accumulator: (B, n_theta, n_rho) frequency tensor
+        :param threshold: hough threshold, self.threshold by default
+        :param angle_error: theta error from the mode, self.angle_error by default
+        :return: (B, K, n_rho) sliced accumulator, (B, K) theta index tensor
+        """
+        threshold = self.threshold if threshold is None else threshold
+        angle_error = self.angle_error if angle_error is None else angle_error
+        filtered = F.threshold(accumulator, threshold, 0)
+        modes = filtered.sum(dim=2).argmax(dim=1)
+        offsets = torch.arange(-angle_error, angle_error + 1)
+        theta_index = (modes.unsqueeze(1) + offsets) % (180 // self.step_theta)
+        theta_index = theta_index.sort(dim=1).values
+        filtered = torch.gather(
+            filtered,
+            1,
+            theta_index.unsqueeze(2).expand(-1, -1, filtered.shape[2]),
+        )
+        return filtered, theta_index
+
+    def positivize_rhos_batch(self, accumulator, theta_index):
+        """
+        Batched positivize_rhos: (B, n_thetas, n_rhos) -> (B, 2 * n_thetas, n_rhos / 2)
+        """
+        chunk_size = int(self.diag_len)
+        negatives, positives = accumulator.split(chunk_size, dim=2)
+        theta_index = torch.concat([theta_index, theta_index + 180], dim=1)
+        accumulator = torch.concat([positives, negatives.flip(dims=[2])], dim=1)
+        return accumulator, theta_index
+
+    def cluster_lines_batch(
+        self, acc, thetas_idcs, mean_crop_sizes, clustering_tol=None
+    ):
+        """
+        Batched cluster_lines, clusters never span two images
+        :param acc: (B, n_thetas, n_rhos) frequency accumulator
+        :param thetas_idcs: (B, n_thetas) parallel theta tensor
+        :param mean_crop_sizes: (B,) mean crop size of each image
+        :param clustering_tol: rho tolerance, self.clustering_tol by default
+        :return: (N, 2) sorted (theta, rho) tensor, (N,) image index, cluster start indices
+        """
+        image_index, rho_index, theta_pos = torch.where(acc.permute(0, 2, 1) > 0)
+        thetas_rhos = torch.stack(
+            [thetas_idcs[image_index, theta_pos], rho_index], dim=1
+        )
+        clustering_tol = (
+            self.clustering_tol if clustering_tol is None else clustering_tol
+        )
+        clustering_tol = (
+            mean_crop_sizes[image_index]
+            if clustering_tol == self.CROP_AS_TOL
+            else clustering_tol
+        )
+        cluster_index = get_cluster_index(
+            thetas_rhos[:, 1], clustering_tol, image_index
+        )
+        return thetas_rhos, image_index, cluster_index
+
+    def predict_batch(self, masks):
+        """
+        Detect rows on a batch of masks with batched tensor ops
+        Args:
+            masks: (B, H, W) binary tensor
+
+        Returns:
+            list with a HoughDetectorDict dictionary for each image
+        """
+        if masks.ndim == 4:
+            masks = masks.squeeze(1)
+        masks = masks.to(self.device)
+        B, width, height = masks.shape
+        components, regions, region_index, mean_crop_sizes = (
+            self.calculate_connectivity_batch(masks)
+        )
+        accumulator = self.hough_batch((width, height), regions, region_index, B)
+        filtered_acc, theta_index = self.filter_lines_batch(accumulator)
+        pos_acc, theta_index = self.positivize_rhos_batch(filtered_acc, theta_index)
+        thetas_rhos, line_index, cluster_index = self.cluster_lines_batch(
+            pos_acc, theta_index, mean_crop_sizes.cpu()
+        )
+        medians = get_medians(thetas_rhos, cluster_index, line_index, B)
+        n_regions = torch.bincount(region_index, minlength=B).tolist()
+        return [
+            {
+                HoughDetectorDict.LINES: medians[i],
+                HoughDetectorDict.MEAN_CROP_SIZE: mean_crop_sizes[i],
+                HoughDetectorDict.CROP_MASK: masks[i],
+                HoughDetectorDict.COMPONENTS: components[i].unsqueeze(0),
+                HoughDetectorDict.ORIGINAL_LINES: None,
+                HoughDetectorDict.REDUCED_THRESHOLD: None,
+                HoughDetectorDict.ZERO_REASON: (
+                    "No components" if n_regions[i] == 0 else None
+                ),
+                HoughDetectorDict.UNIFORM_SIGNIFICANCE: None,
+            }
+            for i in range(B)
+        ]
+
+    def sweep(self, masks, thresholds=None, angle_errors=None, clustering_tols=None):
+        """
+        Detect rows with every (threshold, angle_error, clustering_tol) combination.
+        Connectivity and accumulator are computed once, each combination only
+        repeats the filtering and the clustering.
+        :param masks: (B, H, W) binary tensor
+        :param thresholds: hough thresholds, [self.threshold] by default
+        :param angle_errors: theta errors from the mode, [self.angle_error] by default
+        :param clustering_tols: rho tolerances, [self.clustering_tol] by default
+        :return: DataFrame with a row for each image and combination
+        """
+        thresholds = thresholds or [self.threshold]
+        angle_errors = angle_errors or [self.angle_error]
+        clustering_tols = clustering_tols or [self.clustering_tol]
+        if masks.ndim == 4:
+            masks = masks.squeeze(1)
+        masks = masks.to(self.device)
+        B, width, height = masks.shape
+        _, regions, region_index, mean_crop_sizes = self.calculate_connectivity_batch(
+            masks
+        )
+        accumulator = self.hough_batch((width, height), regions, region_index, B)
+        n_regions = torch.bincount(region_index, minlength=B).tolist()
+
+        rows = []
+        for threshold, angle_error in product(thresholds, angle_errors):
+            filtered_acc, theta_index = self.filter_lines_batch(
+                accumulator, threshold, angle_error
+            )
+            pos_acc, theta_index = self.positivize_rhos_batch(filtered_acc, theta_index)
+            for clustering_tol in clustering_tols:
+                thetas_rhos, line_index, cluster_index = self.cluster_lines_batch(
+                    pos_acc, theta_index, mean_crop_sizes.cpu(), clustering_tol
+                )
+                medians = get_medians(thetas_rhos, cluster_index, line_index, B)
+                rows += [
+                    {
+                        "image": i,
+                        "threshold": threshold,
+                        "angle_error": angle_error,
+                        "clustering_tol": clustering_tol,
+                        "n_lines": len(medians[i]),
+                        "lines": medians[i],
+                        "zero_reason": "No components" if n_regions[i] == 0 else None,
+                    }
+                    for i in range(B)
+                ]
+        return pd.DataFrame(rows)
+
 
 class HoughCropRowDetector(AbstractHoughCropRowDetector):
-    def hough(self, mask):
+    VOTES_PER_CHUNK = 2**24
+
+    def __init__(
+        self,
+        step_theta=1,
+        step_rho=1,
+        threshold=10,
+        angle_error=3,
+        clustering_tol=2,
+        uniform_significance=0.1,
+        crop_detector=None,
+        theta_reduction_threshold=1.0,
+        theta_value=None,
+        coarse_to_fine=False,
+        coarse_step_theta=5,
+        coarse_downscale=4,
+        fine_band=None,
+        theta_prior_patches=None,
+        torch_hough=False,
+        device=None,
+    ):
+        """
+
+        :param torch_hough: compute the Hough transform of predict_batch and sweep as a torch
+            accumulator on the device instead of cv2.HoughLines per mask. Faster on GPU, but
+            its rhos can differ by one step from the ones of cv2.HoughLines (and predict_from_mask)
+        :param coarse_to_fine: search the lines with a coarse sweep on the downscaled mask
+            followed by a fine sweep only around its theta mode
+        :param coarse_step_theta: theta quantization of the coarse sweep in degrees
+        :param coarse_downscale: downscale factor of the mask in the coarse sweep
+        :param fine_band: half width in degrees of the fine sweep band, coarse_step_theta by default
+        :param theta_prior_patches: if set, the row angle of each field is learned from the
+            coarse sweeps of its first theta_prior_patches patches, then only the fine sweep runs
+        """
+        super().__init__(
+            step_theta=step_theta,
+            step_rho=step_rho,
+            threshold=threshold,
+            angle_error=angle_error,
+            clustering_tol=clustering_tol,
+            uniform_significance=uniform_significance,
+            crop_detector=crop_detector,
+            theta_reduction_threshold=theta_reduction_threshold,
+            theta_value=theta_value,
+            device=device,
+        )
+        self.coarse_to_fine = coarse_to_fine
+        self.coarse_step_theta = coarse_step_theta
+        self.coarse_downscale = coarse_downscale
+        self.fine_band = coarse_step_theta if fine_band is None else fine_band
+        self.theta_prior_patches = theta_prior_patches
+        self.theta_observations = defaultdict(list)
+        self.theta_priors = {}
+        self.torch_hough = torch_hough
+
+    def hough_accumulator(self, masks, step_theta=None):
+        """
+        Vote accumulator of the standard Hough transform of a batch of masks.
+        Votes are computed as in cv2.HoughLines (origin in the top left corner,
+        float32 trigonometric tables, rounded rhos) so that the peaks of the
+        accumulator match its lines up to floating point rounding.
+        :param masks: (B, H, W) binary tensor
+        :param step_theta: theta quantization in degrees, self.step_theta by default
+        :return: (B, n_thetas, n_rhos) int64 accumulator
+        """
+        B, H, W = masks.shape
+        n_thetas, n_rhos, cos_thetas, sin_thetas = get_hough_lines_tables(
+            H, W, step_theta or self.step_theta, self.step_rho
+        )
+        cos_thetas = cos_thetas.to(masks.device)
+        sin_thetas = sin_thetas.to(masks.device)
+
+        image_index, ys, xs = torch.nonzero(masks, as_tuple=True)
+        accumulator = torch.zeros(
+            B * n_thetas * n_rhos, dtype=torch.int64, device=masks.device
+        )
+        chunk = max(1, self.VOTES_PER_CHUNK // max(len(xs), 1))
+        for start in range(0, n_thetas, chunk):
+            theta_index = torch.arange(
+                start, min(start + chunk, n_thetas), device=masks.device
+            )
+            rho_index = torch.round(
+                xs.unsqueeze(1) * cos_thetas[theta_index]
+                + ys.unsqueeze(1) * sin_thetas[theta_index]
+            ).long() + (n_rhos - 1) // 2
+            index = (
+                image_index.unsqueeze(1) * n_thetas + theta_index
+            ) * n_rhos + rho_index
+            index = index.flatten()
+            accumulator.index_add_(0, index, torch.ones_like(index))
+        return accumulator.reshape(B, n_thetas, n_rhos)
+
+    def lines_from_accumulator(self, accumulator, threshold=None, return_votes=False):
+        """
+        Lines are the local maxima of the accumulator above the threshold, as in cv2.HoughLines
+        :param accumulator: (B, n_thetas, n_rhos) accumulator
+        :param threshold: hough threshold, self.threshold by default
+        :param return_votes: also return the votes of each line
+        :return: (N, 2) (rho, theta) tensor sorted by votes within each image, (N,) image index
+            and (N,) votes if return_votes
+        """
+        threshold = self.threshold if threshold is None else threshold
+        B, n_thetas, n_rhos = accumulator.shape
+        padded = F.pad(accumulator, (1, 1, 1, 1))
+        center = padded[:, 1:-1, 1:-1]
+        peaks = (
+            (center > threshold)
+            & (center > padded[:, 1:-1, :-2])
+            & (center >= padded[:, 1:-1, 2:])
+            & (center > padded[:, :-2, 1:-1])
+            & (center >= padded[:, 2:, 1:-1])
+        )
+        image_index, theta_index, rho_index = torch.nonzero(peaks, as_tuple=True)
+        votes = accumulator[image_index, theta_index, rho_index]
+        order = torch.sort(-votes, stable=True).indices
+        order = order[torch.sort(image_index[order], stable=True).indices]
+        image_index, theta_index, rho_index = (
+            image_index[order],
+            theta_index[order],
+            rho_index[order],
+        )
+        rhos = (rho_index - (n_rhos - 1) * 0.5) * self.step_rho
+        thetas = theta_index * (self.step_theta * np.pi / 180)
+        lines = torch.stack([rhos, thetas], dim=1).float()
+        if return_votes:
+            return lines, image_index, votes[order]
+        return lines, image_index
+
+    def hough_lines_batch(self, masks, threshold=None, return_votes=False):
+        """
+        Lines of each mask of a batch, from cv2.HoughLines as in predict_from_mask or,
+        with torch_hough, from the torch accumulator
+        :param masks: (B, H, W) binary tensor
+        :param threshold: hough threshold, self.threshold by default
+        :param return_votes: also return the votes of each line
+        :return: (N, 2) (rho, theta) tensor sorted by votes within each image, (N,) image index
+            and (N,) votes if return_votes
+        """
+        if self.torch_hough:
+            return self.lines_from_accumulator(
+                self.hough_accumulator(masks), threshold, return_votes
+            )
+        threshold = self.threshold if threshold is None else threshold
+        step_theta = self.step_theta * np.pi / 180
+        found, image_index = [], []
+        for i, mask in enumerate(masks.cpu().type(torch.uint8).numpy()):
+            # Same transform as cv2.HoughLines, the votes are the third column
+            lines = cv2.HoughLinesWithAccumulator(
+                mask, self.step_rho, step_theta, threshold
+            )
+            if lines is not None:
+                found.append(torch.from_numpy(lines.reshape(-1, 3)))
+                image_index.append(torch.full((len(lines),), i))
+        if not found:
+            found, image_index = [torch.empty(0, 3)], [torch.empty(0, dtype=torch.int64)]
+        found = torch.cat(found).to(masks.device)
+        lines = found[:, :2].contiguous()
+        image_index = torch.cat(image_index).to(masks.device)
+        if return_votes:
+            return lines, image_index, found[:, 2].long()
+        return lines, image_index
+
+    def filter_lines_batch(self, lines, line_index, batch_size, angle_error=1):
+        """
+        Batched filter_lines, the theta mode is computed image by image
+        :param lines: (N, 2) (rho, theta) tensor
+        :param line_index: (N,) image index of each line
+        :param batch_size: number of images
+        :param angle_error: theta error from the mode in theta steps,
+            filter_lines keeps a single step
+        :return: (N,) boolean tensor of the lines to keep
+        """
+        thetas = lines[:, 1].contiguous()
+        n_bins = int(180 / self.step_theta)
+        step_theta = angle_error * self.step_theta * np.pi / 180
+        if self.theta_value is None:
+            bin_edges = torch.linspace(0, np.pi, n_bins + 1, device=lines.device)
+            bins = (torch.bucketize(thetas, bin_edges, right=True) - 1).clamp(
+                0, n_bins - 1
+            )
+            hist = torch.zeros(batch_size, n_bins, device=lines.device)
+            hist.index_put_(
+                (line_index, bins), torch.ones_like(thetas), accumulate=True
+            )
+            theta_mode = bin_edges[hist.argmax(dim=1)][line_index]
+        else:
+            theta_mode = self.theta_value
+        return (thetas >= theta_mode - step_theta) & (thetas <= theta_mode + step_theta)
+
+    def cluster_lines_batch(
+        self, lines, line_index, mean_crop_sizes, clustering_tol=None
+    ):
+        """
+        Batched cluster_lines, clusters never span two images
+        :param lines: (N, 2) (rho, theta) tensor
+        :param line_index: (N,) image index of each line
+        :param mean_crop_sizes: (B,) mean crop size of each image
+        :param clustering_tol: rho tolerance, self.clustering_tol by default
+        :return: lines sorted by image and rho, their image index, cluster start indices
+        """
+        order = torch.sort(lines[:, 0], stable=True).indices
+        order = order[torch.sort(line_index[order], stable=True).indices]
+        lines, line_index = lines[order], line_index[order]
+        clustering_tol = (
+            self.clustering_tol if clustering_tol is None else clustering_tol
+        )
+        clustering_tol = (
+            mean_crop_sizes[line_index]
+            if clustering_tol == self.CROP_AS_TOL
+            else clustering_tol
+        )
+        cluster_index = get_cluster_index(lines[:, 0], clustering_tol, line_index)
+        return lines, line_index, cluster_index
+
+    def predict_batch(self, masks):
+        """
+        Detect rows on a batch of masks with batched tensor ops.
+        The lines are the ones of cv2.HoughLines, as in predict_from_mask, unless torch_hough is set.
+        Args:
+            masks: (B, H, W) binary tensor
+
+        Returns:
+            list with a HoughDetectorDict dictionary for each image
+        """
+        if masks.ndim == 4:
+            masks = masks.squeeze(1)
+        masks = masks.to(self.device)
+        B = masks.shape[0]
+        components, regions, region_index, mean_crop_sizes = (
+            self.calculate_connectivity_batch(masks)
+        )
+        lines, line_index = self.hough_lines_batch(masks)
+        n_regions = torch.bincount(region_index, minlength=B).tolist()
+        original_lines = lines.split(torch.bincount(line_index, minlength=B).tolist())
+
+        keep = self.filter_lines_batch(lines, line_index, B)
+        sorted_lines, sorted_index, cluster_index = self.cluster_lines_batch(
+            lines[keep], line_index[keep], mean_crop_sizes
+        )
+        medians = get_medians(sorted_lines, cluster_index, sorted_index, B)
+
+        results = []
+        for i in range(B):
+            zero_reason = None
+            uniform_statistic = None
+            res = medians[i]
+            if n_regions[i] == 0:
+                zero_reason = "No components"
+                res = torch.tensor([])
+            elif len(original_lines[i]) == 0:
+                zero_reason = "No lines thresholded"
+                res = torch.tensor([])
+            else:
+                is_uniform, uniform_statistic = self.test_if_uniform(
+                    original_lines[i][:, 1].cpu()
+                )
+                if is_uniform:
+                    zero_reason = "Uniform"
+            results.append(
+                {
+                    HoughDetectorDict.LINES: res,
+                    HoughDetectorDict.MEAN_CROP_SIZE: mean_crop_sizes[i],
+                    HoughDetectorDict.CROP_MASK: masks[i].unsqueeze(0),
+                    HoughDetectorDict.COMPONENTS: components[i].unsqueeze(0),
+                    HoughDetectorDict.ORIGINAL_LINES: original_lines[i],
+                    HoughDetectorDict.REDUCED_THRESHOLD: None,
+                    HoughDetectorDict.ZERO_REASON: zero_reason,
+                    HoughDetectorDict.UNIFORM_SIGNIFICANCE: uniform_statistic,
+                }
+            )
+        return results
+
+    def sweep(self, masks, thresholds=None, angle_errors=None, clustering_tols=None):
+        """
+        Detect rows with every (threshold, angle_error, clustering_tol) combination.
+        The lines and their votes are computed once at the lowest threshold (see
+        hough_lines_batch), each threshold then keeps the lines with more votes and
+        each combination only repeats the filtering and the clustering.
+        :param masks: (B, H, W) binary tensor
+        :param thresholds: hough thresholds, [self.threshold] by default
+        :param angle_errors: theta errors from the mode in theta steps, [1] by default
+            as in predict_batch
+        :param clustering_tols: rho tolerances, [self.clustering_tol] by default
+        :return: DataFrame with a row for each image and combination
+        """
+        thresholds = thresholds or [self.threshold]
+        angle_errors = angle_errors or [1]
+        clustering_tols = clustering_tols or [self.clustering_tol]
+        if masks.ndim == 4:
+            masks = masks.squeeze(1)
+        masks = masks.to(self.device)
+        B = masks.shape[0]
+        _, regions, region_index, mean_crop_sizes = self.calculate_connectivity_batch(
+            masks
+        )
+        all_lines, all_index, votes = self.hough_lines_batch(
+            masks, min(thresholds), return_votes=True
+        )
+        n_regions = torch.bincount(region_index, minlength=B).tolist()
+
+        rows = []
+        for threshold in thresholds:
+            above = votes > threshold
+            lines, line_index = all_lines[above], all_index[above]
+            original_lines = lines.split(
+                torch.bincount(line_index, minlength=B).tolist()
+            )
+            zero_reasons, uniform_statistics = [], []
+            for i in range(B):
+                zero_reason, uniform_statistic = None, None
+                if n_regions[i] == 0:
+                    zero_reason = "No components"
+                elif len(original_lines[i]) == 0:
+                    zero_reason = "No lines thresholded"
+                else:
+                    is_uniform, uniform_statistic = self.test_if_uniform(
+                        original_lines[i][:, 1].cpu()
+                    )
+                    if is_uniform:
+                        zero_reason = "Uniform"
+                zero_reasons.append(zero_reason)
+                uniform_statistics.append(uniform_statistic)
+            for angle_error in angle_errors:
+                keep = self.filter_lines_batch(lines, line_index, B, angle_error)
+                for clustering_tol in clustering_tols:
+                    sorted_lines, sorted_index, cluster_index = self.cluster_lines_batch(
+                        lines[keep], line_index[keep], mean_crop_sizes, clustering_tol
+                    )
+                    medians = get_medians(sorted_lines, cluster_index, sorted_index, B)
+                    rows += [
+                        {
+                            "image": i,
+                            "threshold": threshold,
+                            "angle_error": angle_error,
+                            "clustering_tol": clustering_tol,
+                            "n_lines": len(medians[i]),
+                            "lines": medians[i],
+                            "zero_reason": zero_reasons[i],
+                            "uniform_significance": uniform_statistics[i],
+                        }
+                        for i in range(B)
+                    ]
+        return pd.DataFrame(rows)
+
+    def hough(
+        self, mask, step_theta=None, threshold=None, min_theta=0, max_theta=np.pi
+    ):
         """
         Apply hough transform to the mask
         :param mask: mask tensor
+        :param step_theta: theta quantization in degrees, self.step_theta by default
+        :param threshold: hough threshold, self.threshold by default
+        :param min_theta: minimum theta of the sweep in radians
+        :param max_theta: maximum theta of the sweep in radians
         :return: (rho, theta) tensor
         """
-        step_theta = self.step_theta * np.pi / 180
+        step_theta = (step_theta or self.step_theta) * np.pi / 180
+        threshold = self.threshold if threshold is None else threshold
         mask = mask.squeeze(0).cpu().type(torch.uint8).numpy()
-        lines = cv2.HoughLines(mask, self.step_rho, step_theta, self.threshold)
+        lines = cv2.HoughLines(
+            mask,
+            self.step_rho,
+            step_theta,
+            threshold,
+            min_theta=min_theta,
+            max_theta=max_theta,
+        )
         return torch.tensor([]) if lines is None else torch.tensor(lines).squeeze(1)
 
+    def hough_coarse(self, mask):
+        """
+        Row angle from a low resolution hough sweep on the mask downscaled by coarse_downscale:
+        the theta whose rho profile has the highest energy (sum of squared votes)
+        :param mask: mask tensor
+        :return: theta in radians, None if the mask is empty
+        """
+        mask = mask.reshape(1, 1, *mask.shape[-2:]).float()
+        small = F.max_pool2d(mask, self.coarse_downscale).squeeze(1)
+        if not small.any():
+            return None
+        accumulator = self.hough_accumulator(small, step_theta=self.coarse_step_theta)
+        energy = accumulator[0].double().square().sum(dim=1)
+        return energy.argmax().item() * self.coarse_step_theta * np.pi / 180
+
+    def hough_fine(self, mask, theta_center):
+        """
+        Full resolution hough sweep only in the band of fine_band degrees around theta_center.
+        Thetas stay on the grid of the full sweep and the band wraps around pi.
+        :param mask: mask tensor
+        :param theta_center: band center in radians
+        :return: (rho, theta) tensor
+        """
+        step_theta = self.step_theta * np.pi / 180
+        n_thetas = int(round(180 / self.step_theta))
+        center = int(round(theta_center / step_theta))
+        band = int(np.ceil(self.fine_band / self.step_theta))
+        if 2 * band + 1 >= n_thetas:
+            return self.hough(mask)
+        lines = [
+            self.hough(
+                mask, min_theta=inf * step_theta, max_theta=(sup - 0.5) * step_theta
+            )
+            for inf, sup in get_circular_interval(
+                center - band, center + band + 1, n_thetas
+            )
+        ]
+        lines = [line for line in lines if len(line) > 0]
+        return torch.cat(lines) if lines else torch.tensor([])
+
+    def theta_mode(self, thetas, step_theta=None):
+        """
+        Left edge of the most frequent theta bin
+        :param thetas: thetas in radians
+        :param step_theta: bin width in degrees, self.step_theta by default
+        """
+        n_bins = int(180 / (step_theta or self.step_theta))
+        hist = torch.histogram(thetas, bins=n_bins, range=(0, np.pi))
+        return hist.bin_edges[hist.hist.argmax()]
+
+    def update_theta_prior(self, field, theta):
+        """
+        Record the row angle of a patch of field, when theta_prior_patches angles are
+        recorded their mode becomes the prior of the field
+        """
+        if self.theta_prior_patches is None or field in self.theta_priors:
+            return
+        observations = self.theta_observations[field]
+        observations.append(theta)
+        if len(observations) >= self.theta_prior_patches:
+            self.theta_priors[field] = torch.tensor(observations).mode().values.item()
+
+    def get_theta_prior(self, field):
+        """
+        Learned row angle prior of field used by search_lines, None if the coarse sweep runs
+        """
+        if not self.coarse_to_fine or self.theta_value is not None:
+            return None
+        return self.theta_priors.get(field)
+
+    def search_lines(self, mask, field=None):
+        """
+        Hough lines of the mask, from a full sweep or from a coarse-to-fine search.
+        The uniformity test needs the thetas of a full sweep, so it is skipped by the
+        coarse-to-fine search.
+        :param mask: mask tensor
+        :param field: field of the mask, key of the learned theta prior
+        :return: (rho, theta) tensor, lines used for the uniformity test (None to skip it),
+            theta of the coarse sweep recorded by the prior (None if it did not run)
+        """
+        if not self.coarse_to_fine:
+            lines = self.hough(mask)
+            return lines, lines, None
+        theta = (
+            self.theta_value
+            if self.theta_value is not None
+            else self.theta_priors.get(field)
+        )
+        if theta is not None:
+            return self.hough_fine(mask, theta), None, None
+        theta = self.hough_coarse(mask)
+        if theta is None:
+            return torch.tensor([]), None, None
+        self.update_theta_prior(field, theta)
+        return self.hough_fine(mask, theta), None, theta
+
     def filter_lines(self, lines):
         """
         Filter lines that doesn't have the theta mode
@@ -597,12 +1409,8 @@ class HoughCropRowDetector(AbstractHoughCropRowDetector):
         :return: filtered lines
         """
         thetas = lines[:, 1]
-        n_bins = int(180 / self.step_theta)
-        hist = torch.histogram(thetas, bins=n_bins, range=(0, np.pi))
         theta_mode = (
-            hist.bin_edges[hist.hist.argmax()]
-            if self.theta_value is None
-            else self.theta_value
+            self.theta_mode(thetas) if self.theta_value is None else self.theta_value
         )
         step_theta = self.step_theta * np.pi / 180
         thetas_in_bin = (thetas >= theta_mode - step_theta) & (
@@ -614,7 +1422,7 @@ class HoughCropRowDetector(AbstractHoughCropRowDetector):
         """
         Cluster lines basing on rhos with a certain tolerance
         :param lines: (rho, theta) tensor
-        :return: cluster list indices: index where each cluster starts
+        :return: sorted lines, cluster indices: index where each cluster starts and the end index
         """
         clustering_tol = (
             self.mean_crop_size
@@ -623,57 +1431,62 @@ class HoughCropRowDetector(AbstractHoughCropRowDetector):
         )
         rhos = lines[:, 0]
         sorted_lines = lines[torch.argsort(rhos)]
-        cluster_indices = [0]
-        if sorted_lines.shape[0] > 1:
-            for i in range(1, sorted_lines.shape[0]):
-                if abs(sorted_lines[i][0] - sorted_lines[i - 1][0]) > clustering_tol:
-                    cluster_indices.append(i)
-        else:
-            i = 0
-        cluster_indices.append(i + 1)
+        cluster_indices = get_cluster_index(sorted_lines[:, 0], clustering_tol)
         return sorted_lines, cluster_indices
 
     def predict_from_mask(
         self,
         mask,
+        field=None,
+        segmentation=None,
     ):
         """
         Detect rows
         Args:
             input_img: Input tensor
-            return_mean_crop_size: tells if return the mean crop size
+            field: field of the mask, used by the coarse-to-fine theta prior
+            segmentation: VegetationSegmentation of the mask, whose components are reused
 
         Returns:
 
         """
-        crop_mask = mask.cuda()
+        crop_mask = mask.to(self.device)
         zero_reason = None
         uniform_statistic = None
         original_lines = torch.tensor([])
-        components, regions = self.calculate_connectivity(
-            crop_mask
-        )  # To calculate the mean crop size
+        coarse_theta = None
+        with PROFILER.span("components"):
+            components, regions = self.calculate_connectivity(
+                crop_mask, segmentation
+            )  # To calculate the mean crop size
+        PROFILER.count("components", len(regions))
         reduced_threshold = None
         if len(regions) == 0:
             zero_reason = "No components"
             res = torch.tensor([])
         else:
-            original_lines = self.hough(crop_mask)
+            with PROFILER.span("hough"):
+                original_lines, uniform_lines, coarse_theta = self.search_lines(
+                    crop_mask, field
+                )
             if len(original_lines) == 0:
                 zero_reason = "No lines thresholded"
                 res = torch.tensor([])
             else:
-                is_uniform, uniform_statistic = self.test_if_uniform(
-                    original_lines[:, 1]
-                )
-                if is_uniform:
-                    zero_reason = "Uniform"
-                    res = torch.tensor([])
-
-                filtered_lines = self.filter_lines(original_lines)
-                thetas_rhos, clusters_index = self.cluster_lines(filtered_lines)
-                medians = get_medians(thetas_rhos, clusters_index)
-                res = medians
+                with PROFILER.span("lines"):
+                    if uniform_lines is not None:
+                        is_uniform, uniform_statistic = self.test_if_uniform(
+                            uniform_lines[:, 1]
+                        )
+                        if is_uniform:
+                            zero_reason = "Uniform"
+                            res = torch.tensor([])
+
+                    filtered_lines = self.filter_lines(original_lines)
+                    thetas_rhos, clusters_index = self.cluster_lines(filtered_lines)
+                    medians = get_medians(thetas_rhos, clusters_index)
+                    res = medians
+        PROFILER.count("lines", len(res))
 
         return_dict = {
             HoughDetectorDict.LINES: res,
@@ -684,6 +1497,188 @@ class HoughCropRowDetector(AbstractHoughCropRowDetector):
             HoughDetectorDict.REDUCED_THRESHOLD: reduced_threshold,
             HoughDetectorDict.ZERO_REASON: zero_reason,
             HoughDetectorDict.UNIFORM_SIGNIFICANCE: uniform_statistic,
+            HoughDetectorDict.COARSE_THETA: coarse_theta,
         }
 
         return return_dict
+
+
+class OrthoRowDetector:
+    """
+    Crop rows of the patches of an orthomosaic, detected once per field on the whole
+    downscaled orthomosaic and projected onto each patch with the tiling of
+    preprocess.divide_ortho_into_patches, so that rows are consistent across patch
+    borders and patches with few plants still get their rows.
+    """
+
+    def __init__(
+        self,
+        root,
+        channels,
+        patch_size,
+        row_detector,
+        downscale=4,
+        refine_tolerance=None,
+    ):
+        """
+        :param root: folder of the orthomosaics, one folder per field with a {channel}.png per channel
+        :param channels: channels of the orthomosaic given to the vegetation detector
+        :param patch_size: size of the patches of divide_ortho_into_patches
+        :param row_detector: HoughCropRowDetector of the orthomosaic, with its crop_detector
+        :param downscale: downscale factor of the orthomosaic
+        :param refine_tolerance: if set, each line is moved in the patch to the rho within
+            refine_tolerance pixels crossing the most vegetation pixels
+        """
+        self.root = root
+        self.channels = channels
+        self.patch_size = patch_size
+        self.row_detector = row_detector
+        self.downscale = downscale
+        self.refine_tolerance = refine_tolerance
+        self.fields = {}
+
+    def load_ortho(self, field):
+        """
+        Downscaled orthomosaic of a field, channels are read and downscaled one at a time
+        :return: (C, h, w) tensor in [0, 1], (H, W) size of the orthomosaic
+        """
+        channels = []
+        for channel in self.channels:
+            img = cv2.imread(
+                os.path.join(self.root, field, f"{channel}.png"), cv2.IMREAD_UNCHANGED
+            )
+            height, width = img.shape[:2]
+            size = (max(width // self.downscale, 1), max(height // self.downscale, 1))
+            channels.append(cv2.resize(img, size, interpolation=cv2.INTER_AREA))
+        ortho = torch.from_numpy(np.stack(channels)).float() / 255.0
+        return ortho, (height, width)
+
+    def detect_field(self, field):
+        """
+        Crop rows of the orthomosaic of a field in full resolution coordinates, detected once
+        :return: dict with the lines, the size of the orthomosaic, mean crop size and zero reason
+        """
+        if field in self.fields:
+            return self.fields[field]
+        ortho, (height, width) = self.load_ortho(field)
+        mask = self.row_detector.crop_detector(ortho)
+        result = self.row_detector.predict_from_mask(mask, field=field)
+        scale_x = width / ortho.shape[2]
+        scale_y = height / ortho.shape[1]
+        mean_crop_size = result[HoughDetectorDict.MEAN_CROP_SIZE]
+        self.fields[field] = {
+            "lines": scale_lines(
+                result[HoughDetectorDict.LINES].cpu(), scale_x, scale_y
+            ),
+            "size": (height, width),
+            "mean_crop_size": None
+            if mean_crop_size is None
+            else mean_crop_size * (scale_x + scale_y) / 2,
+            "zero_reason": result[HoughDetectorDict.ZERO_REASON],
+        }
+        return self.fields[field]
+
+    def predict_from_mask(self, mask, field, patch_index):
+        """
+        Crop rows of a patch from the rows of its field
+        :param mask: (1, h, w) vegetation mask of the patch
+        :param field: field of the patch
+        :param patch_index: index of the patch in divide_ortho_into_patches
+        :return: result dict as HoughCropRowDetector.predict_from_mask
+        """
+        field_rows = self.detect_field(field)
+        x0, y0 = get_patch_origin(patch_index, *field_rows["size"], self.patch_size)
+        lines = field_rows["lines"]
+        zero_reason = field_rows["zero_reason"]
+        if len(lines) > 0:
+            rhos = lines[:, 0] - x0 * torch.cos(lines[:, 1]) - y0 * torch.sin(lines[:, 1])
+            lines = torch.stack([rhos, lines[:, 1]], dim=1)
+            height, width = mask.shape[-2:]
+            tolerance = self.refine_tolerance or 0
+            lines = lines[crosses_box(lines, width, height, tolerance)]
+            if self.refine_tolerance is not None:
+                lines = refine_lines(lines, mask, self.refine_tolerance)
+            if len(lines) == 0:
+                zero_reason = "No field lines in patch"
+        return {
+            HoughDetectorDict.LINES: lines,
+            HoughDetectorDict.MEAN_CROP_SIZE: field_rows["mean_crop_size"],
+            HoughDetectorDict.CROP_MASK: mask,
+            HoughDetectorDict.COMPONENTS: None,
+            HoughDetectorDict.ORIGINAL_LINES: field_rows["lines"],
+            HoughDetectorDict.REDUCED_THRESHOLD: None,
+            HoughDetectorDict.ZERO_REASON: zero_reason,
+            HoughDetectorDict.UNIFORM_SIGNIFICANCE: None,
+        }
+
+
+def scale_lines(lines, scale_x, scale_y):
+    """
+    Lines of an image resized by (scale_x, scale_y) with area interpolation: the pixel
+    (u, v) of the image covers (x + 0.5) = (u + 0.5) * scale in the resized one
+    :param lines: (L, 2) (rho, theta) tensor
+    :return: (L, 2) (rho, theta) lines of the resized image, theta in [0, pi]
+    """
+    if len(lines) == 0:
+        return lines
+    lines = lines.double()
+    cos, sin = torch.cos(lines[:, 1]), torch.sin(lines[:, 1])
+    rhs = lines[:, 0] + 0.5 * (cos + sin) - 0.5 * (cos / scale_x + sin / scale_y)
+    normal_x, normal_y = cos / scale_x, sin / scale_y
+    norm = torch.hypot(normal_x, normal_y)
+    thetas = torch.atan2(normal_y, normal_x)
+    rhos = rhs / norm
+    # Keep theta in [0, pi] as the Hough transform, flipping the normal
+    flip = thetas < 0
+    thetas[flip] += np.pi
+    rhos[flip] = -rhos[flip]
+    return torch.stack([rhos, thetas], dim=1).float()
+
+
+def crosses_box(lines, width, height, tolerance=0):
+    """
+    Lines passing within tolerance pixels of the (0, 0, width, height) box
+    :param lines: (L, 2) (rho, theta) tensor
+    :return: (L,) boolean tensor
+    """
+    corners = torch.tensor(
+        [[0, 0], [width - 1, 0], [0, height - 1], [width - 1, height - 1]],
+        dtype=lines.dtype,
+    )
+    projections = corners[:, :1] * torch.cos(lines[:, 1])
+    projections = projections + corners[:, 1:] * torch.sin(lines[:, 1])
+    return (projections.amin(dim=0) <= lines[:, 0] + tolerance) & (
+        projections.amax(dim=0) >= lines[:, 0] - tolerance
+    )
+
+
+def refine_lines(lines, mask, tolerance):
+    """
+    Move each line to the rho within tolerance pixels crossing the most vegetation pixels,
+    preferring the smallest shift, lines crossing no vegetation are kept as they are
+    :param lines: (L, 2) (rho, theta) tensor
+    :param mask: (1, H, W) or (H, W) vegetation mask
+    :param tolerance: maximum shift of rho in pixels
+    :return: (L, 2) refined lines
+    """
+    if len(lines) == 0:
+        return lines
+    tolerance = int(tolerance)
+    ys, xs = torch.nonzero(mask.squeeze(0).cpu(), as_tuple=True)
+    distances = (
+        xs[:, None] * torch.cos(lines[:, 1]) + ys[:, None] * torch.sin(lines[:, 1])
+        - lines[:, 0]
+    ).round().long()
+    near = distances.abs() <= tolerance
+    line_index = torch.arange(len(lines)).expand_as(distances)
+    votes = torch.bincount(
+        line_index[near] * (2 * tolerance + 1) + distances[near] + tolerance,
+        minlength=len(lines) * (2 * tolerance + 1),
+    ).reshape(len(lines), 2 * tolerance + 1)
+    # Shifts by increasing absolute value, so that argmax prefers the smallest on ties
+    shifts = torch.tensor(sorted(range(-tolerance, tolerance + 1), key=abs))
+    best = votes[:, shifts + tolerance].argmax(dim=1)
+    refined = lines.clone()
+    has_votes = votes.sum(dim=1) > 0
+    refined[has_votes, 0] += shifts[best[has_votes]].to(lines.dtype)
+    return refined
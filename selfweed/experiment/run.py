@@ -21,6 +21,7 @@ from selfweed.data.utils import DataDict
 from selfweed.experiment.utils import WrapperModule
 from selfweed.loss import build_loss
 from selfweed.models import build_model
+from selfweed.models.segmentation import HoughSLIC, HoughSLICSegmentationWrapper
 from selfweed.utils.metrics import build_metrics
 from selfweed.utils.utils import (
     RunningAverage,
@@ -272,6 +273,16 @@ class Run:
         elif moment == SchedulerStepMoment.EPOCH:
             self.scheduler.step(metrics[self.watch_metric])
 
+    def _preprocess(self, batch_dict: DataDict, dataloader):
+        """
+        Apply on the device the transforms of a dataset built with device_preprocessing
+        to the uint8 images of a batch, batches of the other datasets are returned as they are.
+        """
+        device_transform = getattr(dataloader.dataset, "device_transform", None)
+        if device_transform is not None:
+            batch_dict.image = device_transform(batch_dict.image)
+        return batch_dict
+
     def _forward(
         self,
         input_dict: DataDict,
@@ -385,6 +396,7 @@ class Run:
 
         for tot_steps, (batch_idx, batch_dict) in enumerate(bar):
             batch_dict: DataDict
+            batch_dict = self._preprocess(batch_dict, self.train_loader)
             self.optimizer.zero_grad()
             result_dict = self._forward(batch_dict, epoch, batch_idx)
             loss = self._backward(batch_idx, batch_dict, result_dict, loss_normalizer)
@@ -454,6 +466,7 @@ class Run:
         self.tracker.create_prediction_sequence(phase)
         with torch.no_grad():
             for batch_idx, batch_dict in bar:
+                batch_dict = self._preprocess(batch_dict, dataloader)
                 result_dict: ModelOutput = self.model(batch_dict)
                 outputs = result_dict.logits
                 preds = outputs.argmax(dim=1)
@@ -535,6 +548,7 @@ class Run:
             for k in range(ITERATIONS):
                 logger.info(f"Iteration {k}")
                 for batch_dict in dataloader:
+                    batch_dict = self._preprocess(batch_dict, dataloader)
                     if i < WARMUP:
                         _ = self.model(batch_dict)
                         continue
@@ -569,5 +583,10 @@ class Run:
 
     def end(self):
         logger.info("Ending run")
+        if self.model is not None:
+            # Worker processes of the models, e.g. the SLIC pool of the superpixels
+            for module in self.model.modules():
+                if isinstance(module, (HoughSLIC, HoughSLICSegmentationWrapper)):
+                    module.close()
         self.tracker.end()
         logger.info("Run ended")
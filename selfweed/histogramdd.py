@@ -34,7 +34,37 @@ def _get_outer_edges(a, range):
     return first_edge, last_edge
 
 
-def histogramdd(thetas, rhos, rho_values, displacements=None, range=None):
+def band_votes(xy, displacements, size, batch_index=None, batch_size=1):
+    """
+    Vote for the band [xy - displacement, xy + displacement] of each sample in a
+    flattened accumulator using a difference array: +1 at the band start, -1 past
+    its end, then a cumulative sum. Memory scales with the accumulator size and
+    the number of samples, not with the total number of votes.
+    :param xy: (N,) flattened accumulator indices
+    :param displacements: (N,) half band width of each sample
+    :param size: size of the flattened accumulator of a single image
+    :param batch_index: optional (N,) index of the image each sample belongs to,
+        bands are clamped to the accumulator of their own image
+    :param batch_size: number of images
+    :return: (batch_size * size,) int64 accumulator
+    """
+    size = int(size)
+    total = size * batch_size
+    if batch_index is None:
+        starts = (xy - displacements).clamp(0, size)
+        ends = (xy + displacements + 1).clamp(0, size)
+    else:
+        lower = batch_index * size
+        upper = lower + size
+        starts = torch.minimum(torch.maximum(xy - displacements, lower), upper)
+        ends = torch.minimum(torch.maximum(xy + displacements + 1, lower), upper)
+    diff = torch.bincount(starts, minlength=total + 1) - torch.bincount(
+        ends, minlength=total + 1
+    )
+    return diff.cumsum(0)[:total]
+
+
+def histogramdd(thetas, rhos, rho_values, displacements=None, range=None, batch_index=None, batch_size=1):
     """
     Compute the bidimensional histogram of some data.
     Parameters
@@ -53,6 +83,11 @@ def histogramdd(thetas, rhos, rho_values, displacements=None, range=None):
           edges along each dimension.
         * The number of bins for each dimension (nx, ny, ... =bins)
         * The number of bins for all dimensions (nx=ny=...=bins).
+    batch_index : (N,) tensor, optional
+        Index of the image each row of ``rho_values`` belongs to. When given,
+        the histogram has shape ``(batch_size, *nbin)``.
+    batch_size : int, optional
+        Number of images when ``batch_index`` is given.
     range : sequence, optional
         A sequence of length D, each an optional (lower, upper) tuple giving
         the outer bin edges to be used if the edges are not given explicitly in
@@ -162,22 +197,28 @@ def histogramdd(thetas, rhos, rho_values, displacements=None, range=None):
     Ncount = torch.stack(Ncount, dim=1)
     # Compute the sample indices in the flattened histogram matrix.
     # This raises an error if the array is too large.
-    xy = Ncount @ torch.tensor([nbin[1], 1])
+    xy = Ncount @ torch.tensor([nbin[1], 1], device=sample.device)
+
+    if batch_index is not None:
+        # Each image votes in its own slice of the flattened histmat.
+        batch_index = batch_index.repeat_interleave(len(thetas))
+        xy = xy + batch_index * nbin.prod()
 
     if displacements is not None:
-        displacements_adapted = displacements.repeat(len(thetas)).reshape(len(thetas), len(displacements)).T.flatten()
-        # Add the displacements
-        xy_enlarged = torch.concat([torch.arange(-dis, dis + 1) + xyindex
-                                    for dis, xyindex in zip(displacements_adapted, xy)])
+        hist = band_votes(
+            xy,
+            displacements.repeat_interleave(len(thetas)),
+            nbin.prod(),
+            batch_index=batch_index,
+            batch_size=batch_size,
+        )
     else:
-        xy_enlarged = xy
-
-    # Compute the number of repetitions in xy and assign it to the
-    # flattened histmat.
-    hist = torch.bincount(xy_enlarged, minlength=nbin.prod())
+        # Compute the number of repetitions in xy and assign it to the
+        # flattened histmat.
+        hist = torch.bincount(xy, minlength=nbin.prod() * batch_size)
 
     # Shape into a proper matrix
-    hist = hist.reshape(*nbin)
+    hist = hist.reshape(*nbin) if batch_index is None else hist.reshape(batch_size, *nbin)
 
     # Remove outliers (indices 0 and -1 for each dimension).
     # core = D*(slice(1, -1),)
@@ -1,26 +1,50 @@
-from copy import deepcopy
+import glob
+import hashlib
+import json
+import shutil
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
 import os
+import multiprocessing
 import math
+import re
+import time
 import torch
 import numpy as np
-import skimage as ski
 import cv2
 
 from torchvision import transforms
 from PIL import Image
+from torch.utils.data import Subset
 from tqdm import tqdm
-from datetime import datetime
 
 import yaml
+from selfweed.cache import Manifest, StageCache, hash_array, hash_files, hash_params
 from selfweed.data import get_dataset
-from selfweed.data.utils import DataDict, crop_to_nonzero
+from selfweed.data.patch_store import (
+    COMPACT_DEAD_SHARE,
+    PatchStoreWriter,
+    compact_patch_store,
+    merge_patch_stores,
+    write_patch_pngs,
+)
+from selfweed.data.utils import GT_FORMATS, DataDict, write_label_map
 
+from selfweed.profiling import PROFILER, Profiler
+from selfweed.superpixels import SuperpixelService
 from selfweed.detector import (
     HoughCropRowDetector,
     HoughDetectorDict,
+    OrthoRowDetector,
     get_vegetation_detector,
 )
-from selfweed.visualize import map_grayscale_to_rgb
+from selfweed.utils.utils import get_device
+
+CHANNELS = ["R", "G", "B", "NIR", "RE"]
+PIXELS_PER_CHUNK = 2**24
+MANIFEST_FILE = "manifest.json"
+CHECKPOINT_EVERY = 50
 
 
 def get_drawn_img(img, theta_rho, color=(255, 255, 255)):
@@ -44,34 +68,45 @@ def get_drawn_img(img, theta_rho, color=(255, 255, 255)):
         b = math.sin(theta)
         x0 = a * rho
         y0 = b * rho
-        pt1 = (int(x0 + 1000 * (-b)), int(y0 + 1000 * (a)))
-        pt2 = (int(x0 - 1000 * (-b)), int(y0 - 1000 * (a)))
+        # The segment must cover the whole image, whose points are at most a diagonal away from (x0, y0)
+        extent = max(1000, int(math.hypot(*draw_img.shape[:2])) + 1)
+        pt1 = (int(x0 + extent * (-b)), int(y0 + extent * (a)))
+        pt2 = (int(x0 - extent * (-b)), int(y0 - extent * (a)))
         cv2.line(draw_img, pt1, pt2, color, 4, cv2.LINE_AA)
     return draw_img
 
 
-def get_slic(img, slic_params):
+def segment_bboxes(segments, n_segments, valid=None):
     """
-    Get the SLIC segmentation of an image.
+    Bounding boxes of the segments in a single scatter pass.
 
     Args:
-        img (numpy.ndarray): The input image.
-        slic_params (dict): Parameters for the SLIC segmentation.
+        segments (torch.Tensor): The (H, W) segment index of each pixel, in [0, n_segments).
+        n_segments (int): The number of segments.
+        valid (torch.Tensor): Optional (H, W) boolean mask of the pixels to consider.
 
     Returns:
-        numpy.ndarray: The SLIC segmentation.
+        tuple: (y0, y1, x0, x1) inclusive bounds, empty segments have y0 > y1.
     """
-    img = img.permute(1, 2, 0).cpu().numpy()
-    slic_params_cp = deepcopy(slic_params)
-    N = int(np.prod(img.shape[:-1]) * slic_params_cp.pop("percent"))
-    slic_params_cp["n_segments"] = N
-    slic = ski.segmentation.slic(img[:, :, :3], **slic_params_cp)
-    return slic
+    H, W = segments.shape
+    if valid is None:
+        ys, xs = torch.meshgrid(torch.arange(H), torch.arange(W), indexing="ij")
+        ys, xs, index = ys.flatten(), xs.flatten(), segments.flatten()
+    else:
+        ys, xs = torch.nonzero(valid, as_tuple=True)
+        index = segments[ys, xs]
+    y0 = torch.full((n_segments,), H).scatter_reduce(0, index, ys, "amin")
+    y1 = torch.full((n_segments,), -1).scatter_reduce(0, index, ys, "amax")
+    x0 = torch.full((n_segments,), W).scatter_reduce(0, index, xs, "amin")
+    x1 = torch.full((n_segments,), -1).scatter_reduce(0, index, xs, "amax")
+    return y0, y1, x0, x1
 
 
 def get_patches(img, weedmap, slic_map):
     """
-    Get the patches of the image based on the SLIC segmentation and their class
+    Get the patches of the image based on the SLIC segmentation and their class.
+    Class histograms and bounding boxes of all the segments are computed in a single
+    pass, only the segments that become patches are cropped.
 
     Args:
         img (numpy.ndarray): The input image.
@@ -79,49 +114,149 @@ def get_patches(img, weedmap, slic_map):
         slic_map (numpy.ndarray): The SLIC segmentation.
 
     Returns:
-        list: List of patches.
+        tuple: (SLIC weed map, list of (patch, label) tuples)
     """
     MIN_HEIGHT = 10
     MIN_WIDTH = 10
     MIN_PLANT_PERCENT = 0.1
-    patches = []
-    slic_map = torch.tensor(slic_map)
+    slic_map = torch.as_tensor(slic_map)
     weedmap = weedmap.argmax(dim=0).cpu()
-    weedmap_slic = torch.zeros_like(slic_map)
-    for i in np.unique(slic_map):
-        mask = slic_map == i
-        plant_mask = mask * weedmap
-        if plant_mask.sum() == 0:
-            continue
-        patch_mask = crop_to_nonzero(plant_mask)
-        min_size = (
-            patch_mask.shape[0] >= MIN_HEIGHT
-            and patch_mask.shape[1] >= MIN_WIDTH
-        )
-        values, counts = torch.unique(patch_mask, return_counts=True)
-        complete_counts = torch.zeros(3, dtype=int)
-        complete_counts[values] = counts
-        if values.sum() == 0:
-            continue
-        label = complete_counts[1:].argmax() + 1
-        min_percent = complete_counts[label] >= (MIN_PLANT_PERCENT * complete_counts.sum())
-        patch = crop_to_nonzero(mask * img)
-        weedmap_slic[plant_mask.bool()] = label
-        if min_size and min_percent:
-            patches.append((patch, label-1))
+    img = img.cpu()
+    segment_ids, segments = torch.unique(slic_map, return_inverse=True)
+    n_segments = len(segment_ids)
+    PROFILER.count("superpixels", n_segments)
+
+    # Class histogram, plant bbox and majority plant class of each segment
+    counts = torch.bincount(
+        (segments * 3 + weedmap).flatten(), minlength=n_segments * 3
+    ).reshape(n_segments, 3)
+    plants = weedmap > 0
+    y0, y1, x0, x1 = segment_bboxes(segments, n_segments, plants)
+    has_plants = counts[:, 1:].sum(dim=1) > 0
+    labels = counts[:, 1:].argmax(dim=1) + 1
+    heights, widths = y1 - y0 + 1, x1 - x0 + 1
+    min_size = (heights >= MIN_HEIGHT) & (widths >= MIN_WIDTH)
+    # The plant bbox includes the pixels of the other segments in the background count
+    min_percent = counts.gather(1, labels.unsqueeze(1)).squeeze(1) >= (
+        MIN_PLANT_PERCENT * heights * widths
+    )
+    weedmap_slic = torch.where(
+        plants, labels[segments], torch.zeros_like(slic_map)
+    ).type(slic_map.dtype)
+
+    # Patches are cropped to the nonzero pixels of the image in the segment
+    y0, y1, x0, x1 = segment_bboxes(segments, n_segments, (img != 0).any(dim=0))
+    patches = []
+    for i in torch.nonzero(has_plants & min_size & min_percent).flatten().tolist():
+        crop = (slice(y0[i], y1[i] + 1), slice(x0[i], x1[i] + 1))
+        patch = (segments[crop] == i) * img[:, crop[0], crop[1]]
+        patches.append((patch, labels[i] - 1))
     return weedmap_slic, patches
 
 
-def label_from_row(img, mask, row_image, slic_params=None):
-    conn_components = cv2.connectedComponents(mask.cpu().numpy().astype(np.uint8))[1]
-    conn_components = torch.tensor(conn_components)
-    row_crop_intersection = conn_components * row_image.bool()
-    crop_values = row_crop_intersection.unique()
-    if len(crop_values) == 1:
+def get_row_components(components, lines, tolerance=3, mode="pixels"):
+    """
+    Get the connected components crossed by at least one line, measuring the distance
+    |x cos(theta) + y sin(theta) - rho| from all the lines in one batched op.
+
+    Args:
+        components (torch.Tensor): The (H, W) connected components, 0 for background.
+        lines (torch.Tensor): The (L, 2) (rho, theta) lines, origin in the top left corner.
+        tolerance (float): Maximum distance in pixels from a line. 3 approximates the
+            4 px anti-aliased lines drawn by get_drawn_img.
+        mode (str): "pixels" measures the distance of every pixel of the components,
+            "bbox" of the bounding box of each component.
+
+    Returns:
+        torch.Tensor: The labels of the components on a row.
+    """
+    if len(lines) == 0:
+        return torch.tensor([], dtype=components.dtype, device=components.device)
+    lines = lines.to(components.device).float()
+    rhos = lines[:, 0]
+    cos_thetas = torch.cos(lines[:, 1])
+    sin_thetas = torch.sin(lines[:, 1])
+    ys, xs = torch.nonzero(components, as_tuple=True)
+    labels = components[ys, xs].long()
+    if mode == "pixels":
+        on_row = torch.zeros(len(xs), dtype=torch.bool, device=components.device)
+        chunk = max(1, PIXELS_PER_CHUNK // len(lines))
+        for start in range(0, len(xs), chunk):
+            x = xs[start : start + chunk, None].float()
+            y = ys[start : start + chunk, None].float()
+            distances = (x * cos_thetas + y * sin_thetas - rhos).abs()
+            on_row[start : start + chunk] = (distances <= tolerance).any(dim=1)
+        return labels[on_row].unique().type(components.dtype)
+    if mode == "bbox":
+        n_labels = int(components.max()) + 1
+        x0 = torch.full((n_labels,), components.shape[1], device=components.device)
+        y0 = torch.full((n_labels,), components.shape[0], device=components.device)
+        x0 = x0.scatter_reduce(0, labels, xs, "amin")
+        y0 = y0.scatter_reduce(0, labels, ys, "amin")
+        x1 = torch.zeros_like(x0).scatter_reduce(0, labels, xs, "amax")
+        y1 = torch.zeros_like(y0).scatter_reduce(0, labels, ys, "amax")
+        # Projections of the bbox corners on the normal of each line (n_labels, 4, L)
+        corners_x = torch.stack([x0, x0, x1, x1], dim=1).float().unsqueeze(2)
+        corners_y = torch.stack([y0, y1, y0, y1], dim=1).float().unsqueeze(2)
+        projections = corners_x * cos_thetas + corners_y * sin_thetas
+        on_row = (
+            (projections.amin(dim=1) <= rhos + tolerance)
+            & (projections.amax(dim=1) >= rhos - tolerance)
+        ).any(dim=1)
+        on_row &= torch.bincount(labels, minlength=n_labels) > 0
+        on_row[0] = False
+        return on_row.nonzero().flatten().type(components.dtype)
+    raise ValueError(f"Unknown row assignment mode {mode}")
+
+
+def label_from_row(
+    img,
+    mask,
+    row_image=None,
+    slic_params=None,
+    lines=None,
+    tolerance=3,
+    mode="pixels",
+    cache=None,
+    components=None,
+):
+    """
+    Label the plants of the mask: components on a crop row are crops, the others weeds.
+    Rows are given either drawn in row_image or as (rho, theta) lines, assigned
+    analytically with get_row_components.
+
+    Args:
+        img (torch.Tensor): The (C, H, W) input image.
+        mask (torch.Tensor): The (H, W) vegetation mask.
+        row_image (torch.Tensor): The (H, W) image with the rows drawn.
+        slic_params (dict): Parameters for the SLIC segmentation, None to skip it.
+        lines (torch.Tensor): The (L, 2) (rho, theta) rows, used when row_image is None.
+        tolerance (float): Maximum distance in pixels of a crop from a line.
+        mode (str): Assignment mode of get_row_components.
+        cache (StageCache): Cache of the SLIC segmentations.
+        components (torch.Tensor): The (H, W) connected components of the mask, e.g. of
+            a VegetationSegmentation, computed if None.
+
+    Returns:
+        tuple: (weed map, SLIC weed map, patches)
+    """
+    with PROFILER.span("row_assignment"):
+        if components is None:
+            components = cv2.connectedComponents(mask.cpu().numpy().astype(np.uint8))[1]
+        conn_components = torch.as_tensor(components).cpu()
+        if row_image is None:
+            crop_values = get_row_components(conn_components, lines, tolerance, mode)
+        else:
+            row_crop_intersection = conn_components * row_image.bool()
+            crop_values = row_crop_intersection.unique()
+            # Remove zeros
+            crop_values = crop_values[crop_values != 0]
+    PROFILER.count("crops", len(crop_values))
+    if len(crop_values) == 0:
         weedmap = torch.stack([~mask, torch.zeros_like(mask), mask])
-        return weedmap, *slic_label(img, slic_params, weedmap)
-    # Remove zeros
-    crop_values = crop_values[1:]
+        if slic_params is None:
+            return weedmap, None, []
+        return weedmap, *slic_label(img, slic_params, weedmap, cache)
     crop_mask = torch.isin(conn_components, crop_values)
     crops = conn_components * crop_mask
     weeds = conn_components * (~crop_mask)
@@ -129,13 +264,16 @@ def label_from_row(img, mask, row_image, slic_params=None):
     weedmap = torch.stack([background, crops, weeds])
     if slic_params is None:
         return weedmap, None, []
-    return weedmap, *slic_label(img, slic_params, weedmap)
+    return weedmap, *slic_label(img, slic_params, weedmap, cache)
 
 
 # TODO Rename this here and in `label_from_row`
-def slic_label(img, slic_params, weedmap):
-    slic = get_slic(img, slic_params)
-    weedmap_slic, patches = get_patches(img, weedmap, slic)
+def slic_label(img, slic_params, weedmap, cache=None):
+    with PROFILER.span("slic"):
+        slic = SuperpixelService(slic_params, cache)(img)
+    with PROFILER.span("patches"):
+        weedmap_slic, patches = get_patches(img, weedmap, slic)
+    PROFILER.count("patches", len(patches))
     return weedmap_slic, patches
 
 
@@ -150,15 +288,46 @@ def gt_defix(gt):
     return gt
 
 
-def load_and_label(outdir, param_file, interactive=True):
+def load_and_label(
+    outdir,
+    param_file,
+    interactive=True,
+    workers=1,
+    profile=False,
+    trace=False,
+    shard_index=0,
+    num_shards=1,
+):
     with open(param_file, "r") as f:
         params = yaml.safe_load(f)
     param_id = param_file.split("/")[-1].split(".")[0]
     outsubdir = os.path.join(outdir, param_id)
-    for _ in label(outsubdir, **params, interactive=interactive):
+    os.makedirs(outdir, exist_ok=True)
+    for _ in label(
+        outsubdir,
+        **params,
+        interactive=interactive,
+        workers=workers,
+        profile_path=f"{outdir}/{param_id}_profile.txt" if profile else None,
+        trace_path=f"{outdir}/{param_id}_trace.jsonl" if trace else None,
+        shard_index=shard_index,
+        num_shards=num_shards,
+    ):
         pass
 
 
+def load_and_merge(outdir, param_file):
+    """
+    Merge the shards of a load_and_label run, see merge_label_shards.
+    """
+    param_id = param_file.split("/")[-1].split(".")[0]
+    merge_label_shards(
+        os.path.join(outdir, param_id),
+        profile_path=f"{outdir}/{param_id}_profile.txt",
+        trace_path=f"{outdir}/{param_id}_trace.jsonl",
+    )
+
+
 def save_and_label(
     outdir,
     dataset_params,
@@ -166,10 +335,26 @@ def save_and_label(
     hough_detector_params,
     slic_params,
     interactive=False,
+    workers=1,
+    row_assignment_params=None,
+    cache_params=None,
+    patch_format="shards",
+    gt_format="index",
+    profile=False,
+    trace=False,
+    ortho_params=None,
 ):
-    now = datetime.now().strftime("%d-%m-%Y_%H:%M:%S")
-    hashid = hash(now)
-    hashid_8 = str(hashid)[-8:]
+    # Runs with the same parameters share (and resume) the same output directory
+    hashid_8 = get_label_params_hash(
+        dataset_params,
+        plant_detector_params,
+        hough_detector_params,
+        slic_params,
+        row_assignment_params,
+        patch_format,
+        gt_format,
+        ortho_params,
+    )[:8]
     outsubdir = os.path.join(outdir, hashid_8)
     os.makedirs(outdir, exist_ok=True)
 
@@ -180,6 +365,8 @@ def save_and_label(
             "plant_detector_params": plant_detector_params,
             "hough_detector_params": hough_detector_params,
             "slic_params": slic_params,
+            "row_assignment_params": row_assignment_params,
+            "ortho_params": ortho_params,
         },
     )
     yield from label(
@@ -189,84 +376,946 @@ def save_and_label(
         hough_detector_params,
         slic_params,
         interactive,
+        workers=workers,
+        row_assignment_params=row_assignment_params,
+        cache_params=cache_params,
+        patch_format=patch_format,
+        gt_format=gt_format,
+        profile_path=f"{outdir}/{hashid_8}_profile.txt" if profile else None,
+        trace_path=f"{outdir}/{hashid_8}_trace.jsonl" if trace else None,
+        ortho_params=ortho_params,
     )
 
 
-def label(
-    outdir,
-    dataset_params,
-    plant_detector_params,
-    hough_detector_params,
-    slic_params,
-    interactive=False,
+def get_detectors(
+    plant_detector_params, hough_detector_params, device=None, ortho_params=None
 ):
-    os.makedirs(outdir, exist_ok=True)
-    channels = ["R", "G", "B", "NIR", "RE"]
-    gt_outdir = os.path.join(outdir, "pseudogt")
-    gt_slic_outdir = os.path.join(outdir, "pseudogt_slic")
-    patches_outdir = os.path.join(outdir, "patches")
-    os.makedirs(patches_outdir, exist_ok=True)
-    os.makedirs(gt_outdir, exist_ok=True)
+    """
+    Vegetation and crop row detectors of a labelling run.
 
+    Args:
+        ortho_params (dict): If given, the rows are detected once per field on the
+            orthomosaic by an OrthoRowDetector with these root, patch_size, downscale
+            and refine_tolerance, and an optional hough_detector_params overriding
+            the ones of the patches.
+    """
     plant_detector = get_vegetation_detector(
-        plant_detector_params["name"], plant_detector_params["params"]
+        plant_detector_params["name"], plant_detector_params["params"], device=device
     )
+    if ortho_params is not None:
+        ortho_params = dict(ortho_params)
+        detector = HoughCropRowDetector(
+            **{**hough_detector_params, **ortho_params.pop("hough_detector_params", {})},
+            crop_detector=plant_detector,
+            device=device,
+        )
+        return plant_detector, OrthoRowDetector(
+            **ortho_params, channels=CHANNELS, row_detector=detector
+        )
     detector = HoughCropRowDetector(
         **hough_detector_params,
         crop_detector=plant_detector,
+        device=device,
     )
-    dataset = get_dataset(**dataset_params)
-    for i, (data_dict) in enumerate(tqdm(dataset)):
-        img = data_dict.image
-        gt = data_dict.target
-        mask = plant_detector(img)
-        result_dict = detector.predict_from_mask(mask)
-        lines = result_dict[HoughDetectorDict.LINES]
-        blank = mask.cpu().numpy().astype(np.uint8)
-        line_mask = get_drawn_img(
-            torch.zeros_like(torch.tensor(blank)).numpy(), lines, color=(255, 0, 255)
+    return plant_detector, detector
+
+
+def get_field(name):
+    """
+    Get the field of an image from its path: root/field/gt_folder/basename
+    """
+    return os.path.basename(os.path.dirname(os.path.dirname(name)))
+
+
+def get_ortho_patch_index(detector, name):
+    """
+    Index of a patch written by divide_ortho_into_patches from its path (.../{index}.png),
+    None if the rows are not detected on the orthomosaic.
+    """
+    if not isinstance(detector, OrthoRowDetector):
+        return None
+    return int(os.path.splitext(os.path.basename(name))[0])
+
+
+def get_image_key(name):
+    """
+    Key of an image in the manifest and in the profiler: field/basename
+    """
+    return f"{get_field(name)}/{os.path.basename(name)}"
+
+
+def get_stage_keys(
+    x, plant_detector_params, hough_detector_params, field=None, theta_prior=None
+):
+    """
+    Cache keys of the vegetation mask and of the crop rows of an input. Each key
+    depends on the content of the input and on the parameters of its stage and of
+    all the upstream ones.
+
+    Args:
+        x (torch.Tensor): The input of the vegetation detector (image or NDVI).
+        plant_detector_params (dict): Parameters of the vegetation detector.
+        hough_detector_params (dict): Parameters of the crop row detector.
+        field (str): The field of the input, the row angle prior depends on it.
+        theta_prior (float): The row angle prior of the field used by the crop row
+            detector, None if it was not learned yet.
+
+    Returns:
+        tuple: (mask key, rows key)
+    """
+    mask_key = hash_params("mask", hash_array(x), plant_detector_params)
+    # Rows found without a prior keep the keys they had before the prior existed
+    prior = () if theta_prior is None else (theta_prior,)
+    rows_key = hash_params("rows", mask_key, hough_detector_params, field, *prior)
+    return mask_key, rows_key
+
+
+def rows_to_cache(result_dict):
+    """
+    Cacheable outputs of a crop row detector result, without the mask cached upstream.
+    """
+    return {
+        key.value: value
+        for key, value in result_dict.items()
+        if key != HoughDetectorDict.CROP_MASK
+    }
+
+
+def rows_from_cache(outputs, mask):
+    """
+    Crop row detector result from its cached outputs and the mask.
+    """
+    result_dict = {HoughDetectorDict(key): value for key, value in outputs.items()}
+    result_dict[HoughDetectorDict.CROP_MASK] = mask
+    return result_dict
+
+
+def get_components(result_dict):
+    """
+    The (H, W) connected components of a crop row detector result, None if missing.
+    """
+    components = result_dict.get(HoughDetectorDict.COMPONENTS)
+    if components is None or components.numel() == 0:
+        return None
+    return components.reshape(components.shape[-2:]).cpu()
+
+
+def detect_rows(
+    img,
+    plant_detector,
+    detector,
+    field=None,
+    cache=None,
+    stage_params=None,
+    patch_index=None,
+):
+    """
+    Vegetation mask and crop rows of an image, read from the cache when available.
+    A computed mask is segmented in the same step and its connected components are
+    reused by the crop row detector and returned with the rows.
+
+    Args:
+        img (torch.Tensor): The (C, H, W) input image.
+        plant_detector: The vegetation detector.
+        detector: The crop row detector, or an OrthoRowDetector projecting the rows
+            of the field onto the image.
+        field (str): The field of the image.
+        cache (StageCache): The stage cache, None to always compute.
+        stage_params (tuple): (plant_detector_params, hough_detector_params) of the cache keys.
+        patch_index (int): Index of the image in the orthomosaic, for an OrthoRowDetector.
+
+    Returns:
+        tuple: (mask, result dict of the crop row detector)
+    """
+    segmentation = None
+
+    def detect_vegetation():
+        nonlocal segmentation
+        with PROFILER.span("vegetation"):
+            segmentation = plant_detector.segment(img)
+        return segmentation.mask
+
+    if cache is None:
+        mask = detect_vegetation()
+    else:
+        theta_prior = (
+            detector.get_theta_prior(field)
+            if isinstance(detector, HoughCropRowDetector)
+            else None
+        )
+        mask_key, rows_key = get_stage_keys(
+            img, *stage_params, field=field, theta_prior=theta_prior
+        )
+        mask = cache.cached(mask_key, lambda: {"mask": detect_vegetation()})["mask"]
+    if isinstance(detector, OrthoRowDetector):
+        # Projecting the rows of the field is cheaper than a cache lookup
+        with PROFILER.span("hough"):
+            result_dict = detector.predict_from_mask(mask, field, patch_index)
+        if segmentation is not None:
+            result_dict[HoughDetectorDict.COMPONENTS] = segmentation.components
+        return mask, result_dict
+    if cache is None:
+        return mask, detector.predict_from_mask(
+            mask, field=field, segmentation=segmentation
         )
-        argmask = mask[0].type(torch.uint8)
+    rows = cache.get(rows_key)
+    if rows is None:
+        rows = rows_to_cache(
+            detector.predict_from_mask(mask, field=field, segmentation=segmentation)
+        )
+        cache.put(rows_key, rows)
+    elif rows.get(HoughDetectorDict.COARSE_THETA.value) is not None:
+        # The cached coarse sweep still teaches the row angle prior of the field
+        detector.update_theta_prior(field, rows[HoughDetectorDict.COARSE_THETA.value])
+    return mask, rows_from_cache(rows, mask)
+
+
+def label_sample(
+    img,
+    plant_detector,
+    detector,
+    slic_params,
+    field=None,
+    row_assignment_params=None,
+    cache=None,
+    stage_params=None,
+    patch_index=None,
+):
+    """
+    Label a single image from its crop rows.
+
+    Args:
+        img (torch.Tensor): The (C, H, W) input image.
+        plant_detector: The vegetation detector.
+        detector: The crop row detector.
+        slic_params (dict): Parameters for the SLIC segmentation.
+        field (str): The field of the image, used by the row angle prior of the detector.
+        row_assignment_params (dict): If given, crops are assigned to the rows analytically
+            with these tolerance and mode (see get_row_components) instead of drawing the rows.
+        cache (StageCache): Cache of the vegetation mask, of the crop rows and of the
+            SLIC segmentation.
+        stage_params (tuple): (plant_detector_params, hough_detector_params) of the cache keys.
+        patch_index (int): Index of the image in the orthomosaic, for an OrthoRowDetector.
+
+    Returns:
+        tuple: (weed map, SLIC weed map, patches) where the maps contain the class indices.
+    """
+    mask, result_dict = detect_rows(
+        img, plant_detector, detector, field, cache, stage_params, patch_index
+    )
+    return label_rows(
+        img,
+        mask,
+        result_dict[HoughDetectorDict.LINES],
+        slic_params,
+        row_assignment_params,
+        cache,
+        get_components(result_dict),
+    )
+
+
+def label_rows(
+    img,
+    mask,
+    lines,
+    slic_params,
+    row_assignment_params=None,
+    cache=None,
+    components=None,
+):
+    """
+    Label an image from its vegetation mask and crop rows, the CPU heavy part of
+    label_sample (connected components, SLIC and patches).
+
+    Args:
+        img (torch.Tensor): The (C, H, W) input image.
+        mask (torch.Tensor): The (1, H, W) vegetation mask.
+        lines (torch.Tensor): The (L, 2) (rho, theta) crop rows.
+        slic_params (dict): Parameters for the SLIC segmentation.
+        row_assignment_params (dict): Analytic row assignment parameters, see label_sample.
+        cache (StageCache): Cache of the SLIC segmentation.
+        components (torch.Tensor): The (H, W) connected components of the mask, computed if None.
+
+    Returns:
+        tuple: (weed map, SLIC weed map, patches) where the maps contain the class indices.
+    """
+    argmask = mask[0].type(torch.uint8)
+    if row_assignment_params is not None:
         weed_map, weed_map_slic, patches = label_from_row(
             img,
             argmask,
-            torch.tensor(line_mask).permute(2, 0, 1)[0],
             slic_params=slic_params,
+            lines=lines,
+            cache=cache,
+            components=components,
+            **row_assignment_params,
         )
-        weed_map = weed_map.argmax(dim=0)
-        weed_map = weed_map.cpu().numpy().astype(np.uint8)
-        weed_map = map_grayscale_to_rgb(
-            weed_map, mapping={1: (0, 255, 0), 2: (255, 0, 0)}
-        ).transpose(2, 0, 1)
-        weed_map_slic = weed_map_slic.cpu().numpy().astype(np.uint8)
-        weed_map_slic = map_grayscale_to_rgb(
-            weed_map_slic, mapping={1: (0, 255, 0), 2: (255, 0, 0)}
-        ).transpose(2, 0, 1)
-        # RGB to BGR
-        weed_map = np.moveaxis(weed_map[[2, 1, 0], ::], 0, 2)
-        weed_map_slic = np.moveaxis(weed_map_slic[[2, 1, 0], ::], 0, 2)
-        path, basename = os.path.split(data_dict.name)
-        filename, _ = os.path.splitext(basename)
-        path, gt_folder = os.path.split(path)
-        path, field = os.path.split(path)
+        return weed_map.argmax(dim=0), weed_map_slic, patches
+    blank = mask.cpu().numpy().astype(np.uint8)
+    line_mask = get_drawn_img(
+        torch.zeros_like(torch.tensor(blank)).numpy(), lines, color=(255, 0, 255)
+    )
+    weed_map, weed_map_slic, patches = label_from_row(
+        img,
+        argmask,
+        torch.tensor(line_mask).permute(2, 0, 1)[0],
+        slic_params=slic_params,
+        cache=cache,
+        components=components,
+    )
+    return weed_map.argmax(dim=0), weed_map_slic, patches
+
+
+def save_sample(
+    outdir,
+    name,
+    weed_map,
+    weed_map_slic,
+    patches,
+    channels=CHANNELS,
+    patch_store=None,
+    gt_format="index",
+):
+    """
+    Write the pseudo GTs and the patches of a labelled image.
+
+    Args:
+        outdir (str): The output directory of the labelling run.
+        name (str): The path of the ground truth of the image in the dataset.
+        weed_map (torch.Tensor): The (H, W) weed map.
+        weed_map_slic (torch.Tensor): The (H, W) SLIC weed map.
+        patches (list): List of (patch, label) tuples.
+        channels (list): Names of the channels of the patches.
+        patch_store (PatchStoreWriter): Packed store of the patches, None to write
+            a PNG for each channel of each patch.
+        gt_format (str): Encoding of the pseudo GTs, see write_label_map.
+    """
+    gt_outdir = os.path.join(outdir, "pseudogt")
+    gt_slic_outdir = os.path.join(outdir, "pseudogt_slic")
+    patches_outdir = os.path.join(outdir, "patches")
+    basename = os.path.basename(name)
+    field = get_field(name)
+    with PROFILER.span("write"):
         os.makedirs(os.path.join(gt_outdir, field), exist_ok=True)
         os.makedirs(os.path.join(gt_slic_outdir, field), exist_ok=True)
-        for ch in channels + ["RGB"]:
-            os.makedirs(os.path.join(patches_outdir, field, ch), exist_ok=True)
-        for i, (patch, label) in enumerate(patches):
-            patch = (patch * 255).type(torch.uint8)
-            for j, ch in enumerate(channels):
-                patch_out_path = os.path.join(
-                    patches_outdir, field, ch, f"{filename}_{i}_{label}.png"
+        if patch_store is None:
+            for ch in channels + ["RGB"]:
+                os.makedirs(os.path.join(patches_outdir, field, ch), exist_ok=True)
+        written = []
+        for i, (patch, patch_label) in enumerate(patches):
+            patch = (patch * 255).type(torch.uint8).cpu().numpy()
+            if patch_store is not None:
+                patch_store.add(field, basename, i, int(patch_label), patch)
+                PROFILER.count("bytes_written", patch.nbytes)
+            else:
+                written += write_patch_pngs(
+                    patches_outdir,
+                    field,
+                    basename,
+                    i,
+                    int(patch_label),
+                    patch,
+                    channels,
                 )
-                cv2.imwrite(patch_out_path, patch[j].numpy())
-            patch_rgb_out_path = os.path.join(
-                patches_outdir, field, "RGB", f"{filename}_{i}_{label}.png"
-            )
-            cv2.imwrite(patch_rgb_out_path, np.moveaxis(patch[:3].numpy(), 0, 2))
         img_out_path = os.path.join(gt_outdir, field, basename)
         img_out_path_slic = os.path.join(gt_slic_outdir, field, basename)
-        cv2.imwrite(img_out_path, weed_map)
-        cv2.imwrite(img_out_path_slic, weed_map_slic)
-        if interactive:
-            yield i
+        write_label_map(img_out_path, weed_map, gt_format)
+        write_label_map(img_out_path_slic, weed_map_slic, gt_format)
+    if PROFILER.enabled:
+        written += [img_out_path, img_out_path_slic]
+        PROFILER.count("bytes_written", sum(os.path.getsize(path) for path in written))
+
+
+def read_sample(dataset, i):
+    """
+    Item i of the dataset, timed as the read stage of its image.
+    """
+    start = time.perf_counter()
+    data_dict = dataset[i]
+    PROFILER.add_time(
+        "read", time.perf_counter() - start, key=get_image_key(data_dict.name)
+    )
+    return data_dict
+
+
+# State of the labelling worker processes, set by _init_label_worker
+_worker_state = {}
+
+
+def _init_label_worker(
+    slic_params, row_assignment_params, cache, profile=False, detector_params=None
+):
+    # Each worker uses a single core, parallelism comes from the pool
+    torch.set_num_threads(1)
+    cv2.setNumThreads(1)
+    if profile:
+        PROFILER.enable()
+    _worker_state["slic_params"] = slic_params
+    _worker_state["row_assignment_params"] = row_assignment_params
+    _worker_state["cache"] = cache
+    if detector_params is not None:
+        plant_detector_params, hough_detector_params, device, ortho_params = detector_params
+        _worker_state["detectors"] = get_detectors(
+            plant_detector_params,
+            hough_detector_params,
+            device=device,
+            ortho_params=ortho_params,
+        )
+        _worker_state["stage_params"] = (plant_detector_params, hough_detector_params)
+
+
+def _label_worker(img, mask, lines, key=None, components=None):
+    # The profiler record of the image goes back to the main process with the outputs
+    with PROFILER.image(key):
+        outputs = label_rows(
+            img,
+            mask,
+            lines,
+            _worker_state["slic_params"],
+            _worker_state["row_assignment_params"],
+            _worker_state["cache"],
+            components,
+        )
+    return outputs, PROFILER.pop(key)
+
+
+def _detect_label_worker(img, name, key=None):
+    # Rows are detected by the worker with its own detectors, then labelled as in _label_worker
+    plant_detector, detector = _worker_state["detectors"]
+    with PROFILER.image(key):
+        outputs = label_sample(
+            img,
+            plant_detector,
+            detector,
+            _worker_state["slic_params"],
+            field=get_field(name),
+            row_assignment_params=_worker_state["row_assignment_params"],
+            cache=_worker_state["cache"],
+            stage_params=_worker_state["stage_params"],
+            patch_index=get_ortho_patch_index(detector, name),
+        )
+    return outputs, PROFILER.pop(key)
+
+
+def detects_in_workers(detector, device):
+    """
+    Whether label_pipeline detects the rows in its label processes: on CPU detection
+    is parallelized with the labelling, on another device it runs in the main process.
+    Detectors learning a row angle prior per field keep detecting in the main process,
+    so that the prior follows the order of the dataset.
+    """
+    learns_prior = (
+        isinstance(detector, HoughCropRowDetector)
+        and detector.theta_prior_patches is not None
+    )
+    return get_device(device) == "cpu" and not learns_prior
+
+
+def label_pipeline(
+    outdir,
+    dataset,
+    plant_detector,
+    detector,
+    slic_params,
+    row_assignment_params=None,
+    cache=None,
+    stage_params=None,
+    patch_store=None,
+    gt_format="index",
+    workers=2,
+    io_workers=None,
+    queue_size=None,
+    detector_params=None,
+):
+    """
+    Label the dataset with a staged pipeline: a thread pool prefetches the images,
+    the main process detects the rows (on the device of the detectors), a process
+    pool runs label_rows and the thread pool encodes and writes the outputs.
+    With detector_params the process pool detects the rows too, so that detection
+    scales with the number of processes on CPU.
+    Stages are connected by FIFO queues of at most queue_size images, so memory
+    does not grow with the dataset and the images complete in dataset order.
+
+    Args:
+        outdir (str): The output directory of the labelling run.
+        dataset: The dataset to label.
+        workers (int): Number of label_rows processes.
+        io_workers (int): Number of read and write threads, workers by default.
+        queue_size (int): Maximum number of images waiting in each stage, 2 * workers by default.
+        detector_params (tuple): (plant_detector_params, hough_detector_params, device,
+            ortho_params) of the detectors built by each process (see get_detectors),
+            None to detect the rows in the main process with plant_detector and detector.
+
+    Yields:
+        int: The index of each labelled image, in order.
+    """
+    io_workers = io_workers or workers
+    queue_size = queue_size or 2 * workers
+    reads, labels, writes = deque(), deque(), deque()
+    io_pool = ThreadPoolExecutor(io_workers)
+    label_pool = ProcessPoolExecutor(
+        workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_label_worker,
+        initargs=(
+            slic_params,
+            row_assignment_params,
+            cache,
+            PROFILER.enabled,
+            detector_params,
+        ),
+    )
+
+    def drain(queue, full):
+        # Pop the completed (or, when the queue is full, the oldest) heads of a stage
+        while queue and (queue[0][-1].done() or len(queue) >= full):
+            yield queue.popleft()
+
+    def write(name, outputs):
+        with PROFILER.image(get_image_key(name)):
+            save_sample(
+                outdir, name, *outputs, patch_store=patch_store, gt_format=gt_format
+            )
+
+    def submit_write(name, label_future):
+        outputs, record = label_future.result()
+        PROFILER.add_record(get_image_key(name), record)
+        return io_pool.submit(write, name, outputs)
+
+    with io_pool, label_pool:
+        for i in range(min(queue_size, len(dataset))):
+            reads.append(io_pool.submit(read_sample, dataset, i))
+        for i in range(len(dataset)):
+            data_dict = reads.popleft().result()
+            if i + queue_size < len(dataset):
+                reads.append(io_pool.submit(read_sample, dataset, i + queue_size))
+            key = get_image_key(data_dict.name)
+            if detector_params is not None:
+                labels.append(
+                    (
+                        i,
+                        data_dict.name,
+                        label_pool.submit(
+                            _detect_label_worker,
+                            data_dict.image.cpu(),
+                            data_dict.name,
+                            key,
+                        ),
+                    )
+                )
+            else:
+                with PROFILER.image(key):
+                    mask, result_dict = detect_rows(
+                        data_dict.image,
+                        plant_detector,
+                        detector,
+                        get_field(data_dict.name),
+                        cache,
+                        stage_params,
+                        get_ortho_patch_index(detector, data_dict.name),
+                    )
+                labels.append(
+                    (
+                        i,
+                        data_dict.name,
+                        label_pool.submit(
+                            _label_worker,
+                            data_dict.image.cpu(),
+                            mask.cpu(),
+                            result_dict[HoughDetectorDict.LINES].cpu(),
+                            key,
+                            get_components(result_dict),
+                        ),
+                    )
+                )
+            for j, name, future in drain(labels, queue_size):
+                writes.append((j, submit_write(name, future)))
+            for j, future in drain(writes, queue_size):
+                future.result()
+                yield j
+        for j, name, future in drain(labels, 1):
+            writes.append((j, submit_write(name, future)))
+        for j, future in drain(writes, 1):
+            future.result()
+            yield j
+
+
+def get_label_params_hash(
+    dataset_params,
+    plant_detector_params,
+    hough_detector_params,
+    slic_params,
+    row_assignment_params=None,
+    patch_format="shards",
+    gt_format="index",
+    ortho_params=None,
+):
+    """
+    Stable hash of the parameters of a labelling run. The fields are excluded, so that
+    runs on more fields share the outputs of the fields already labelled.
+    """
+    dataset_params = {k: v for k, v in dataset_params.items() if k != "fields"}
+    return hash_params(
+        dataset_params,
+        plant_detector_params,
+        hough_detector_params,
+        slic_params,
+        row_assignment_params,
+        patch_format,
+        gt_format,
+        ortho_params,
+    )
+
+
+def remove_png_patches(patches_outdir, field, sources):
+    """
+    Remove the PNG patches of some source images of a field, written as
+    {stem}_{index}_{label}.png
+    """
+    stems = {os.path.splitext(source)[0] for source in sources}
+    pattern = re.compile(r"(.*)_\d+_\d+\.png")
+    field_dir = os.path.join(patches_outdir, field)
+    if not stems or not os.path.isdir(field_dir):
+        return
+    for ch in os.listdir(field_dir):
+        for filename in os.listdir(os.path.join(field_dir, ch)):
+            match = pattern.fullmatch(filename)
+            if match and match.group(1) in stems:
+                os.remove(os.path.join(field_dir, ch, filename))
+
+
+def label(
+    outdir,
+    dataset_params,
+    plant_detector_params,
+    hough_detector_params,
+    slic_params,
+    interactive=False,
+    workers=1,
+    device=None,
+    row_assignment_params=None,
+    cache_params=None,
+    patch_format="shards",
+    gt_format="index",
+    checkpoint_every=CHECKPOINT_EVERY,
+    profile_path=None,
+    trace_path=None,
+    ortho_params=None,
+    shard_index=0,
+    num_shards=1,
+):
+    """
+    Label the dataset writing the pseudo GTs and the patches in outdir.
+    A manifest in outdir records the parameters hash and the content hash of each
+    labelled image: images already labelled with the same parameters and content
+    are skipped, so interrupted runs resume and new fields are labelled alone.
+
+    With num_shards > 1 the run labels only the images of shard shard_index (see
+    get_shard), so that the shards can run on different nodes. Each shard writes
+    the pseudo GTs in the shared layout and its manifest, patch store and profile
+    in parts (see get_part_path), combined by merge_label_shards.
+
+    Args:
+        workers (int): Number of processes. When greater than 1 the images are
+            labelled by label_pipeline, with workers label_rows processes.
+        device (str): Device of the detectors.
+        row_assignment_params (dict): Tolerance and mode of the analytic assignment
+            of the crops to the rows, None to draw the rows (see label_sample).
+        cache_params (dict): root and max_bytes of a StageCache of the vegetation
+            masks and crop rows, so that runs changing only downstream parameters
+            skip the detection.
+        patch_format (str): "shards" packs the patches in a PatchStoreWriter in
+            outdir/patches, "png" writes a PNG for each channel of each patch
+            (the layout of selfweed.data.patch_store.export_patches). The store is
+            compacted at the end of the run when the patches of the images labelled
+            again take more than COMPACT_DEAD_SHARE of its bytes.
+        gt_format (str): "index" writes the pseudo GTs as single channel class
+            indices, "rgb" as the colored WeedMap ground truths. Both are read by
+            WeedMapDataset and PseudoModel.
+        checkpoint_every (int): Number of images between two writes of the manifest
+            and of the patch index.
+        profile_path (str): If given, the stages of each image are timed and counted
+            by PROFILER and the summary table of the run is written here.
+        trace_path (str): If given, the stages are profiled and the JSONL trace of
+            the timings and counters of each image is written here.
+        ortho_params (dict): If given, the rows are detected once per field on its
+            orthomosaic and projected onto the patches, named {index}.png as written
+            by divide_ortho_into_patches (see get_detectors).
+        shard_index (int): Index of the shard labelled by this run.
+        num_shards (int): Number of shards of the dataset.
+
+    Yields:
+        int: The number of labelled images minus one, if interactive.
+    """
+    if patch_format not in ("shards", "png"):
+        raise ValueError(f"Unknown patch format {patch_format}")
+    if gt_format not in GT_FORMATS:
+        raise ValueError(f"Unknown gt format {gt_format}")
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"Shard index {shard_index} not in [0, {num_shards})")
+    os.makedirs(outdir, exist_ok=True)
+    os.makedirs(os.path.join(outdir, "patches"), exist_ok=True)
+    os.makedirs(os.path.join(outdir, "pseudogt"), exist_ok=True)
+
+    def part(path):
+        if path is None or num_shards == 1:
+            return path
+        return get_part_path(path, shard_index, num_shards)
+
+    dataset = get_dataset(**dataset_params)
+    params_hash = get_label_params_hash(
+        dataset_params,
+        plant_detector_params,
+        hough_detector_params,
+        slic_params,
+        row_assignment_params,
+        patch_format,
+        gt_format,
+        ortho_params,
+    )
+    manifest_path = os.path.join(outdir, MANIFEST_FILE)
+    manifest = Manifest(part(manifest_path), params_hash)
+    # Images labelled by this shard, or by any shard of a merged run
+    labelled = {**Manifest(manifest_path, params_hash).entries, **manifest.entries}
+    keys = [f"{field}/{filename}" for field, filename in dataset.index]
+    shard = [
+        i for i, key in enumerate(keys) if get_shard(key, num_shards) == shard_index
+    ]
+    # Only the images of the shard are read, so each node hashes 1 / num_shards of the dataset
+    content_hashes = {
+        i: hash_files(dataset.get_image_paths(*dataset.index[i])) for i in shard
+    }
+    todo = [i for i in shard if labelled.get(keys[i]) != content_hashes[i]]
+    # Not only the changed images: an interrupted run can leave patches of images
+    # missing from the manifest, written before their entry was flushed
+    relabelled = {dataset.index[i] for i in todo}
+    n_skipped = len(shard) - len(todo)
+    if n_skipped > 0:
+        print(f"Skipping {n_skipped} images already labelled in {outdir}")
+
+    patch_store = (
+        PatchStoreWriter(
+            part(os.path.join(outdir, "patches")),
+            CHANNELS,
+            mode="w" if manifest.reset else "a",
+        )
+        if patch_format == "shards"
+        else nullcontext()
+    )
+    profile_path, trace_path = part(profile_path), part(trace_path)
+    profile = profile_path is not None or trace_path is not None
+    if profile:
+        PROFILER.enable(trace_path)
+    try:
+        with patch_store as patch_store:
+            # Images to label are labelled again from scratch
+            if patch_store is not None:
+                patch_store.remove(relabelled)
+            else:
+                for field in {field for field, _ in relabelled}:
+                    remove_png_patches(
+                        os.path.join(outdir, "patches"),
+                        field,
+                        {filename for f, filename in relabelled if f == field},
+                    )
+            done = _label(
+                outdir,
+                Subset(dataset, todo),
+                plant_detector_params,
+                hough_detector_params,
+                slic_params,
+                workers,
+                device,
+                row_assignment_params,
+                cache_params,
+                patch_store,
+                gt_format,
+                ortho_params,
+            )
+            for n, j in enumerate(done):
+                manifest.add(keys[todo[j]], content_hashes[todo[j]])
+                PROFILER.finish(keys[todo[j]])
+                if (n + 1) % checkpoint_every == 0:
+                    if patch_store is not None:
+                        patch_store.flush()
+                    manifest.flush()
+                if interactive:
+                    yield n_skipped + n
+        if patch_format == "shards":
+            # Patches of the images labelled again are left in the shards until then
+            compact_patch_store(
+                part(os.path.join(outdir, "patches")), COMPACT_DEAD_SHARE
+            )
+    finally:
+        # After the patch store is closed, so that the manifest never lists missing patches
+        manifest.flush()
+        if profile_path is not None:
+            PROFILER.write_summary(profile_path)
+            if num_shards > 1:
+                with open(get_totals_path(profile_path), "w") as f:
+                    json.dump(PROFILER.get_totals(), f)
+        if profile:
+            PROFILER.disable()
+
+
+def get_shard(key, num_shards):
+    """
+    Shard of an image from a stable hash of its key, independent of the order and
+    of the other images of the dataset.
+    """
+    return int(hashlib.sha1(key.encode()).hexdigest(), 16) % num_shards
+
+
+def get_part_path(path, shard_index, num_shards):
+    """
+    Path of the part of a shard of an output: name.ext -> name.part-i-of-n.ext
+    """
+    stem, ext = os.path.splitext(path)
+    return f"{stem}.part-{shard_index:03d}-of-{num_shards:03d}{ext}"
+
+
+def get_parts(path):
+    """
+    Existing parts of an output written by the shards of a run.
+    """
+    stem, ext = os.path.splitext(path)
+    return sorted(glob.glob(f"{glob.escape(stem)}.part-*-of-*{ext}"))
+
+
+def get_totals_path(profile_path):
+    return f"{os.path.splitext(profile_path)[0]}.json"
+
+
+def merge_label_shards(outdir, profile_path=None, trace_path=None):
+    """
+    Combine the parts written by the shards of a labelling run in outdir: the
+    manifests, the patch stores and, if given the paths of the run, the profiles
+    and the traces. Images labelled by the shards replace their previous outputs.
+    The shards must have been run with the same parameters.
+
+    Args:
+        outdir (str): The output directory of the labelling run.
+        profile_path (str): The summary table of the run, merged from the totals of
+            the profiled shards (the wall time is the one of the slowest shard).
+        trace_path (str): The JSONL trace of the run, concatenation of the traces
+            of the shards.
+    """
+    manifest_path = os.path.join(outdir, MANIFEST_FILE)
+    manifest_parts = get_parts(manifest_path)
+    if not manifest_parts:
+        print(f"No shards to merge in {outdir}")
+        return
+    parts = []
+    for path in manifest_parts:
+        with open(path) as f:
+            parts.append(json.load(f))
+    params_hashes = {part["params"] for part in parts}
+    if len(params_hashes) > 1:
+        raise ValueError(f"Shards of {outdir} have different parameters")
+    manifest = Manifest(manifest_path, params_hashes.pop())
+    entries = {key: value for part in parts for key, value in part["entries"].items()}
+    store_parts = get_parts(os.path.join(outdir, "patches"))
+    if store_parts:
+        merge_patch_stores(
+            os.path.join(outdir, "patches"),
+            store_parts,
+            CHANNELS,
+            sources={tuple(key.split("/", 1)) for key in entries},
+            mode="w" if manifest.reset else "a",
+        )
+    # After the patch store, so that the manifest never lists missing patches
+    manifest.entries.update(entries)
+    manifest.flush()
+    for path in manifest_parts:
+        os.remove(path)
+
+    if profile_path is not None:
+        totals_parts = get_parts(get_totals_path(profile_path))
+        if totals_parts:
+            profiler = Profiler()
+            wall_time = 0
+            for path in totals_parts:
+                with open(path) as f:
+                    totals = json.load(f)
+                profiler.add_totals(totals)
+                wall_time = max(wall_time, totals["wall_time"])
+            profiler.write_summary(profile_path, wall_time=wall_time)
+            for path in totals_parts + get_parts(profile_path):
+                os.remove(path)
+    if trace_path is not None:
+        trace_parts = get_parts(trace_path)
+        if trace_parts:
+            with open(trace_path, "a") as trace:
+                for path in trace_parts:
+                    with open(path) as f:
+                        shutil.copyfileobj(f, trace)
+                    os.remove(path)
+
+
+def _label(
+    outdir,
+    dataset,
+    plant_detector_params,
+    hough_detector_params,
+    slic_params,
+    workers,
+    device,
+    row_assignment_params,
+    cache_params,
+    patch_store,
+    gt_format,
+    ortho_params,
+):
+    plant_detector, detector = get_detectors(
+        plant_detector_params,
+        hough_detector_params,
+        device=device,
+        ortho_params=ortho_params,
+    )
+    cache = StageCache(**cache_params) if cache_params else None
+    if workers > 1:
+        done = label_pipeline(
+            outdir,
+            dataset,
+            plant_detector,
+            detector,
+            slic_params,
+            row_assignment_params=row_assignment_params,
+            cache=cache,
+            stage_params=(plant_detector_params, hough_detector_params),
+            patch_store=patch_store,
+            gt_format=gt_format,
+            workers=workers,
+            detector_params=(
+                plant_detector_params, hough_detector_params, device, ortho_params
+            )
+            if detects_in_workers(detector, device)
+            else None,
+        )
+        yield from tqdm(done, total=len(dataset))
+        return
+
+    for i in tqdm(range(len(dataset))):
+        data_dict = read_sample(dataset, i)
+        with PROFILER.image(get_image_key(data_dict.name)):
+            weed_map, weed_map_slic, patches = label_sample(
+                data_dict.image,
+                plant_detector,
+                detector,
+                slic_params,
+                field=get_field(data_dict.name),
+                row_assignment_params=row_assignment_params,
+                cache=cache,
+                stage_params=(plant_detector_params, hough_detector_params),
+                patch_index=get_ortho_patch_index(detector, data_dict.name),
+            )
+            save_sample(
+                outdir,
+                data_dict.name,
+                weed_map,
+                weed_map_slic,
+                patches,
+                patch_store=patch_store,
+                gt_format=gt_format,
+            )
+        yield i
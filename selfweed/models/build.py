@@ -1,3 +1,5 @@
+from selfweed.cache import StageCache
+from selfweed.superpixels import SuperpixelService
 from selfweed.detector import HoughCropRowDetector, get_vegetation_detector
 from selfweed.models.pseudo import PseudoModel
 from selfweed.models.rowweeder import RowWeeder
@@ -106,6 +108,8 @@ def build_resnet50(
     plant_detector_params,
     slic_params,
     internal_batch_size=1,
+    cache_params=None,
+    slic_workers=1,
 ):
     classification_model = HuggingFaceClassificationWrapper(ResNetForImageClassification.from_pretrained(
         "microsoft/resnet-50",
@@ -116,19 +120,32 @@ def build_resnet50(
     plant_detector = get_vegetation_detector(
         plant_detector_params["name"], plant_detector_params["params"]
     )
-    return HoughSLICSegmentationWrapper(classification_model, plant_detector, slic_params, internal_batch_size=internal_batch_size)
+    superpixels = SuperpixelService(
+        slic_params,
+        cache=StageCache(**cache_params) if cache_params else None,
+        workers=slic_workers,
+    )
+    return HoughSLICSegmentationWrapper(classification_model, plant_detector, slic_params, internal_batch_size=internal_batch_size, superpixels=superpixels)
 
 
 def build_houghcc(
     input_channels,
     plant_detector_params,
     hough_detector_params,
+    row_assignment_params=None,
+    cache_params=None,
 ):
     plant_detector = get_vegetation_detector(
         plant_detector_params["name"], plant_detector_params["params"]
     )
     hough_detector = HoughCropRowDetector(**hough_detector_params)
-    return HoughCC(plant_detector=plant_detector, hough_detector=hough_detector)
+    return HoughCC(
+        plant_detector=plant_detector,
+        hough_detector=hough_detector,
+        row_assignment_params=row_assignment_params,
+        cache=StageCache(**cache_params) if cache_params else None,
+        stage_params=(plant_detector_params, hough_detector_params),
+    )
 
 
 def build_houghslic(
@@ -136,12 +153,19 @@ def build_houghslic(
     plant_detector_params,
     hough_detector_params,
     slic_params,
+    cache_params=None,
+    slic_workers=1,
 ):
     plant_detector = get_vegetation_detector(
         plant_detector_params["name"], plant_detector_params["params"]
     )
     hough_detector = HoughCropRowDetector(**hough_detector_params)
-    return HoughSLIC(plant_detector=plant_detector, hough_detector=hough_detector, slic_params=slic_params)
+    superpixels = SuperpixelService(
+        slic_params,
+        cache=StageCache(**cache_params) if cache_params else None,
+        workers=slic_workers,
+    )
+    return HoughSLIC(plant_detector=plant_detector, hough_detector=hough_detector, slic_params=slic_params, superpixels=superpixels)
 
 def build_pseudo_gt_model(
     gt_folder
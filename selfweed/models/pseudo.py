@@ -1,6 +1,6 @@
 import os
 import torch
-import torchvision
+from selfweed.data.utils import read_label_map
 from selfweed.data.weedmap import WeedMapDataset
 from selfweed.models.utils import ModelOutput
 
@@ -20,7 +20,8 @@ class PseudoModel(torch.nn.Module):
             img_name = os.path.basename(n)
             field = os.path.basename(os.path.dirname(os.path.dirname(n)))
             img_path = os.path.join(self.gt_folder, field, img_name)
-            gt = torchvision.io.read_image(img_path)
-            gt = gt[[2, 1, 0], ::].bool().float()
+            gt = read_label_map(img_path)
+            gt = torch.nn.functional.one_hot(gt, len(WeedMapDataset.id2class))
+            gt = gt.permute(2, 0, 1).float()
             pseudo_gts.append(gt)
         return ModelOutput(logits=torch.stack(pseudo_gts).to(self._get_device()), scores=None)
@@ -90,15 +90,10 @@ class RowWeeder(nn.Module):
         )
         self.decoder = nn.ModuleList(decoder_layers)
 
-    def _encode_plants(self, plants):
-        if plants is None:
-            return None
-        plants, flags = plants
-        b = plants.shape[0]
-        if flags.sum() == 0:
-            return None
-        plants = rearrange(plants, "b n c h w -> (b n) c h w")
-
+    def _encode_plant_crops(self, plants):
+        """
+        Embeddings of each layer of the plant encoder of (N, C, H, W) plant crops, as (N, E) tensors
+        """
         # Ensure min plant size
         H, W = plants.shape[-2:]
         if H < self.min_plant_size or W < self.min_plant_size:
@@ -124,14 +119,45 @@ class RowWeeder(nn.Module):
                     plants_features, self.embedding_size[:2]
                 )
                 plants_embedding = rearrange(
-                    plants_embedding, "(b n) h w c -> (b n) (h w c)", b=b
+                    plants_embedding, "n h w c -> n (h w c)"
                 )
             else:
                 plants_embedding = plants_features.mean(dim=(2, 3))
-            plants_embedding = rearrange(plants_embedding, "(b n) c -> b n c", b=b)
             plants_pyramid_features.append(plants_embedding)
         return plants_pyramid_features
 
+    def _encode_plant_buckets(self, buckets):
+        """
+        Plants bucketed by size (see data.utils.bucket_patches), each bucket is encoded
+        on its own and the embeddings are put back in batch order, as a (1, N, E)
+        sequence of all the plants of the batch for each layer
+        """
+        buckets = [(plants, positions) for plants, positions in buckets if len(positions) > 0]
+        if not buckets:
+            return None
+        features = [self._encode_plant_crops(plants) for plants, _ in buckets]
+        order = torch.cat([positions for _, positions in buckets]).argsort()
+        return [
+            torch.cat(layer_features)[order].unsqueeze(0)
+            for layer_features in zip(*features)
+        ]
+
+    def _encode_plants(self, plants):
+        if plants is None:
+            return None
+        if len(plants) == 0 or not torch.is_tensor(plants[0]):
+            # List of [plants, positions] buckets
+            return self._encode_plant_buckets(plants)
+        plants, flags = plants
+        b = plants.shape[0]
+        if flags.sum() == 0:
+            return None
+        plants = rearrange(plants, "b n c h w -> (b n) c h w")
+        return [
+            rearrange(plants_embedding, "(b n) c -> b n c", b=b)
+            for plants_embedding in self._encode_plant_crops(plants)
+        ]
+
     def _get_scores(self, crop_features, weed_features, i, batch_size, device):
         normalized_crops_embeddings = normalize(
             self.crop_embeddings[i].weight, p=2, dim=-1
@@ -7,19 +7,35 @@ import torchvision.transforms.functional as FV
 
 from selfweed.data.utils import DataDict, crop_to_nonzero
 from selfweed.detector import HoughDetectorDict
-from selfweed.labeling import get_drawn_img, get_slic, label_from_row
+from selfweed.labeling import (
+    get_components,
+    get_drawn_img,
+    get_row_components,
+    get_stage_keys,
+    label_from_row,
+    rows_from_cache,
+    rows_to_cache,
+)
 from selfweed.models.utils import ModelOutput
+from selfweed.superpixels import SuperpixelService
 
 class HoughSLICSegmentationWrapper(nn.Module):
     classificator_size = (224, 224)
-    def __init__(self, classification_model, plant_detector, slic_params, use_ndvi=True, internal_batch_size=1) -> None:
+    def __init__(self, classification_model, plant_detector, slic_params, use_ndvi=True, internal_batch_size=1, superpixels=None) -> None:
         super().__init__()
         self.model = classification_model
         self.plant_detector = plant_detector
         self.slic_params = slic_params
+        self.superpixels = superpixels or SuperpixelService(slic_params)
         self.use_ndvi = use_ndvi
         self.internal_batch_size = internal_batch_size
         self.__repr__ = f"HoughSlicWrapper:\n{self.model.__repr__}"
+
+    def close(self):
+        """
+        Stop the worker processes of the superpixels
+        """
+        self.superpixels.close()
         
     def segment(self, image, mask, slic):
         weedmap = mask.clone().long()
@@ -41,9 +57,10 @@ class HoughSLICSegmentationWrapper(nn.Module):
             return self.model(image)
         B, _, H, W = image.shape
         segmentations = []
+        slics = self.superpixels.batch(image)
         for i in range(image.shape[0]):
             mask = self.plant_detector(ndvi=ndvi[i])[0]
-            slic = torch.tensor(get_slic(image[i], self.slic_params), device=mask.device)
+            slic = torch.tensor(slics[i], device=mask.device)
             segmentations.append(self.segment(image[i], mask, slic))
         return ModelOutput(logits=torch.cat(segmentations), scores=None)
 
@@ -52,41 +69,77 @@ class HoughSLICSegmentationWrapper(nn.Module):
     
     
 class HoughCC(nn.Module):
-    def __init__(self, hough_detector, plant_detector, use_ndvi=True) -> None:
+    def __init__(self, hough_detector, plant_detector, use_ndvi=True, row_assignment_params=None, cache=None, stage_params=None) -> None:
         super().__init__()
         self.hough_detector = hough_detector
         self.plant_detector = plant_detector
         self.use_ndvi = use_ndvi
+        self.row_assignment_params = row_assignment_params
+        self.cache = cache
+        self.stage_params = stage_params
         self.__repr__ = f"HoughCC:\n{self.hough_detector.__repr__}"
         
-    def segment(self, image, mask):
-        result_dict = self.hough_detector.predict_from_mask(mask)
+    def segment(self, image, mask, result_dict=None):
+        if result_dict is None:
+            result_dict = self.hough_detector.predict_from_mask(mask)
         lines = result_dict[HoughDetectorDict.LINES]
-        conn_components = cv2.connectedComponents(mask[0].cpu().numpy().astype(np.uint8))[1]
-        conn_components = torch.tensor(conn_components)
-        blank = mask.cpu().numpy().astype(np.uint8)
-        line_mask = get_drawn_img(
-            torch.zeros_like(torch.tensor(blank)).numpy(), lines, color=(255, 0, 255)
-        )
-        row_image = torch.tensor(line_mask).permute(2, 0, 1)[0]
-        row_crop_intersection = conn_components * row_image.bool()
-        crop_values = row_crop_intersection.unique()
-        if len(crop_values) == 1:
+        # Components of the row detection, labelled again only if it found none
+        conn_components = get_components(result_dict)
+        if conn_components is None:
+            conn_components = cv2.connectedComponents(mask[0].cpu().numpy().astype(np.uint8))[1]
+            conn_components = torch.tensor(conn_components)
+        if self.row_assignment_params is not None:
+            crop_values = get_row_components(
+                conn_components, lines, **self.row_assignment_params
+            )
+        else:
+            blank = mask.cpu().numpy().astype(np.uint8)
+            line_mask = get_drawn_img(
+                torch.zeros_like(torch.tensor(blank)).numpy(), lines, color=(255, 0, 255)
+            )
+            row_image = torch.tensor(line_mask).permute(2, 0, 1)[0]
+            row_crop_intersection = conn_components * row_image.bool()
+            crop_values = row_crop_intersection.unique()
+            # Remove zeros
+            crop_values = crop_values[crop_values != 0]
+        if len(crop_values) == 0:
             return torch.cat([~mask, torch.zeros_like(mask), mask])
-        # Remove zeros
-        crop_values = crop_values[1:]
         crop_mask = torch.isin(conn_components, crop_values)
         crops = conn_components * crop_mask
         weeds = conn_components * (~crop_mask)
         background = conn_components == 0
         return torch.stack([background, crops, weeds]).float().to(mask.device)
 
+    def detect_rows(self, ndvi):
+        """
+        Vegetation masks and crop rows of a batch, only the images missing in the cache are processed
+        """
+        if self.cache is None:
+            masks = self.plant_detector(ndvi=ndvi)[0]
+            return masks, self.hough_detector.predict_batch(masks)
+        keys = [get_stage_keys(x, *self.stage_params) for x in ndvi]
+        masks = self.cache.cached_batch(
+            [mask_key for mask_key, _ in keys],
+            lambda missing: [
+                {"mask": mask} for mask in self.plant_detector(ndvi=ndvi[missing])[0]
+            ],
+        )
+        masks = torch.stack([mask["mask"].to(ndvi.device) for mask in masks])
+        rows = self.cache.cached_batch(
+            [rows_key for _, rows_key in keys],
+            lambda missing: [
+                rows_to_cache(result_dict)
+                for result_dict in self.hough_detector.predict_batch(masks[missing])
+            ],
+        )
+        return masks, [rows_from_cache(row, mask) for row, mask in zip(rows, masks)]
+
     def forward(self, image, ndvi=None):
         B, _, H, W = image.shape
-        segmentations = []
-        for i in range(image.shape[0]):
-            mask = self.plant_detector(ndvi=ndvi[i])[0]
-            segmentations.append(self.segment(image[i], mask))
+        masks, result_dicts = self.detect_rows(ndvi)
+        segmentations = [
+            self.segment(image[i], masks[i], result_dicts[i]) for i in range(B)
+        ]
         return ModelOutput(logits=torch.cat(segmentations), scores=None)
 
     def get_learnable_params(self, train_params):
@@ -94,13 +147,20 @@ class HoughCC(nn.Module):
     
     
 class HoughSLIC(nn.Module):
-    def __init__(self, hough_detector, plant_detector, slic_params, use_ndvi=True) -> None:
+    def __init__(self, hough_detector, plant_detector, slic_params, use_ndvi=True, superpixels=None) -> None:
         super().__init__()
         self.hough_detector = hough_detector
         self.plant_detector = plant_detector
         self.slic_params = slic_params
+        self.superpixels = superpixels or SuperpixelService(slic_params)
         self.use_ndvi = use_ndvi
         self.__repr__ = f"HoughCC:\n{self.hough_detector.__repr__}"
+
+    def close(self):
+        """
+        Stop the worker processes of the superpixels
+        """
+        self.superpixels.close()
         
     def segment(self, image, mask, slic):
         mask = mask.bool()
@@ -123,9 +183,10 @@ class HoughSLIC(nn.Module):
     def forward(self, image, ndvi=None):
         B, _, H, W = image.shape
         segmentations = []
+        slics = self.superpixels.batch(image)
         for i in range(image.shape[0]):
             mask = self.plant_detector(ndvi=ndvi[i])[0]
-            slic = torch.tensor(get_slic(image[i], self.slic_params), device=mask.device)
+            slic = torch.tensor(slics[i], device=mask.device)
             segmentations.append(self.segment(image[i], mask, slic))
         return ModelOutput(logits=torch.cat(segmentations), scores=None)
 
@@ -109,6 +109,42 @@ def crop_black_borders(image, borders=None):
         return Image.fromarray(image[top : bottom + 1, left : right + 1]), borders
 
 
+def get_patch_padding(height, width, patch_size):
+    """
+    Right and bottom padding of an ortho of size (height, width) in divide_ortho_into_patches.
+
+    Args:
+        height (int): Height of the ortho.
+        width (int): Width of the ortho.
+        patch_size (int): Size of the patches.
+
+    Returns:
+        tuple: (right padding, bottom padding)
+    """
+    right_padding = patch_size - height % patch_size
+    bottom_padding = patch_size - width % patch_size
+    return right_padding, bottom_padding
+
+
+def get_patch_origin(index, height, width, patch_size):
+    """
+    Top left corner in the ortho of the patch written as {index}.png by
+    divide_ortho_into_patches: patches are numbered row by row over the padded ortho.
+
+    Args:
+        index (int): Index of the patch.
+        height (int): Height of the ortho.
+        width (int): Width of the ortho.
+        patch_size (int): Size of the patches.
+
+    Returns:
+        tuple: (x, y) of the top left corner of the patch.
+    """
+    right_padding, _ = get_patch_padding(height, width, patch_size)
+    n_cols = (width + right_padding) // patch_size
+    return (index % n_cols) * patch_size, (index // n_cols) * patch_size
+
+
 def divide_ortho_into_patches(input_folder, output_folder, patch_size):
     """
     Divides the ortho images in the input folder into patches of the specified size
@@ -129,8 +165,9 @@ def divide_ortho_into_patches(input_folder, output_folder, patch_size):
     ]
     ortho = [Image.open(channel) for channel in channels_path]
     tensors = [torchvision.transforms.PILToTensor()(channel) for channel in ortho]
-    right_padding = patch_size - tensors[0].shape[1] % patch_size
-    bottom_padding = patch_size - tensors[0].shape[2] % patch_size
+    right_padding, bottom_padding = get_patch_padding(
+        tensors[0].shape[1], tensors[0].shape[2], patch_size
+    )
     tensors = [
         torch.nn.functional.pad(
             tensor, (0, right_padding, 0, bottom_padding), mode="constant", value=0
@@ -0,0 +1,211 @@
+import json
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+import pandas as pd
+
+NULL_SPAN = nullcontext()
+
+
+class _Span:
+    def __init__(self, profiler, stage):
+        self.profiler = profiler
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        self.profiler.add_time(self.stage, time.perf_counter() - self.start)
+
+
+class Profiler:
+    """
+    Per image stage timers and counters of a run.
+
+    Spans and counters are attributed to the image set with image() in the current
+    thread. Each image is a record of seconds per stage and of counters, finish()
+    adds it to the run totals and writes it as a line of the JSONL trace, if any.
+    Records of other processes are moved with pop() and add_record().
+    When disabled, span() returns a shared no-op context and the other methods
+    return at once, so instrumented code pays only a method call.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.records = {}
+        self.seconds = {}
+        self.counts = {}
+        self.n_images = 0
+        self.start_time = time.perf_counter()
+        self.trace = None
+
+    def enable(self, trace_path=None):
+        """
+        Start recording a run, writing the trace of each finished image to trace_path.
+        """
+        self.reset()
+        self.enabled = True
+        if trace_path is not None:
+            self.trace = open(trace_path, "w")
+
+    def disable(self):
+        self.enabled = False
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+
+    @contextmanager
+    def image(self, key):
+        """
+        Attribute the spans and counters of the current thread to the image key.
+        """
+        previous = getattr(self.local, "key", None)
+        self.local.key = key
+        try:
+            yield
+        finally:
+            self.local.key = previous
+
+    def get_record(self, key):
+        return self.records.setdefault(key, {"seconds": {}, "counts": {}})
+
+    def span(self, stage):
+        """
+        Context timing a stage of the current image.
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return _Span(self, stage)
+
+    def add_time(self, stage, seconds, key=None):
+        if not self.enabled:
+            return
+        with self.lock:
+            record = self.get_record(key or getattr(self.local, "key", None))
+            record["seconds"][stage] = record["seconds"].get(stage, 0) + seconds
+
+    def count(self, name, value=1, key=None):
+        """
+        Add value to a counter of the current image.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            record = self.get_record(key or getattr(self.local, "key", None))
+            record["counts"][name] = record["counts"].get(name, 0) + int(value)
+
+    def pop(self, key):
+        """
+        Record of an image, removed from the profiler, empty if disabled.
+        """
+        with self.lock:
+            return self.records.pop(key, {"seconds": {}, "counts": {}})
+
+    def add_record(self, key, record):
+        """
+        Merge a record popped from another profiler.
+        """
+        for stage, seconds in record["seconds"].items():
+            self.add_time(stage, seconds, key=key)
+        for name, value in record["counts"].items():
+            self.count(name, value, key=key)
+
+    def finish(self, key):
+        """
+        Add the record of a completed image to the totals and to the trace.
+        """
+        if not self.enabled:
+            return
+        record = self.pop(key)
+        with self.lock:
+            self.n_images += 1
+            for stage, seconds in record["seconds"].items():
+                self.seconds[stage] = self.seconds.get(stage, 0) + seconds
+            for name, value in record["counts"].items():
+                self.counts[name] = self.counts.get(name, 0) + value
+            if self.trace is not None:
+                self.trace.write(json.dumps({"image": key, **record}) + "\n")
+
+    def get_totals(self):
+        """
+        Totals of the finished images, to be merged with add_totals.
+        """
+        return {
+            "n_images": self.n_images,
+            "wall_time": time.perf_counter() - self.start_time,
+            "seconds": self.seconds,
+            "counts": self.counts,
+        }
+
+    def add_totals(self, totals):
+        """
+        Add the totals of another run, e.g. of another shard of the same run.
+        """
+        with self.lock:
+            self.n_images += totals["n_images"]
+            for stage, seconds in totals["seconds"].items():
+                self.seconds[stage] = self.seconds.get(stage, 0) + seconds
+            for name, value in totals["counts"].items():
+                self.counts[name] = self.counts.get(name, 0) + value
+
+    def summary(self):
+        """
+        Summary tables of the finished images.
+        Stages: total and per image seconds of each stage and its share of the total
+        stage time (stages of concurrent threads and processes overlap, so the total
+        can exceed the wall time). Counters: total and per image value of each counter.
+
+        Returns:
+            tuple: (stages DataFrame, counters DataFrame)
+        """
+        n_images = max(self.n_images, 1)
+        total_seconds = sum(self.seconds.values()) or 1
+        stages = pd.DataFrame(
+            [
+                {
+                    "stage": stage,
+                    "seconds": seconds,
+                    "per_image": seconds / n_images,
+                    "share": seconds / total_seconds,
+                }
+                for stage, seconds in sorted(self.seconds.items(), key=lambda x: -x[1])
+            ],
+            columns=["stage", "seconds", "per_image", "share"],
+        )
+        counters = pd.DataFrame(
+            [
+                {"counter": name, "total": value, "per_image": value / n_images}
+                for name, value in sorted(self.counts.items())
+            ],
+            columns=["counter", "total", "per_image"],
+        )
+        return stages, counters
+
+    def write_summary(self, path, wall_time=None):
+        """
+        Write the summary tables, wall_time is the time since enable by default.
+        """
+        if wall_time is None:
+            wall_time = time.perf_counter() - self.start_time
+        stages, counters = self.summary()
+        with open(path, "w") as f:
+            f.write(
+                f"images: {self.n_images}\n"
+                f"wall time: {wall_time:.2f} s\n"
+                f"throughput: {self.n_images / wall_time:.3f} images/s\n\n"
+            )
+            f.write(stages.to_string(index=False, float_format="{:.4f}".format))
+            f.write("\n\n")
+            f.write(counters.to_string(index=False, float_format="{:.1f}".format))
+            f.write("\n")
+
+
+# Profiler of the process, disabled unless a run enables it
+PROFILER = Profiler()
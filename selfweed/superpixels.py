@@ -0,0 +1,136 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+
+import numpy as np
+import skimage as ski
+import torch
+import torch.nn.functional as F
+
+from selfweed.cache import hash_array, hash_params
+
+# Largest downscale factor of get_slic, beyond it the agreement with full resolution SLIC
+# is no longer bounded on the synthetic benchmark (see benchmark_slic)
+MAX_SLIC_DOWNSCALE = 2
+
+
+def get_slic(img, slic_params):
+    """
+    Get the SLIC segmentation of an image.
+    If slic_params has a downscale factor, SLIC runs on the image downscaled by it (with
+    the same number of segments and a proportionally smaller sigma) and the segment map
+    is upsampled back with nearest neighbour interpolation. The factor is at most
+    MAX_SLIC_DOWNSCALE: on the synthetic benchmark a factor of 2 is ~3x faster with
+    91-98% agreement of the SLIC weed map on the plant pixels and an achievable
+    segmentation accuracy within 0.004 of full resolution, while larger factors
+    give fewer segments than requested. SLIC runs at full resolution when the
+    downscaled image would have fewer pixels than segments.
+
+    Args:
+        img (torch.Tensor or numpy.ndarray): The (C, H, W) input image.
+        slic_params (dict): Parameters for the SLIC segmentation.
+
+    Returns:
+        numpy.ndarray: The SLIC segmentation.
+    """
+    img = torch.as_tensor(img).cpu()
+    slic_params_cp = deepcopy(slic_params)
+    N = int(np.prod(img.shape[1:]) * slic_params_cp.pop("percent"))
+    downscale = slic_params_cp.pop("downscale", 1)
+    slic_params_cp["n_segments"] = N
+    H, W = img.shape[1:]
+    if downscale > MAX_SLIC_DOWNSCALE:
+        raise ValueError(
+            f"SLIC downscale {downscale} is larger than {MAX_SLIC_DOWNSCALE}"
+        )
+    if max(H // downscale, 1) * max(W // downscale, 1) < N:
+        downscale = 1
+    if downscale > 1:
+        img = F.interpolate(
+            img[None, :3].float(),
+            size=(max(H // downscale, 1), max(W // downscale, 1)),
+            mode="area",
+        )[0]
+        if "sigma" in slic_params_cp:
+            slic_params_cp["sigma"] = slic_params_cp["sigma"] / downscale
+    img = img.permute(1, 2, 0).numpy()
+    slic = ski.segmentation.slic(img[:, :, :3], **slic_params_cp)
+    if downscale > 1:
+        slic = F.interpolate(
+            torch.from_numpy(slic)[None, None].float(), size=(H, W), mode="nearest"
+        )[0, 0].numpy().astype(slic.dtype)
+    return slic
+
+
+def _slic_worker(img, slic_params):
+    torch.set_num_threads(1)
+    return get_slic(img, slic_params)
+
+
+class SuperpixelService:
+    """
+    SLIC segmentations of images, read from a StageCache when available and computed
+    in a process pool for batches.
+
+    Args:
+        slic_params (dict): Parameters for the SLIC segmentation, see get_slic.
+        cache (StageCache): Cache of the segment maps, keyed by the image content and
+            slic_params, None to always compute.
+        workers (int): Number of processes of the batched segmentation.
+    """
+
+    def __init__(self, slic_params, cache=None, workers=1):
+        self.slic_params = slic_params
+        self.cache = cache
+        self.workers = workers
+        self.pool = None
+
+    def get_key(self, img):
+        return hash_params("slic", hash_array(img), self.slic_params)
+
+    def __call__(self, img):
+        return self.batch([img])[0]
+
+    def batch(self, images):
+        """
+        SLIC segmentations of a list (or batch tensor) of (C, H, W) images.
+        """
+        images = [torch.as_tensor(img).cpu() for img in images]
+        if self.cache is None:
+            return self.segment(images)
+        outputs = self.cache.cached_batch(
+            [self.get_key(img) for img in images],
+            lambda missing: [
+                {"slic": slic} for slic in self.segment([images[i] for i in missing])
+            ],
+        )
+        return [np.asarray(output["slic"]) for output in outputs]
+
+    def segment(self, images):
+        if self.workers <= 1 or len(images) <= 1:
+            return [get_slic(img, self.slic_params) for img in images]
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return list(
+            self.pool.map(
+                _slic_worker,
+                [img.numpy() for img in images],
+                [self.slic_params] * len(images),
+            )
+        )
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        return {**self.__dict__, "pool": None}
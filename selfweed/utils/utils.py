@@ -28,6 +28,15 @@ class StrEnum(str, Enum):
     pass
 
 
+def get_device(device=None):
+    """
+    Resolve the device to use, defaulting to CUDA when available
+    """
+    if device is None:
+        return "cuda" if torch.cuda.is_available() else "cpu"
+    return device
+
+
 def load_yaml(file_path):
     with open(file_path, "r") as yaml_file:
         return yaml.safe_load(yaml_file.read())
@@ -273,6 +282,24 @@ def merge_bboxes(bboxes):
     return torch.tensor([cx, cy, x1, y1, x2, y2, width, height])
 
 
+def get_regions_from_stats(stats):
+    """
+    Build the region tensor from cv2.connectedComponentsWithStats stats.
+    :param stats: (N, 5) tensor of (x0, y0, width, height, area) rows
+    :return: (N, 8) tensor where each row is (cx, cy, x0, y0, x1, y1, width, height)
+    """
+    stats = stats.long()
+    x0 = stats[:, cv2.CC_STAT_LEFT]
+    y0 = stats[:, cv2.CC_STAT_TOP]
+    width = stats[:, cv2.CC_STAT_WIDTH]
+    height = stats[:, cv2.CC_STAT_HEIGHT]
+    x1 = x0 + width - 1
+    y1 = y0 + height - 1
+    cx = torch.round((x1 + x0) / 2).long()
+    cy = torch.round((y1 + y0) / 2).long()
+    return torch.stack([cx, cy, x0, y0, x1, y1, width, height], dim=1)
+
+
 def intersection_point(l1, l2):
     m1, b1 = l1
     m2, b2 = l2
@@ -402,31 +429,79 @@ def get_circular_interval(inf, sup, interval_max):
 
 
 def max_displacement(width, height):
+    if torch.is_tensor(width) and width.ndim > 0:
+        return torch.div(torch.maximum(width, height), 2, rounding_mode="floor")
     return int(width / 2 if width > height else height / 2)
 
 
 def mean_displacement(width, height):
+    if torch.is_tensor(width) and width.ndim > 0:
+        return torch.div(width + height, 4, rounding_mode="floor")
     return int((width + height) / 4)
 
 
-def get_medians(theta_rhos: torch.Tensor, cluster_index):
+def paint_boxes(shape, y0, y1, x0, x1):
+    """
+    Paint the boxes [y0, y1) x [x0, x1) with a 2D difference array: +1 on the
+    top-left and bottom-right corners, -1 on the other two, then an integral image.
+    :param shape: (H, W) shape of the mask
+    :param y0, y1, x0, x1: (N,) box bounds, already clipped to the mask
+    :return: (H, W) boolean mask, True where at least one box is painted
+    """
+    height, width = shape
+    corners = torch.cat([y0 * (width + 1) + x0, y1 * (width + 1) + x1])
+    opposites = torch.cat([y0 * (width + 1) + x1, y1 * (width + 1) + x0])
+    size = (height + 1) * (width + 1)
+    diff = torch.bincount(corners, minlength=size) - torch.bincount(
+        opposites, minlength=size
+    )
+    coverage = diff.reshape(height + 1, width + 1).cumsum(0).cumsum(1)
+    return coverage[:height, :width] > 0
+
+
+def get_medians(theta_rhos: torch.Tensor, cluster_index, group_index=None, n_groups=1):
     """
     Get the median lines from each cluster
     :param theta_rhos: tensor for thetas and rhos (N, 2)
-    :param cluster_index: list of indices for each cluster start
-    :return: medians from each cluster
+    :param cluster_index: list or tensor of indices for each cluster start, plus the end index
+    :param group_index: optional (N,) sorted group of each line (e.g. the image index),
+        clusters must not span two groups
+    :param n_groups: number of groups
+    :return: medians from each cluster, a tuple with the medians of each group if group_index is given
     """
-    if theta_rhos.shape[0] > 0:
-        return torch.stack(
-            [
-                theta_rhos[(i + j) // 2]
-                for i, j in previous_iterator(cluster_index, return_first=False)
-            ]
+    cluster_index = torch.as_tensor(cluster_index, device=theta_rhos.device)
+    median_index = (cluster_index[:-1] + cluster_index[1:]) // 2
+    if group_index is not None:
+        return theta_rhos[median_index].split(
+            torch.bincount(group_index[median_index], minlength=n_groups).tolist()
         )
+    if theta_rhos.shape[0] > 0:
+        return theta_rhos[median_index]
     else:
         return torch.tensor([])
 
 
+def get_cluster_index(values: torch.Tensor, tol, group_index=None):
+    """
+    Get the cluster boundaries of sorted values: a new cluster starts where two
+    consecutive values differ more than tol or belong to different groups
+    :param values: (N,) sorted values (sorted within each group)
+    :param tol: scalar tolerance or (N,) tolerance of each value
+    :param group_index: optional (N,) sorted group of each value (e.g. the image index)
+    :return: (C + 1,) tensor with the index where each cluster starts and the end index
+    """
+    if values.shape[0] == 0:
+        return torch.zeros(1, dtype=torch.long, device=values.device)
+    if torch.is_tensor(tol) and tol.ndim > 0:
+        tol = tol[1:]
+    breaks = torch.diff(values).abs() > tol
+    if group_index is not None:
+        breaks |= torch.diff(group_index) != 0
+    starts = torch.nonzero(breaks).flatten() + 1
+    bounds = torch.tensor([0, values.shape[0]], device=values.device)
+    return torch.cat([bounds[:1], starts, bounds[1:]])
+
+
 def get_line_boxes(theta, rho, is_deg, img_width, img_height):
     if is_deg:
         theta = np.deg2rad(theta)
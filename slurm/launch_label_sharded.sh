@@ -0,0 +1,9 @@
+#!/bin/bash
+# Label on NUM_SHARDS nodes, then merge the shards when all of them succeed
+# Usage: ./slurm/launch_label_sharded.sh NUM_SHARDS OUTDIR PARAMETERS [label options]
+NUM_SHARDS=$1
+OUTDIR=$2
+PARAMETERS=$3
+shift 3
+JOB_ID=$(sbatch --parsable --array=0-$((NUM_SHARDS - 1)) slurm/launch_label --outdir $OUTDIR --parameters $PARAMETERS $@)
+sbatch --dependency=afterok:$JOB_ID slurm/launch_label_merge --outdir $OUTDIR --parameters $PARAMETERS
@@ -18,7 +18,15 @@ from selfweed.detector import (
     get_vegetation_detector as get_vegetation_detector_fn,
 )
 from selfweed.data import get_dataset
-from selfweed.labeling import get_drawn_img, label_from_row, label, save_and_label
+from selfweed.cache import StageCache
+from selfweed.labeling import (
+    detect_rows,
+    get_drawn_img,
+    get_field,
+    label_from_row,
+    label,
+    save_and_label,
+)
 from selfweed.visualize import map_grayscale_to_rgb
 
 
@@ -36,6 +44,31 @@ def get_vegetation_detector(ndvi_threshold=0.5):
     return get_vegetation_detector_fn(name, params)
 
 
+@st.cache_resource
+def get_stage_cache(root):
+    return StageCache(root) if root else None
+
+
+def get_plant_detector_params():
+    return dict(
+        name=st.session_state["vegetation_detector"],
+        params=dict(threshold=st.session_state["ndvi_threshold"]),
+    )
+
+
+def get_hough_detector_params():
+    return dict(
+        threshold=st.session_state["threshold"],
+        step_theta=st.session_state["step_theta"],
+        step_rho=st.session_state["step_rho"],
+        angle_error=st.session_state["angle_error"],
+        clustering_tol=st.session_state["clustering_tol"],
+        uniform_significance=st.session_state["uniform_significance"],
+        theta_reduction_threshold=st.session_state["theta_reduction_threshold"],
+        theta_value=st.session_state["theta_value"],
+    )
+
+
 def get_thumbnail(path):
     i = Image.open(path)
     i.thumbnail((150, 150), Image.LANCZOS)
@@ -84,20 +117,19 @@ def display_prediction():
     img = data_dict.image
     gt = data_dict.target
 
-    mask = st.session_state["labeller"](img)
-    st.write(mask.shape)
     detector = HoughCropRowDetector(
-        threshold=st.session_state["threshold"],
+        **get_hough_detector_params(),
         crop_detector=st.session_state["labeller"],
-        step_theta=st.session_state["step_theta"],
-        step_rho=st.session_state["step_rho"],
-        angle_error=st.session_state["angle_error"],
-        clustering_tol=st.session_state["clustering_tol"],
-        uniform_significance=st.session_state["uniform_significance"],
-        theta_reduction_threshold=st.session_state["theta_reduction_threshold"],
-        theta_value=st.session_state["theta_value"],
     )
-    res = detector.predict_from_mask(mask)
+    mask, res = detect_rows(
+        img,
+        st.session_state["labeller"],
+        detector,
+        field=get_field(data_dict.name),
+        cache=get_stage_cache(st.session_state["cache_dir"]),
+        stage_params=(get_plant_detector_params(), get_hough_detector_params()),
+    )
+    st.write(mask.shape)
     lines = res[HoughDetectorDict.LINES]
     original_lines = res[HoughDetectorDict.ORIGINAL_LINES]
     uniform_significance = res[HoughDetectorDict.UNIFORM_SIGNIFICANCE]
@@ -219,6 +251,11 @@ if __name__ == "__main__":
         st.session_state["labeller"] = get_vegetation_detector(
             ndvi_threshold=ndvi_threshold
         )
+        st.text_input(
+            value="",
+            label="Stage cache directory (empty to disable)",
+            key="cache_dir",
+        )
     col1, col2 = st.columns(2)
     with col1:
         st.slider(
@@ -278,22 +315,18 @@ if __name__ == "__main__":
                     threshold=st.session_state["ndvi_threshold"],
                 ),
             ),
-            hough_detector_params=dict(
-                threshold=st.session_state["threshold"],
-                step_theta=st.session_state["step_theta"],
-                step_rho=st.session_state["step_rho"],
-                angle_error=st.session_state["angle_error"],
-                clustering_tol=st.session_state["clustering_tol"],
-                uniform_significance=st.session_state["uniform_significance"],
-                theta_reduction_threshold=st.session_state["theta_reduction_threshold"],
-                theta_value=st.session_state["theta_value"],
-            ),
+            hough_detector_params=get_hough_detector_params(),
             dataset_params=dict(
                 root=st.session_state["root"],
                 modality=st.session_state["modality"],
                 fields=st.session_state["fields"],
             ),
             interactive=True,
+            cache_params=(
+                dict(root=st.session_state["cache_dir"])
+                if st.session_state["cache_dir"]
+                else None
+            ),
         ):
             bar.progress(i / len(st.session_state["dataset"]))
 